@@ -0,0 +1,478 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# benchmark: times each stage of the processing (decode, undistort, CLAHE,
+#            deblur, DGS, the built in wavelet engine and coallation) on the test
+#            images, scaled up copies of them and synthetic trees of N samples,
+#            with the peak memory of each run. The results are written as json
+#            and can be compared against a stored baseline, including a check
+#            that the grain size distributions still agree.
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import multiprocessing
+import concurrent.futures
+import yaml
+import cv2
+import numpy as np
+
+from distortion_calibration import calibration_registry
+from dgs_analysis import dgs_analysis, dgs_array, check_dgs, use_native
+from wavelet_engine import wavelet_gsd
+from deblur import deblur
+from coallate_gsd_data import coallate_gsd_data
+from sample_index import sample_index
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# the test images and config shipped with photoseive
+package_dir = os.path.dirname (os.path.abspath (__file__))
+default_images = [os.path.join (package_dir, 'test_images', 'image.jpg')]
+default_config_file = os.path.join (package_dir, 'config.txt')
+
+# the grain size results kept for each case: the engine in the config (DGS by
+# default) and the built in wavelet engine
+gsd_keys = ('gsd', 'wavelet_gsd')
+
+# default analysis scales, as in run_dgs_analysis
+default_scales = np.append (np.arange (0.02, 0.5, 0.02), np.arange (0.5, 8.0, 0.2))
+
+def peak_rss ():
+    '''
+    function to get the peak resident memory (bytes) of this process so far,
+    or None if it cannot be found on this platform
+    '''
+    if resource is not None:
+        rss = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+        return (rss if sys.platform == 'darwin' else rss * 1024)
+    try:
+        import psutil
+        return (psutil.Process ().memory_info ().peak_wset)
+    except (ImportError, AttributeError):
+        return None
+
+def time_stage (func, repeats):
+    '''
+    function to time a stage: runs func repeats times and returns (result of the
+    last run, dict of the median and best times in seconds, and the peak rss of the
+    process after it, which includes the stages before it in the same process)
+    func = the stage to run (no arguments)
+    repeats = number of times to run it
+    '''
+    times = []
+    for i in range (repeats):
+        start = time.perf_counter ()
+        result = func ()
+        times.append (time.perf_counter () - start)
+    return (result, dict (seconds = float (np.median (times)), best = float (min (times)),
+                          repeats = repeats, process_peak_rss = peak_rss ()))
+
+def bench_config (config_file = default_config_file):
+    '''
+    function to read the config used for the benchmark, with the keys the
+    analysis needs that the shipped config.txt does not have
+    config_file = the config file
+    '''
+    with open (config_file, 'r') as f:
+        config = yaml.safe_load (f)
+    config.setdefault ('minscale', 0)
+    config.setdefault ('clahe_dims', 16)
+    return (config)
+
+def write_synthetic_calibration (width, height, calibration_file):
+    '''
+    function to write a calibration file (in the form distortion_calibration reads)
+    with a plausible camera matrix and barrel distortion for the image size, so the
+    undistort stage can be timed without a real calibration
+    width = image width
+    height = image height
+    calibration_file = the file to write
+    '''
+    with open (calibration_file, 'w') as f:
+        f.write ('K = np.array ([[' + str (float (width)) + ', 0.0, ' + str (width / 2.0) + '], ' +
+                 '[0.0, ' + str (float (width)) + ', ' + str (height / 2.0) + '], [0.0, 0.0, 1.0]])\n')
+        f.write ('d = np.array ([-0.1, 0.01, 0.0, 0.0, 0.0])\n')
+    return
+
+def gsd_record (dgs_stats):
+    '''
+    function to keep the grain size results of a case as json friendly lists
+    dgs_stats = the results dict (in the form DGS.dgs returns)
+    '''
+    return (dict (mean = float (dgs_stats['mean grain size']),
+                  sorting = float (dgs_stats['grain size sorting']),
+                  bins = np.asarray (dgs_stats['grain size bins'], dtype = np.float64).tolist (),
+                  freqs = np.asarray (dgs_stats['grain size frequencies'], dtype = np.float64).tolist (),
+                  percentiles = np.asarray (dgs_stats['percentiles'], dtype = np.float64).tolist (),
+                  percentile_values = np.asarray (dgs_stats['percentile_values'],
+                                                  dtype = np.float64).tolist ()))
+
+def make_scaled_image (image_file, scale, out_dir):
+    '''
+    function to make a scaled up (or down) copy of an image, for scaling curves
+    with image size. Returns the new image file name.
+    image_file = the image to scale
+    scale = the linear scale factor (2 is 4 times the pixels)
+    out_dir = directory to write the scaled image to
+    '''
+    img = cv2.imread (image_file)
+    img = cv2.resize (img, None, fx = scale, fy = scale, interpolation = cv2.INTER_CUBIC)
+    name = os.path.splitext (os.path.basename (image_file))[0] + '_x' + str (scale) + '.jpg'
+    out_file = os.path.join (out_dir, name)
+    cv2.imwrite (out_file, img, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    return (out_file)
+
+def bench_image (image_file, config, scales, repeats = 3, radius = 20, tint = 0.0,
+                 calibration_file = None):
+    '''
+    function to time the image stages on one image. Returns the case dict with the
+    stage timings and the grain size results (to check against a baseline).
+    image_file = the image to time
+    config = the config dict
+    scales = scales for analysis (a numpy array)
+    repeats = number of times to run each stage
+    radius = the deblur highpass radius
+    tint = the deblur tint
+    calibration_file = calibration file for the undistort stage (optional, a
+                       synthetic calibration is used if not given)
+    '''
+    work_dir = tempfile.mkdtemp (prefix = 'photoseive_bench_')
+    try:
+        stages = dict ()
+        grey, stages['decode'] = time_stage (
+            lambda: cv2.imread (image_file, cv2.IMREAD_GRAYSCALE), repeats)
+        height, width = grey.shape
+
+        # undistort, the maps are built once (timed on their own) and then reused
+        if calibration_file is None:
+            calibration_file = os.path.join (work_dir, 'calibration.txt')
+            write_synthetic_calibration (width, height, calibration_file)
+        reg = calibration_registry (os.path.join (work_dir, 'maps'))
+        maps, stages['undistort_maps'] = time_stage (
+            lambda: reg.get_maps (calibration_file, (width, height)), 1)
+        unwarped, stages['undistort'] = time_stage (
+            lambda: reg.undistort (grey, calibration_file), repeats)
+
+        # clahe as in dgs_analysis.run_CLAHE
+        clahe = cv2.createCLAHE (clipLimit = 2.0, tileGridSize = (int (config['clahe_dims']),
+                                                                  int (config['clahe_dims'])))
+        clahe_img, stages['clahe'] = time_stage (lambda: clahe.apply (unwarped), repeats)
+
+        # deblur on the colour image (the decode is not part of the stage)
+        db = deblur (image_file)
+        res, stages['deblur'] = time_stage (lambda: db.tinted_highpass (radius, tint), repeats)
+        del db, res
+
+        # the grainsize analysis, the png handover (if DGS needs a file) is written once.
+        # Without DGS installed the stage is recorded as skipped.
+        dgs_stats = None
+        try:
+            if not use_native (config):
+                check_dgs ()
+        except ImportError as e:
+            stages['dgs'] = dict (skipped = str (e))
+            print ('WARNING: skipping the dgs stage: ' + str (e))
+        else:
+            handover_file = os.path.join (work_dir, 'clahe.png')
+            dgs_stats, stages['dgs'] = time_stage (
+                lambda: dgs_array (clahe_img, config, scales, handover_file), repeats)
+
+        # the built in wavelet engine on the same image
+        native_config = dict (config, engine = 'native')
+        wavelet_stats, stages['wavelet'] = time_stage (
+            lambda: wavelet_gsd (clahe_img, native_config, scales), repeats)
+
+        case = dict (image = os.path.basename (image_file), width = width, height = height,
+                     megapixels = width * height / 1.0e6, stages = stages,
+                     peak_rss = peak_rss ())
+        if dgs_stats is not None:
+            case['gsd'] = gsd_record (dgs_stats)
+        case['wavelet_gsd'] = gsd_record (wavelet_stats)
+    finally:
+        shutil.rmtree (work_dir, ignore_errors = True)
+
+    return (case)
+
+def make_sample_tree (base_dir, n, image_file, config, gsd):
+    '''
+    function to make a synthetic tree of n sample directories, each with a config
+    file, the image (hard linked where possible) and the output files of a
+    finished analysis, for timing the tree stages
+    base_dir = base directory of the tree
+    n = number of samples
+    image_file = the image for each sample
+    config = the config dict
+    gsd = the grain size results of a case (see bench_image)
+    '''
+    dgs_stats = {'mean grain size': gsd['mean'], 'grain size sorting': gsd['sorting'],
+                 'grain size skewness': 0.0, 'grain size kurtosis': 0.0,
+                 'percentiles': gsd['percentiles'], 'percentile_values': gsd['percentile_values'],
+                 'grain size bins': gsd['bins'], 'grain size frequencies': gsd['freqs']}
+    for i in range (n):
+        sample_dir = os.path.join (base_dir, 'site_' + str (i // 100), 'sample_' + str (i))
+        os.makedirs (sample_dir)
+        sample_image = os.path.join (sample_dir, 'IMG_' + str (i) + '.JPG')
+        try:
+            os.link (image_file, sample_image)
+        except OSError:
+            shutil.copyfile (image_file, sample_image)
+
+        with open (os.path.join (sample_dir, 'config.txt'), 'w') as f:
+            yaml.dump (config, f, default_flow_style = False)
+        gs = dgs_analysis (sample_image, None)
+        gs.dgs_stats = dgs_stats
+        gs.write_stats ()
+        gs.write_gsd ()
+    return
+
+def bench_tree (n, image_file, config, gsd, repeats = 1, jobs = 8):
+    '''
+    function to time the tree stages (index refresh and coallation) on a
+    synthetic tree of n samples. Returns the tree dict with the stage timings.
+    n = number of samples
+    image_file = the image for each sample
+    config = the config dict
+    gsd = the grain size results of a case (see bench_image)
+    repeats = number of times to run each stage
+    jobs = number of threads for the coallation
+    '''
+    work_dir = tempfile.mkdtemp (prefix = 'photoseive_bench_tree_')
+    base_dir = os.path.join (work_dir, 'tree')
+    index_file = os.path.join (work_dir, 'index.sqlite')
+    try:
+        make_sample_tree (base_dir, n, image_file, config, gsd)
+        stages = dict ()
+
+        def refresh ():
+            if os.path.isfile (index_file):
+                os.unlink (index_file)
+            idx = sample_index (index_file)
+            idx.refresh (base_dir)
+            idx.close ()
+        res, stages['index'] = time_stage (refresh, repeats)
+
+        output_file = os.path.join (work_dir, 'coallated.csv')
+        res, stages['coallate'] = time_stage (
+            lambda: coallate_gsd_data (base_dir, output_file, jobs, index_file = index_file),
+            repeats)
+        tree = dict (samples = n, rows = len (res), stages = stages, peak_rss = peak_rss ())
+    finally:
+        shutil.rmtree (work_dir, ignore_errors = True)
+
+    return (tree)
+
+def run_isolated (func, *args):
+    '''
+    function to run a benchmark function in a fresh process, so the peak memory
+    is that of the one case
+    '''
+    context = multiprocessing.get_context ('spawn')
+    with concurrent.futures.ProcessPoolExecutor (max_workers = 1, mp_context = context) as pool:
+        return (pool.submit (func, *args).result ())
+
+def run_benchmark (images = default_images, image_scales = (1,), tree_sizes = (), repeats = 3,
+                   config_file = default_config_file, scales = default_scales, radius = 20,
+                   tint = 0.0, calibration_file = None, jobs = 8, isolate = True):
+    '''
+    function to run the benchmark. Returns the results dict (see write_results).
+    images = the images to time
+    image_scales = linear scale factors to time each image at (1 is the image as is)
+    tree_sizes = numbers of samples for the synthetic tree timings
+    repeats = number of times to run each stage
+    config_file = the config file to use for the analysis
+    scales = scales for analysis (a numpy array)
+    radius = the deblur highpass radius
+    tint = the deblur tint
+    calibration_file = calibration file for the undistort stage (optional)
+    jobs = number of threads for the coallation
+    isolate = run each case in a fresh process, so each has its own peak memory
+    '''
+    config = bench_config (config_file)
+    run = (lambda func, *args: run_isolated (func, *args)) if isolate else \
+          (lambda func, *args: func (*args))
+
+    results = dict (time = time.strftime ('%Y-%m-%d %H:%M:%S'),
+                    machine = dict (platform = platform.platform (), python = platform.python_version (),
+                                    processor = platform.processor (), cpus = os.cpu_count (),
+                                    opencv = cv2.__version__, numpy = np.__version__),
+                    config = config, repeats = repeats, cases = [], trees = [])
+
+    work_dir = tempfile.mkdtemp (prefix = 'photoseive_bench_images_')
+    try:
+        for image_file in images:
+            for s in image_scales:
+                case_file = image_file if s == 1 else make_scaled_image (image_file, s, work_dir)
+                case = run (bench_image, case_file, config, scales, repeats, radius, tint,
+                            calibration_file)
+                case['image'] = os.path.basename (image_file)
+                case['scale'] = s
+                results['cases'].append (case)
+                print ('timed: ' + case['image'] + ' x' + str (s) + ' ' + stage_summary (case))
+                if s != 1:
+                    os.unlink (case_file)
+    finally:
+        shutil.rmtree (work_dir, ignore_errors = True)
+
+    if len (results['cases']) > 0:
+        for n in tree_sizes:
+            first = results['cases'][0]
+            tree = run (bench_tree, n, images[0], config, first.get ('gsd', first['wavelet_gsd']),
+                        repeats, jobs)
+            results['trees'].append (tree)
+            print ('timed: tree of ' + str (n) + ' samples ' + stage_summary (tree))
+
+    return (results)
+
+def stage_summary (case):
+    '''
+    function to make a one line summary of the stage times of a case or tree
+    '''
+    return (', '.join (k + (' skipped' if 'skipped' in v else ' ' + '%.3f' % v['seconds'] + ' s')
+                       for k, v in case['stages'].items ()))
+
+def write_results (results, output_file):
+    '''
+    function to write the benchmark results as json
+    '''
+    with open (output_file, 'w') as f:
+        json.dump (results, f, indent = 1)
+    return
+
+def read_results (results_file):
+    '''
+    function to read benchmark results (e.g. a stored baseline)
+    '''
+    with open (results_file, 'r') as f:
+        return (json.load (f))
+
+def compare_results (results, baseline, gsd_tolerance = 1e-6, time_tolerance = 0.1):
+    '''
+    function to compare benchmark results against a baseline: prints the speedup
+    of each stage, and checks the grain size distributions agree. Returns a list
+    of problems (gsd disagreements and stages slower than the tolerance allows).
+    results = the results dict
+    baseline = the baseline results dict
+    gsd_tolerance = largest allowed absolute difference of the frequencies,
+                    percentile values and mean (relative for the mean and
+                    percentile values)
+    time_tolerance = allowed slowdown of a stage as a fraction (0.1 is 10 % slower)
+    '''
+    problems = []
+
+    def compare_stages (name, current, base):
+        for stage, t in current['stages'].items ():
+            if stage not in base['stages'] or 'skipped' in t or 'skipped' in base['stages'][stage]:
+                continue
+            ratio = base['stages'][stage]['seconds'] / max (t['seconds'], 1e-12)
+            print ('%-28s %-10s %9.3f s  baseline %9.3f s  speedup %6.2fx' %
+                   (name, stage, t['seconds'], base['stages'][stage]['seconds'], ratio))
+            if t['seconds'] > base['stages'][stage]['seconds'] * (1.0 + time_tolerance):
+                problems.append (name + ' ' + stage + ' is slower than the baseline')
+
+    base_cases = dict (((c['image'], c['scale']), c) for c in baseline.get ('cases', []))
+    for case in results['cases']:
+        name = case['image'] + ' x' + str (case['scale'])
+        base = base_cases.get ((case['image'], case['scale']))
+        if base is None:
+            print (name + ': not in the baseline')
+            continue
+        compare_stages (name, case, base)
+
+        # the grain size results must agree
+        for key in gsd_keys:
+            if key not in case or key not in base:
+                continue
+            gsd, base_gsd = case[key], base[key]
+            if len (gsd['bins']) != len (base_gsd['bins']) or \
+               not np.allclose (gsd['bins'], base_gsd['bins'], rtol = gsd_tolerance, atol = 0.0):
+                problems.append (name + ' ' + key + ' bins differ from the baseline')
+                continue
+            freq_diff = np.max (np.abs (np.asarray (gsd['freqs']) - np.asarray (base_gsd['freqs'])))
+            value_diff = np.max (np.abs (np.asarray (gsd['percentile_values']) -
+                                         np.asarray (base_gsd['percentile_values'])) /
+                                 np.maximum (np.abs (np.asarray (base_gsd['percentile_values'])), 1e-12))
+            mean_diff = abs (gsd['mean'] - base_gsd['mean']) / max (abs (base_gsd['mean']), 1e-12)
+            print ('%-28s %-10s freqs %.2e  percentiles %.2e  mean %.2e' %
+                   (name, key, freq_diff, value_diff, mean_diff))
+            if freq_diff > gsd_tolerance or value_diff > gsd_tolerance or mean_diff > gsd_tolerance:
+                problems.append (name + ' ' + key + ' differs from the baseline')
+
+    base_trees = dict ((t['samples'], t) for t in baseline.get ('trees', []))
+    for tree in results['trees']:
+        base = base_trees.get (tree['samples'])
+        if base is not None:
+            compare_stages ('tree of ' + str (tree['samples']), tree, base)
+
+    for p in problems:
+        print ('PROBLEM: ' + p)
+    return (problems)
+
+def main (argv = None):
+    '''
+    function to run the benchmark from the command line, returns the exit status
+    (1 if the comparison with the baseline found problems)
+    argv = the command line arguments (optional, defaults to sys.argv)
+    '''
+    parser = argparse.ArgumentParser (description = 'time the photoseive processing stages')
+    parser.add_argument ('--images', nargs = '+', default = default_images,
+                         help = 'images to time (default: test_images/image.jpg)')
+    parser.add_argument ('--scales', nargs = '+', type = float, default = [1],
+                         help = 'linear scale factors to time each image at, e.g. 1 2 4')
+    parser.add_argument ('--trees', nargs = '+', type = int, default = [],
+                         help = 'synthetic tree sizes (samples) to time the tree stages on')
+    parser.add_argument ('--repeats', type = int, default = 3, help = 'runs of each stage')
+    parser.add_argument ('--config', default = default_config_file, help = 'config file')
+    parser.add_argument ('--calibration', default = None,
+                         help = 'calibration file for the undistort stage (default: synthetic)')
+    parser.add_argument ('--jobs', type = int, default = 8, help = 'coallation threads')
+    parser.add_argument ('--output', default = 'benchmark.json', help = 'results json file')
+    parser.add_argument ('--baseline', default = None, help = 'baseline json file to compare to')
+    parser.add_argument ('--gsd-tolerance', type = float, default = 1e-6,
+                         help = 'allowed difference of the grain size results')
+    parser.add_argument ('--time-tolerance', type = float, default = 0.1,
+                         help = 'allowed slowdown of a stage (fraction)')
+    parser.add_argument ('--no-isolate', action = 'store_true',
+                         help = 'run every case in this process')
+    args = parser.parse_args (argv)
+
+    image_scales = [int (s) if s == int (s) else s for s in args.scales]
+    results = run_benchmark (args.images, image_scales, args.trees, args.repeats, args.config,
+                             calibration_file = args.calibration, jobs = args.jobs,
+                             isolate = not args.no_isolate)
+    write_results (results, args.output)
+    print ('results written to: ' + args.output)
+
+    if args.baseline is not None:
+        problems = compare_results (results, read_results (args.baseline),
+                                    args.gsd_tolerance, args.time_tolerance)
+        return (1 if len (problems) > 0 else 0)
+    return (0)
+
+# MAIN
+if __name__ == '__main__':
+    sys.exit (main ())
@@ -25,85 +25,251 @@ import glob
 import numpy as np
 import pandas as pd
 import yaml
-import copy
+import concurrent.futures
+
+from sample_index import find_samples, default_index_file
+from result_store import result_store, array_fields
+from instrumentation import timer
+from config_resolver import resolve_config
+from sample_cache import parse_rois, roi_file_name
+
+# columns that identify the sample
+id_keys = ('dir_base', 'dir', 'dir_oneup_base')
+
+# columnar formats written next to the csv file
+default_columnar = ('parquet', 'feather')
+
+def read_sample (directory, record = None, config = None, roi = None):
+    '''
+    function to read the config, stats, percentiles and gsd of one sample into a
+    dict of column name: value (the columns are in the coallated table order)
+    
+    directory = the sample directory
+    record = the record of the sample from a result store (optional), used in
+             place of the stats.txt, gsd.txt and percentiles.txt files
+    config = the config dict the results were made with (optional), used in place
+             of the config.txt file (e.g. a parameter sweep combination)
+    roi = the region of interest to read the results of (optional), from its
+          stats_<roi>.txt, gsd_<roi>.txt and percentiles_<roi>.txt files
+    '''
+    if config is None:
+        config = resolve_config (os.path.join (directory, 'config.txt'))
+    if record is None:
+        with open (os.path.join (directory, roi_file_name ('stats.txt', roi)), 'r') as f:
+            stats = yaml.safe_load (f)
+        gsd = pd.read_csv (os.path.join (directory, roi_file_name ('gsd.txt', roi)))
+        perc = pd.read_csv (os.path.join (directory, roi_file_name ('percentiles.txt', roi)))
+    else:
+        stats = dict ((k, v) for k, v in record.items ()
+                      if k not in array_fields and k not in ('sample', 'write_time'))
+        gsd = dict (bins = pd.Series (record['bins']), freqs = record['freqs'])
+        perc = dict (percentiles = pd.Series (record['percentiles']),
+                     vals = record['percentile_values'])
+    
+    row = dict ()
+    row['dir_base'] = os.path.basename (directory)
+    row['dir'] = directory
+    row['dir_oneup_base'] = os.path.basename (os.path.dirname (directory))
+    if roi is not None:
+        row['roi'] = roi
+    row.update ((k, v) for k, v in config.items () if k != 'rois')
+    row.update (stats)
+    row.update (zip ('p_' + perc['percentiles'].astype ('str'), perc['vals']))
+    row.update (zip ('b_' + gsd['bins'].astype ('str'), gsd['freqs']))
+    return (row)
+
+def read_sample_rows (directory, records = None, config = None):
+    '''
+    function to read the rows of one sample (see read_sample): one row, or one for
+    each region of interest if the config has rois
+    
+    directory = the sample directory
+    records = the records of the sample from a result store (optional, a list)
+    config = the config dict (optional, read from the config.txt file)
+    '''
+    if config is None:
+        config = resolve_config (os.path.join (directory, 'config.txt'))
+    rois = parse_rois (config)
+    if len (rois) == 0:
+        if records is None:
+            return ([read_sample (directory, None, config)])
+        return ([read_sample (directory, records[-1] if records else dict (), config)])
+    
+    by_roi = dict ((r.get ('roi'), r) for r in records) if records is not None else None
+    return ([read_sample (directory, by_roi.get (name, dict ()) if by_roi is not None else None,
+                         config, name) for name, box in rois])
+
+def order_columns (columns):
+    '''
+    function to put the columns in the coallated table order: the id, config and
+    stats columns, then the p_ and b_ columns in numerical order
+    
+    columns = list of the column names
+    '''
+    def numeric_order (prefix):
+        cols = [c for c in columns if c.startswith (prefix)]
+        try:
+            cols.sort (key = lambda c: float (c[len (prefix):]))
+        except ValueError:
+            pass
+        return (cols)
+    
+    other = [c for c in columns if not (c.startswith ('p_') or c.startswith ('b_'))]
+    return (other + numeric_order ('p_') + numeric_order ('b_'))
+
+def build_table (rows):
+    '''
+    function to build the coallated table from a list of sample dicts in one pass.
+    Samples with different config, stats, percentile or bin keys are aligned on
+    the union of the columns (missing values are NaN).
+    
+    rows = list of dicts from read_sample
+    '''
+    columns = []
+    seen = set ()
+    for row in rows:
+        for k in row:
+            if k not in seen:
+                seen.add (k)
+                columns.append (k)
+    columns = order_columns (columns)
+    
+    # build each column in one pass
+    data = dict ()
+    for c in columns:
+        data[c] = [row.get (c, np.nan) for row in rows]
+    return (pd.DataFrame (data, columns = columns))
+
+def write_columnar (res, output_file, columnar = default_columnar):
+    '''
+    function to write the coallated table as parquet and/or feather files next to
+    the csv file (these need pyarrow, they are skipped if it is not installed)
+    
+    res = the coallated dataframe
+    output_file = the csv output file
+    columnar = the formats to write
+    '''
+    if not columnar:
+        return
+    
+    # mixed type config columns (e.g. numbers and strings) are written as strings
+    res = res.copy ()
+    for c in res.columns:
+        if res[c].dtype == object:
+            res[c] = res[c].where (res[c].isna (), res[c].astype (str))
+    
+    base = os.path.splitext (output_file)[0]
+    for fmt in columnar:
+        try:
+            if fmt == 'parquet':
+                res.to_parquet (base + '.parquet', index = False)
+            elif fmt == 'feather':
+                res.reset_index (drop = True).to_feather (base + '.feather')
+            else:
+                print ('ERROR: unknown columnar format: ' + fmt)
+        except ImportError:
+            print ('WARNING: cannot write ' + fmt + ' without pyarrow installed')
+    return
+
+def read_coallated (output_file):
+    '''
+    function to read an existing coallated table, from the parquet file if there
+    is one (faster, keeps the types), else the csv
+    
+    output_file = the csv output file
+    '''
+    parquet_file = os.path.splitext (output_file)[0] + '.parquet'
+    if os.path.isfile (parquet_file) and \
+       os.path.getmtime (parquet_file) >= os.path.getmtime (output_file):
+        try:
+            return (pd.read_parquet (parquet_file))
+        except ImportError:
+            pass
+    return (pd.read_csv (output_file))
 
 # coallate all the data into a pandas dataframe
 
-def coallate_gsd_data (base_dir, output_file):
+def coallate_gsd_data (base_dir, output_file, jobs = 8, incremental = False,
+                       columnar = default_columnar, store = None, index_file = default_index_file):
     '''
     method to coallate all the data into a pandas dataframe
     
     base_dir = the base directory to walk from
     output_file = the output file to place the pandas dataframe into
+    jobs = number of threads to read the samples on
+    incremental = only read the samples that are new or have changed since the
+                  output file was written, and update the existing table
+    columnar = columnar formats to write next to the csv ('parquet', 'feather')
+    store = result store directory to read the results from, in place of the output
+            files in each sample directory (optional)
+    index_file = the sample index file (see sample_index)
+    
+    This returns the coallated dataframe
     '''
+    with timer ('find_samples'):
+        samples = find_samples (base_dir, index_file = index_file)
 
-    first_row = True
+    # read the whole result store at once
+    records = dict ()
+    if store is not None:
+        table = result_store (store).read_table ()
+        if table is not None:
+            for r in table.to_pylist ():
+                records.setdefault (r['sample'], []).append (r)
+        for s in samples:
+            r = records.get (os.path.abspath (s['directory']))
+            s['mtime'] = int (max (x['write_time'] for x in r) * 1e9) if r is not None else None
     
-    # walk down the dirs, looking for config files and images
-    for dir in os.walk (base_dir):
-        files = dir[2]
-
-        # look for a config file
-        if files.count('config.txt') == 1:
+    # in incremental mode, keep the rows of the samples that have not changed
+    prior = None
+    if incremental and os.path.isfile (output_file):
+        prior = read_coallated (output_file)
+        table_mtime = os.stat (output_file).st_mtime_ns
+        known = set (prior['dir'])
+        current = set (s['directory'] for s in samples)
+        samples = [s for s in samples if s['directory'] not in known or
+                   s['mtime'] is None or s['mtime'] > table_mtime]
+        changed = set (s['directory'] for s in samples)
+        prior = prior[prior['dir'].isin (current) & ~prior['dir'].isin (changed)]
+        print ('updating ' + str (len (samples)) + ' samples in: ' + output_file)
+    
+    # read the samples in parallel
+    directories = [s['directory'] for s in samples]
+    rows = []
+    init_keys = None
+    with timer ('read_samples'), concurrent.futures.ThreadPoolExecutor (max_workers = jobs) as pool:
+        if store is None:
+            futures = [pool.submit (read_sample_rows, d) for d in directories]
+        else:
+            futures = [pool.submit (read_sample_rows, d, records.get (os.path.abspath (d), []))
+                       for d in directories]
+        for directory, future in zip (directories, futures):
             try:
-                # ok, lets go ahead and try to run the coallation
-                directory = dir[0]                            # get directory
-                os.chdir (directory)                          # get local
-                directory_base = os.path.basename (dir[0])    # get dir
-                oneup = dir[0].strip(os.path.basename(dir[0]))
-                oneup = oneup.strip ('\\')
-                oneup = oneup.strip ('/')
-                oneup_dir_base = os.path.basename (oneup)   # get directory name one up
-                
-                # get the summary data
-                try:
-                    with open ('config.txt', 'r') as f:
-                        config = yaml.load (f)
-                    with open ('stats.txt', 'r') as f:
-                        stats = yaml.load (f)
-                except:
-                    print('ERROR with directory: ' + directory)
-                
-                # get the gsd and percentiles
-                gsd = pd.read_csv ('gsd.txt')
-                perc = pd.read_csv ('percentiles.txt')
-                
-                # create the keys
-                keys = list (('dir_base', 'dir', 'dir_oneup_base'))
-                keys.extend (config.keys ())
-                keys.extend (stats.keys ())
-                keys.extend (list('p_' + perc['percentiles'].astype ('str')))
-                keys.extend (list('b_' + gsd['bins'].astype ('str')))
-                
-                # create the data list
-                dta = list ((directory_base, directory, oneup_dir_base))
-                dta.extend (config.values ())
-                dta.extend (stats.values ())
-                dta.extend (list(perc['vals']))
-                dta.extend (list(gsd['freqs']))
-                dta = pd.Series (data = dta, index = keys)
-                
-                # if this the first row, make the dataframe
-                if first_row:
-                    res = pd.DataFrame (columns = keys)
-                    init_keys = copy.copy (keys)            # copy the keys
-                    first_row = False                       # set the flag low
-                else:
-                    # check the keys 
-                    if not init_keys == keys:
-                        print ('WHOA! Error with the keys we found in: ' + directory)
-                        print (init_keys)
-                        print ('\n\n\n')
-                        print (keys)
-                        sys.exit ()
-                        
-                # append the data list
-                res = res.append (dta, ignore_index = True)
-                print ('completed: ' + directory)
-            except:
-                print ('error with: ' + directory)
-                
-    # save the file
-    res.to_csv (output_file, index = False)
-    return
+                sample_rows = future.result ()
+            except Exception as e:
+                print ('error with: ' + directory + ' (' + str (e) + ')')
+                continue
+            
+            # note samples with different keys, these get aligned in the table
+            for row in sample_rows:
+                keys = list (row.keys ())
+                if init_keys is None:
+                    init_keys = keys
+                elif keys != init_keys:
+                    print ('NOTE: different keys in: ' + directory + ', aligning columns')
             
+            rows.extend (sample_rows)
+            print ('completed: ' + directory)
+    
+    with timer ('build_table'):
+        res = build_table (rows)
+    if prior is not None:
+        res = pd.concat ([prior, res], ignore_index = True, sort = False)
+        res = res[order_columns (list (res.columns))]
+        res = res.sort_values ('dir', kind = 'stable').reset_index (drop = True)
+            
+    # save the file
+    with timer ('write_table'):
+        res.to_csv (output_file, index = False)
+        write_columnar (res, output_file, columnar)
+    return (res)
@@ -0,0 +1,231 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# config_resolver: layered config files. A config_defaults.txt file in any
+#                  directory above a sample (e.g. the campaign directory, then
+#                  a site directory) sets the defaults for every sample below
+#                  it; the nearer file wins, and the config.txt of the sample
+#                  only needs the values that differ. The files are parsed with
+#                  the C yaml loader (if pyyaml has it) and the parsed files are
+#                  kept until they change, so the analysis and the calibration
+#                  of a sample do not parse the same file twice. A bulk edit
+#                  (set_config) writes one defaults file.
+#                      campaign/config_defaults.txt     resolution, notes, ...
+#                      campaign/site_a/config_defaults.txt  calibration_file
+#                      campaign/site_a/image_0046/config.txt    minscale: 3.14
+
+import os
+import sys
+import tempfile
+import threading
+import yaml
+
+from sample_index import find_samples, defaults_file_name
+
+# the C yaml loader and dumper are much faster (pure python if not built with libyaml)
+yaml_loader = getattr (yaml, 'CSafeLoader', yaml.SafeLoader)
+yaml_dumper = getattr (yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# the parsed files, by file name: ((mtime, size), dict)
+_parsed = dict ()
+_parsed_lock = threading.Lock ()
+
+def parse_file (file_name):
+    '''
+    function to parse a yaml config file into a dict (empty for an empty file), kept
+    until the file changes. Raises OSError if the file cannot be read, and
+    yaml.YAMLError if it cannot be parsed.
+    file_name = the config file
+    '''
+    st = os.stat (file_name)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _parsed_lock:
+        cached = _parsed.get (file_name)
+    if cached is not None and cached[0] == stamp:
+        return (cached[1])
+
+    with open (file_name, 'r') as f:
+        config = yaml.load (f, Loader = yaml_loader)
+    if config is None:
+        config = dict ()
+    if not isinstance (config, dict):
+        raise yaml.YAMLError ('the config file is not a set of keys and values: ' + file_name)
+
+    with _parsed_lock:
+        _parsed[file_name] = (stamp, config)
+    return (config)
+
+def defaults_files (directory):
+    '''
+    function to find the defaults files that apply to a directory: the
+    config_defaults.txt files in it and the directories above it, from the top down
+    directory = the directory (e.g. a sample directory)
+    '''
+    res = []
+    directory = os.path.abspath (directory)
+    while True:
+        file_name = os.path.join (directory, defaults_file_name)
+        if os.path.isfile (file_name):
+            res.append (file_name)
+        parent = os.path.dirname (directory)
+        if parent == directory:
+            break
+        directory = parent
+    res.reverse ()
+    return (res)
+
+def inherited_config (directory):
+    '''
+    function to get the config a directory inherits from the defaults files above
+    it (and in it), without a config.txt
+    directory = the directory
+    '''
+    config = dict ()
+    for file_name in defaults_files (directory):
+        config.update (parse_file (file_name))
+    return (config)
+
+def resolve_config (config_file):
+    '''
+    function to get the config of a sample: the defaults files from the top down,
+    then the config file. Returns a new dict (the caller can change it). Raises
+    OSError if the config file cannot be read.
+    config_file = the config.txt file of the sample
+    '''
+    config = inherited_config (os.path.dirname (os.path.abspath (config_file)))
+    config.update (parse_file (config_file))
+    return (config)
+
+def write_file (file_name, config):
+    '''
+    function to write a config dict to a yaml file, atomically (written to a
+    temporary file and renamed into place)
+    file_name = the config file
+    config = the config dict
+    '''
+    text = yaml.dump (config, Dumper = yaml_dumper, default_flow_style = False)
+    fd, tmp_file = tempfile.mkstemp (dir = os.path.dirname (os.path.abspath (file_name)),
+                                     suffix = '.tmp')
+    try:
+        with os.fdopen (fd, 'w') as f:
+            f.write (text)
+        os.chmod (tmp_file, 0o644)
+        os.replace (tmp_file, file_name)
+    except BaseException:
+        os.unlink (tmp_file)
+        raise
+
+    # keep the parsed file, a rewrite within the mtime resolution is not missed
+    st = os.stat (file_name)
+    with _parsed_lock:
+        _parsed[file_name] = ((st.st_mtime_ns, st.st_size), dict (config))
+    return
+
+def write_config (config_file, config):
+    '''
+    function to write the config of a sample, only keeping the values that differ
+    from the ones it inherits
+    config_file = the config.txt file of the sample
+    config = the full config dict of the sample
+    '''
+    inherited = inherited_config (os.path.dirname (os.path.abspath (config_file)))
+    overrides = dict ((k, v) for k, v in config.items ()
+                      if k not in inherited or inherited[k] != v)
+    write_file (config_file, overrides)
+    return
+
+def config_files_below (base_dir):
+    '''
+    function to find the config.txt files of the samples in a tree, and the defaults
+    files between them and base_dir (not in base_dir)
+    base_dir = base directory of the tree
+    '''
+    base_dir = os.path.abspath (base_dir)
+    config_files = []
+    defaults = set ()
+    for sample in find_samples (base_dir):
+        config_files.append (os.path.join (sample['directory'], 'config.txt'))
+        directory = sample['directory']
+        while directory != base_dir and directory.startswith (os.path.join (base_dir, '')):
+            file_name = os.path.join (directory, defaults_file_name)
+            if os.path.isfile (file_name):
+                defaults.add (file_name)
+            directory = os.path.dirname (directory)
+    return (config_files, sorted (defaults))
+
+def set_config (base_dir, key, value, override = True):
+    '''
+    function to set a config key for every sample in a tree by writing it to the
+    defaults file of base_dir. Returns the number of files written.
+    base_dir = base directory of the tree
+    key = key to set
+    value = the value
+    override = also take the key out of the config and defaults files below base_dir
+               that set it (the files that do not set it are not touched), else
+               those keep their own value
+    '''
+    defaults_file = os.path.join (base_dir, defaults_file_name)
+    defaults = dict (parse_file (defaults_file)) if os.path.isfile (defaults_file) else dict ()
+    defaults[key] = value
+    write_file (defaults_file, defaults)
+    written = 1
+
+    if override:
+        config_files, lower_defaults = config_files_below (base_dir)
+        for file_name in lower_defaults + config_files:
+            config = parse_file (file_name)
+            if key in config:
+                config = dict (config)
+                del config[key]
+                write_file (file_name, config)
+                written = written + 1
+    return (written)
+
+def collapse_configs (base_dir):
+    '''
+    function to move the values shared by every sample in a tree into the defaults
+    file of base_dir, and take them out of the config.txt files, so a later change
+    to one of them is a single file edit. The resolved config of each sample does
+    not change. Returns the keys moved.
+    base_dir = base directory of the tree
+    '''
+    config_files, lower_defaults = config_files_below (base_dir)
+    if len (config_files) == 0:
+        return ([])
+    resolved = [resolve_config (f) for f in config_files]
+
+    # the keys with the same value in every sample
+    shared = dict (resolved[0])
+    for config in resolved[1:]:
+        for k in list (shared):
+            if k not in config or config[k] != shared[k]:
+                del shared[k]
+
+    defaults_file = os.path.join (base_dir, defaults_file_name)
+    defaults = dict (parse_file (defaults_file)) if os.path.isfile (defaults_file) else dict ()
+    defaults.update (shared)
+    write_file (defaults_file, defaults)
+
+    # the files below base_dir only keep the values that differ from what they inherit
+    for file_name in lower_defaults:
+        own = dict ((k, v) for k, v in parse_file (file_name).items () if k not in shared)
+        write_file (file_name, own)
+    for file_name, config in zip (config_files, resolved):
+        write_config (file_name, config)
+    return (sorted (shared))
@@ -20,28 +20,276 @@
 # deblur: this utility experiments with deblurring photoseived imagery
 #         to accentuate the edges of the grains, and help correct for
 #         the issues with camera lenses being inherently less awesome
-#         than the number of pixels in the imagery.
+#         than the number of pixels in the imagery. The highpass mean filter
+#         runs in the frequency domain: the image spectrum is computed once,
+#         and each radius is one multiply by its (cached) disk kernel spectrum
+#         and one inverse fft (opencv's real dft, with the packed spectra),
+#         so many radii and tints can be tried from a single forward fft.
+#         For the pipeline the image is worked on in strips of rows (with
+#         radius rows of overlap) in float32, so the working memory is bounded
+#         however large the image is, and the result can be written back
+#         over the image.
 
 import os
 import sys
+import threading
 import yaml
 import numpy as np
 import cv2
 
-class deblur:
-    def __init__ (self, filename):
+# the disk kernels and their spectra made so far, by radius (and padded image shape),
+# shared by the threads. The spectra are kept up to a size in bytes (the oldest go
+# first), the kernels up to a number.
+_kernel_cache = dict ()
+_spectrum_cache = dict ()
+_spectrum_cache_bytes = 0
+_kernel_cache_size = 64
+_cache_lock = threading.Lock ()
+
+# default working memory (bytes) for the strips of the highpass, and the bytes each
+# padded pixel of a strip needs (the float32 spectrum of each channel, the cached
+# kernel spectra of the strip shapes, the product, the inverse and the mean), of
+# which the cached kernel spectra of the two strip shapes take 8
+default_max_bytes = 256 * 1024**2
+strip_bytes_per_pixel = 24
+spectrum_bytes_per_pixel = 8
+
+# default size the kept kernel spectra can take (their share of the default budget)
+default_cache_bytes = default_max_bytes * spectrum_bytes_per_pixel // strip_bytes_per_pixel
+
+# default tint (0 is the highpass alone)
+default_tint = 0.0
+
+# the deblurred image written in each sample directory by deblur_batch
+deblur_image_name = 'deblur_image.jpg'
+
+def disk_kernel (radius):
+    '''
+    function to make the normalized circular mean kernel of a radius: an odd square
+    kernel of side int (2 x radius) (plus 1 if even), 0 outside the radius
+    radius = the circular radius in pixels
+    '''
+    with _cache_lock:
+        kernel = _kernel_cache.get (radius)
+    if kernel is None:
+        kernel_dim = int (radius * 2.0)
+        if kernel_dim % 2 == 0:
+            kernel_dim = kernel_dim + 1
+        center_dim = int (kernel_dim / 2)
+
+        offset = np.arange (kernel_dim, dtype = np.float64) - center_dim
+        kernel = ((offset[:, None]**2.0 + offset[None, :]**2.0) <= radius**2.0).astype (np.float64)
+        kernel = kernel / kernel.sum ()
+
+        with _cache_lock:
+            if len (_kernel_cache) >= _kernel_cache_size:
+                _kernel_cache.clear ()
+            _kernel_cache[radius] = kernel
+    return (kernel)
+
+def kernel_spectrum (radius, shape, cache_bytes = default_cache_bytes):
+    '''
+    function to get the spectrum (the packed real dft, see cv2.dft) of the disk kernel
+    of a radius, centred on the origin of an array of the padded image shape. The
+    spectrum is kept if it fits in cache_bytes, the oldest spectra make room for it.
+    radius = the circular radius in pixels
+    shape = (rows, columns) of the padded image
+    cache_bytes = size the kept spectra can take (bytes)
+    '''
+    global _spectrum_cache_bytes
+    key = (radius, shape)
+    with _cache_lock:
+        spectrum = _spectrum_cache.get (key)
+    if spectrum is None:
+        kernel = disk_kernel (radius)
+        c = kernel.shape[0] // 2
+        padded = np.zeros (shape, dtype = np.float32)
+        padded[:kernel.shape[0], :kernel.shape[1]] = kernel
+        padded = np.roll (padded, (-c, -c), axis = (0, 1))
+        spectrum = cv2.dft (padded)
+
+        with _cache_lock:
+            while _spectrum_cache and _spectrum_cache_bytes + spectrum.nbytes > cache_bytes:
+                old = _spectrum_cache.pop (next (iter (_spectrum_cache)))
+                _spectrum_cache_bytes = _spectrum_cache_bytes - old.nbytes
+            if key not in _spectrum_cache and spectrum.nbytes <= cache_bytes:
+                _spectrum_cache[key] = spectrum
+                _spectrum_cache_bytes = _spectrum_cache_bytes + spectrum.nbytes
+    return (spectrum)
+
+class highpass_engine:
+    def __init__ (self, frame, max_radius):
+        '''
+        constructor takes the image and computes the spectrum of each channel. The
+        image is padded by reflection (as cv2.filter2D does at the borders) by at least
+        max_radius, up to a fast fft size, so the circular convolution matches the
+        spatial one.
+        frame = the image (rows x columns, or rows x columns x channels)
+        max_radius = the largest radius that will be asked for
+        '''
+        self.frame = frame
+        pad = int (max_radius) + 1
+        rows = cv2.getOptimalDFTSize (frame.shape[0] + 2 * pad)
+        cols = cv2.getOptimalDFTSize (frame.shape[1] + 2 * pad)
+        self.pad = pad
+        self.shape = (rows, cols)
+        padded = cv2.copyMakeBorder (frame, pad, rows - frame.shape[0] - pad,
+                                     pad, cols - frame.shape[1] - pad, cv2.BORDER_REFLECT_101)
+        if padded.ndim == 2:
+            padded = padded[:, :, None]
+        self.spectra = [cv2.dft (padded[:, :, c].astype (np.float32))
+                        for c in range (padded.shape[2])]
+        return
+
+    def average (self, radius, cache_bytes = default_cache_bytes):
+        '''
+        method to get the circular mean of the image (float32, the shape of the image)
+        radius = the circular radius in pixels
+        cache_bytes = size the kept kernel spectra can take (see kernel_spectrum)
         '''
-        constructor takes the file and reads it into disk
-        filename = the filename of the file to deblur
+        k = kernel_spectrum (radius, self.shape, cache_bytes)
+        rows = slice (self.pad, self.pad + self.frame.shape[0])
+        cols = slice (self.pad, self.pad + self.frame.shape[1])
+        avg = np.empty (self.frame.shape, dtype = np.float32)
+        if avg.ndim == 2:
+            avg = avg[:, :, None]
+        for c, spectrum in enumerate (self.spectra):
+            product = cv2.mulSpectrums (spectrum, k, 0)
+            avg[:, :, c] = cv2.idft (product, flags = cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)[rows, cols]
+        return (avg.reshape (self.frame.shape))
+
+    def variants (self, radii, tints):
+        '''
+        method to make the tinted highpass images of every radius and tint from the
+        one image spectrum. Returns a dict of (radius, tint): image.
+        radii = list of circular radii in pixels
+        tints = list of tints
         '''
+        res = dict ()
+        for radius in radii:
+            avg = self.average (radius)
+            for n, tint in enumerate (tints):
+                mean = avg if n == len (tints) - 1 else avg.copy ()
+                res[(radius, tint)] = tint_highpass (self.frame, mean, tint)
+        return (res)
+
+def tint_highpass (frame, avg, tint, out = None):
+    '''
+    function to tint the highpass of an image (the image less its circular mean,
+    rounded) with the image: (1 - tint) x highpass + tint x image, saturated to 0
+    to 255. This is the image less (1 - tint) x the mean, worked out in place in
+    the float32 mean.
+    frame = the image (uint8)
+    avg = the circular mean of the image (float32, it is overwritten)
+    tint = from 0 (the highpass) to 1 (the image)
+    out = uint8 array to write the result to (optional, it can be frame)
+    '''
+    np.rint (avg, out = avg)
+    avg *= (tint - 1.0)
+    avg += frame
+    np.clip (avg, 0, 255, out = avg)
+    if out is None:
+        out = np.empty (frame.shape, dtype = np.uint8)
+    np.copyto (out, avg, casting = 'unsafe')
+    return (out)
+
+def lean_highpass (frame, radius, tint, max_bytes = default_max_bytes, out = None):
+    '''
+    function to make the tinted highpass of an image in strips of rows, so the
+    working memory stays within max_bytes. Each strip is transformed with radius
+    rows of the image above and below it, so the mean is the same as for the whole
+    image. A strip is written to out once the next strip has been read, so out can
+    be the image itself. Returns the highpass image.
+
+    frame = the image (uint8, greyscale or colour)
+    radius = the circular radius of the highpass mean filter
+    tint = from 0 (the highpass) to 1 (the image)
+    max_bytes = working memory for the strips (bytes)
+    out = uint8 array to write the result to (optional, it can be frame)
+    '''
+    if out is None:
+        out = np.empty_like (frame)
+    rows = frame.shape[0]
+    channels = 1 if frame.ndim == 2 else frame.shape[2]
+
+    # strip height from the memory budget, less the overlap and the padding, and the
+    # share of the budget the kept kernel spectra can take
+    pad = int (radius) + 1
+    width = cv2.getOptimalDFTSize (frame.shape[1] + 2 * pad)
+    strip = max (pad, int (max_bytes // (width * channels * strip_bytes_per_pixel)) - 4 * pad)
+    cache_bytes = max_bytes * spectrum_bytes_per_pixel // strip_bytes_per_pixel
+
+    pending = None
+    for start in range (0, rows, strip):
+        stop = min (rows, start + strip)
+        top = max (0, start - pad)
+        engine = highpass_engine (frame[top:min (rows, stop + pad)], radius)
+        avg = engine.average (radius, cache_bytes)[start - top:stop - top]
+        del engine
+
+        # the last strip can be written now this one has read its overlap
+        if pending is not None:
+            out[pending[0]:pending[1]] = pending[2]
+        pending = (start, stop, tint_highpass (frame[start:stop], avg, tint))
+        del avg
+
+    if pending is not None:
+        out[pending[0]:pending[1]] = pending[2]
+    return (out)
+
+def deblur_batch (image_files, radius, tint = default_tint, jobs = 4,
+                  max_bytes = default_max_bytes):
+    '''
+    function to deblur a batch of images on a thread pool (the dft and most of the
+    numpy work release the gil), each written as deblur_image.jpg in its directory.
+    The images are read as greyscale, and each thread works within max_bytes.
+    Returns the list of deblurred image names (None for the images that failed).
+
+    image_files = list of image file names
+    radius = the circular radius of the highpass mean filter
+    tint = from 0 (the highpass) to 1 (the image)
+    jobs = number of threads
+    max_bytes = working memory for the strips of each thread (bytes)
+    '''
+    import concurrent.futures
+
+    def run (image_file):
+        out_file = os.path.join (os.path.dirname (image_file), deblur_image_name)
         try:
-            self.frame = cv2.imread (filename)
-        except:
-            print ('ERROR reading file: ' + filename)
+            db = deblur (image_file, grey = True, max_bytes = max_bytes)
+            if db.frame is None:
+                return (None)
+            db.tinted_highpass (radius, tint, out_file, in_place = True)
+            print ('completed image: ' + image_file)
+            return (out_file)
+        except Exception as e:
+            print ('ERROR: cannot deblur: ' + image_file + ' (' + str (e) + ')')
+            return (None)
+
+    with concurrent.futures.ThreadPoolExecutor (max_workers = jobs) as pool:
+        out_files = list (pool.map (run, image_files))
+
+    return (out_files)
+
+class deblur:
+    def __init__ (self, filename, grey = False, max_bytes = default_max_bytes):
+        '''
+        constructor takes the file and reads it into memory
+        filename = the filename of the file to deblur (or the image, a numpy array)
+        grey = read the image as greyscale (a third of the memory of the colour image)
+        max_bytes = working memory for the strips of the highpass (bytes)
+        '''
+        self.max_bytes = max_bytes
+        if isinstance (filename, np.ndarray):
+            self.frame = filename
+        else:
+            self.frame = cv2.imread (filename, cv2.IMREAD_GRAYSCALE if grey else cv2.IMREAD_COLOR)
+            if self.frame is None:
+                print ('ERROR reading file: ' + filename)
             
         return
     
-    def tinted_highpass (self, radius, tint, output_file = None):
+    def tinted_highpass (self, radius, tint, output_file = None, in_place = False):
         '''
         method to perform a tinted highpass filter with a circular radius
         of a certain number of pixels. This is then tinted with the pre-existing
@@ -54,42 +302,36 @@ class deblur:
                ranges from 0 (no tint) to 1 (full tint)
         output_file = the output filename (optional, writes to disk if supplied, else
                returns the numpy array).
+        in_place = write the output over the image (no second image in memory)
         '''
-        # figure out the kernel dimensions, ensure it is odd
-        kernel_dim = int(radius * 2.0)
-        if kernel_dim % 2 == 0:
-            kernel_dim = kernel_dim + 1
-            
-        center_dim = int (kernel_dim / 2)
-        
-        # make the kernel, by setting the kernel to 0 outside the radius
-        kernel = np.ones ((kernel_dim, kernel_dim))
-        for i in range (0, kernel.shape[0]):
-            for j in range (0, kernel.shape[1]):
-                dist_to_center = np.sqrt ((i - center_dim)**2.0 + (j - center_dim)**2.0)
-                if dist_to_center > radius:
-                    kernel[i, j] = 0.0
-                    
-        # normalize
-        kernel = kernel / kernel.sum ()            
-        
-        # perform highpass
-        avg = cv2.filter2D (self.frame, -1, kernel)
-        highpass = self.frame - avg
-        
-        # tint
-        oput = np.array ((tint * highpass) + ((1.0 - tint) * self.frame), np.uint8)
+        # perform the highpass in the frequency domain in strips, and tint
+        oput = lean_highpass (self.frame, radius, tint, self.max_bytes,
+                              self.frame if in_place else None)
         
         # return the output or write to disk
         if output_file is None:
             return (oput)
         else:
-            try:
-                cv2.imwrite (oput, output_file)
-            except:
+            if not cv2.imwrite (output_file, oput):
                 print ('ERROR: cannot write output file: ' + output_file)
-        
-        
-
 
+    def highpass_variants (self, radii, tints, output_file = None):
+        '''
+        method to perform tinted highpass filters for several radii and tints at
+        once, from a single forward fft of the image (see tinted_highpass). Returns
+        a dict of (radius, tint): the output numpy array.
 
+        radii = list of circular radii of the highpass mean filter
+        tints = list of tints, from 0 (no tint) to 1 (full tint)
+        output_file = the output filename (optional), each variant is written with
+               the radius and tint added to the name, e.g. out_r20_t0.5.jpg
+        '''
+        engine = highpass_engine (self.frame, max (radii))
+        res = engine.variants (radii, tints)
+        if output_file is not None:
+            stem, ext = os.path.splitext (output_file)
+            for (radius, tint), oput in res.items ():
+                variant_file = stem + '_r%g_t%g' % (radius, tint) + ext
+                if not cv2.imwrite (variant_file, oput):
+                    print ('ERROR: cannot write output file: ' + variant_file)
+        return (res)
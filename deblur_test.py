@@ -19,14 +19,12 @@
 
 # deblur test: quick testing script for the deblur utility
 
+import sys
+
 from deblur import *
 
 # MAIN
 if __name__ == '__main__':
-    # read in test image
-    test_image = 'C://Users//tom//Dropbox//python//photoseive//image.jpg'
-    output_image = 'C://Users//tom//Dropbox//python//photoseive//tint_test.jpg'
-    
-    im = deblur (test_image)
-    im.tinted_highpass (radius = 20, tint = 0, output_file = output_image)
-    
+    # e.g. python deblur_test.py test_images/image.jpg tint_test.jpg --radius 20 --tint 0
+    from photoseive import main
+    sys.exit (main (['deblur'] + sys.argv[1:]))
@@ -0,0 +1,102 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# decode_planner: decode oversampled images at a reduced size. The scales are
+#                 grain sizes (in the units of the resolution, e.g. mm), so a
+#                 scale is scale / resolution pixels in the image; if the finest
+#                 scale analysed is several pixels, the image can be decoded at
+#                 1/2, 1/4 or 1/8 size with libjpeg's scaled decode (straight to
+#                 greyscale) and analysed with the resolution multiplied and
+#                 minscale (pixels) and density divided by the factor. The grain
+#                 size bins are the same, with 4, 16 or 64 times less pixel work.
+
+import os
+import sys
+import cv2
+import numpy as np
+
+# opencv decode flags for each reduction factor
+reduced_flags = {1: cv2.IMREAD_GRAYSCALE,
+                 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                 4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+# the finest scale (pixels) that is still resolved after a reduction
+min_resolved_pixels = 2.0
+
+def plan_decode_factor (config, scales, max_factor = 8, min_pixels = min_resolved_pixels):
+    '''
+    function to choose the largest safe reduction factor (1, 2, 4 or 8): the finest
+    scale that is analysed at full size (the smallest scale that is at least
+    minscale pixels, a scale is scale / resolution pixels) must still be at least
+    min_pixels pixels in the reduced image. The same scales are analysed in the
+    reduced image, as minscale is divided by the factor too (see reduced_config).
+
+    config = the config dict
+    scales = the scales for analysis (grain sizes in the units of the resolution, a
+             numpy array)
+    max_factor = largest factor to allow
+    min_pixels = smallest resolved scale (pixels) in the reduced image
+    '''
+    if scales is None:
+        return (1)
+
+    minscale = float (config.get ('minscale', 0) or 0)
+    pixels = np.asarray (scales, dtype = np.float64) / float (config['resolution'])
+    kept = pixels[pixels >= minscale]
+    if len (kept) == 0:
+        return (1)
+
+    factor = 1
+    for f in (2, 4, 8):
+        if f <= max_factor and kept.min () / f >= min_pixels:
+            factor = f
+    return (factor)
+
+def reduced_config (config, scales, factor):
+    '''
+    function to rescale the config for an image reduced by factor: the resolution
+    (size of a pixel) is multiplied, minscale (pixels) is divided, and the density
+    (rows between the analysed rows) is divided so the same rows of the scene are
+    analysed. The scales are grain sizes, so they are the same. Returns (config,
+    scales).
+
+    config = the config dict
+    scales = the scales for analysis (grain sizes, a numpy array)
+    factor = the reduction factor
+    '''
+    if factor == 1:
+        return (config, scales)
+
+    config = dict (config)
+    config['resolution'] = float (config['resolution']) * factor
+    config['minscale'] = float (config.get ('minscale', 0) or 0) / factor
+    config['density'] = max (1, int (round (float (config['density']) / factor)))
+    return (config, scales)
+
+def read_grey (image_file, factor = 1):
+    '''
+    function to decode an image to greyscale at 1/factor of its size (jpeg images
+    are decoded at the reduced size by libjpeg, others are decoded and resized).
+    Returns the image or None if it cannot be read.
+
+    image_file = the image file name
+    factor = the reduction factor (1, 2, 4 or 8)
+    '''
+    return (cv2.imread (image_file, reduced_flags[factor]))
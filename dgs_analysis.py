@@ -21,30 +21,67 @@
 
 import os
 import sys
-import DGS
+import tempfile
+import threading
 import yaml
 import datetime
 import cv2
 import numpy as np
 import pandas as pd
 
+from instrumentation import timer
+from decode_planner import plan_decode_factor, reduced_config, read_grey
+from wavelet_engine import wavelet_gsd, summarise_gsd, default_percentiles
+from deblur import lean_highpass, default_tint
+from config_resolver import resolve_config, write_config
+from sample_cache import roi_file_name
+
+# DGS is only needed for the default engine (engine: native in the config file
+# uses the built in wavelet engine)
+try:
+    import DGS
+except ImportError:
+    DGS = None
+
 class dgs_analysis:
-    def __init__ (self, image_file, scales):
+    def __init__ (self, image_file, scales, store = None, reduce = False, roi = None):
         '''
         constructor takes the file name of the image to evaluate
         image_file = the input image name
         scales = input scales for analysis (a numpy array)
+        store = where to put the results in place of the stats.txt, gsd.txt and
+                percentiles.txt files (optional): anything with an append method
+                that takes the record dict, e.g. a result_store or a list
+        reduce = decode the image at a reduced size if the scales allow it (see
+                 decode_planner), the factor is written to the stats as decode_factor
+        roi = name of the region of interest of the image this analyses (optional):
+              the results go to stats_<roi>.txt, gsd_<roi>.txt and
+              percentiles_<roi>.txt, and the name is written to the stats as roi
         '''
         self.image_file = image_file
         self.scales = scales
+        self.store = store
+        self.roi = roi
         file_dir = os.path.dirname (image_file)
         self.config_file = os.path.join (file_dir, 'config.txt')
-        self.stats_file = os.path.join (file_dir, 'stats.txt')
-        self.percentiles_file = os.path.join (file_dir, 'percentiles.txt')
-        self.gsd_file = os.path.join (file_dir, 'gsd.txt')
+        self.stats_file = os.path.join (file_dir, roi_file_name ('stats.txt', roi))
+        self.percentiles_file = os.path.join (file_dir, roi_file_name ('percentiles.txt', roi))
+        self.gsd_file = os.path.join (file_dir, roi_file_name ('gsd.txt', roi))
+        self.image = None                   # in-memory greyscale image (optional)
+        self.extra_stats = dict ()          # extra run details written with the stats
+        if roi is not None:
+            self.extra_stats['roi'] = roi
+        self.reduce = reduce
+        self.decode_factor = 1              # planned reduction factor of the decode
+        self.image_factor = 1               # reduction factor of the image being analysed
         
         # read the config file
-        self.read_config ()
+        with timer ('read_config'):
+            self.read_config ()
+        
+        # plan the reduced decode
+        if reduce and not self.config_file_error:
+            self.decode_factor = plan_decode_factor (self.config, scales)
         
         return
     
@@ -55,29 +92,59 @@ class dgs_analysis:
         
         # run the analysis if we successfully read the file
         if not self.config_file_error:
-            self.dgs_stats = DGS.dgs (self.image_file, self.config ['density'], self.config ['resolution'],
-                                      self.config ['dofilter'], self.config ['maxscale'], self.config ['notes'],
-                                      self.config ['verbose'], minscale = self.config ['minscale'], scales = self.scales)
-            
-            # write the stats files
-            self.write_stats ()
-            self.write_gsd ()
+            self.analyse ()
+            self.write_results ()
         
-        print ('completed: ' + self.image_file)
+        print ('completed: ' + self.image_file + (' (roi ' + self.roi + ')' if self.roi else ''))
         print ('---------------------------------------------------------------')
         return
     
+    def analyse (self):
+        '''
+        method to run the grainsize analysis without writing the results (the
+        results are kept in self.dgs_stats for write_results)
+        '''
+        # the config and scales for the size of the image being analysed
+        config, scales = reduced_config (self.config, self.scales, self.image_factor)
+        if self.reduce:
+            self.extra_stats['decode_factor'] = self.image_factor
+        
+        with timer ('dgs'):
+            if self.image is None and use_native (config):
+                self.dgs_stats = wavelet_gsd (read_grey (self.image_file), config, scales)
+            elif self.image is None:
+                check_dgs ()
+                self.dgs_stats = DGS.dgs (self.image_file, config ['density'], config ['resolution'],
+                                          config ['dofilter'], config ['maxscale'], config ['notes'],
+                                          config ['verbose'], minscale = config ['minscale'], scales = scales)
+            else:
+                self.dgs_stats = dgs_array (self.image, config, scales)
+        return
+    
+    def write_results (self):
+        '''
+        method to write the stats files, or hand the results to the store
+        '''
+        if self.store is None:
+            with timer ('write_stats'):
+                self.write_stats ()
+            with timer ('write_gsd'):
+                self.write_gsd ()
+        else:
+            with timer ('store'):
+                self.store.append (self.make_record ())
+        return
+    
     def read_config (self):
         '''
         method to read the config file to figure out the stats
         the config file is a simple yaml file that gets interpreted into
-        a python dict
+        a python dict, on top of the defaults files above it (see config_resolver)
         '''
         self.config_file_error = False
         
         try:
-            with open (self.config_file, 'r') as f:
-                self.config = yaml.load (f)
+            self.config = resolve_config (self.config_file)
             
         except:
             self.config_file_error = True
@@ -87,11 +154,11 @@ class dgs_analysis:
     
     def write_config (self):
         '''
-        method to write the config file
+        method to write the config file (only the values that differ from the
+        defaults files above it)
         '''
         try:
-            with open (self.config_file, 'w') as f:
-                yaml.dump (self.config, f, default_flow_style = False)
+            write_config (self.config_file, self.config)
         except:
             print ('Cannot write config file: ' + self.config_file)
             
@@ -101,16 +168,27 @@ class dgs_analysis:
         '''
         method to write the stats as a yaml file
         '''
+        self.make_stats ()
+        
+        def write (file_name):
+            with open (file_name, 'w') as f:
+                yaml.dump (self.stats, f, default_flow_style = False)
+        replace_file (self.stats_file, write)
+            
+        return
+    
+    def make_stats (self):
+        '''
+        method to make the stats dict from the dgs results
+        '''
         self.stats = dict()
         self.stats['skewness'] = float (self.dgs_stats['grain size skewness'])
         self.stats['mean'] = float (self.dgs_stats['mean grain size'])
         self.stats['sorting'] = float (self.dgs_stats['grain size sorting'])
         self.stats['kurtosis'] = float (self.dgs_stats['grain size kurtosis'])
         self.stats['time'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        with open (self.stats_file, 'w') as f:
-            yaml.dump (self.stats, f, default_flow_style = False)
-            
+        self.stats.update (self.dgs_stats.get ('stats', dict ()))
+        self.stats.update (self.extra_stats)
         return
     
     def write_gsd (self):
@@ -127,17 +205,50 @@ class dgs_analysis:
                                                    columns = ('bins', 'freqs'))
                                                     
         # write the csv files to disk
-        self.percentiles.to_csv (self.percentiles_file, index = False)                                            
-        self.gsd.to_csv (self.gsd_file, index = False)
+        replace_file (self.percentiles_file, lambda f: self.percentiles.to_csv (f, index = False))
+        replace_file (self.gsd_file, lambda f: self.gsd.to_csv (f, index = False))
                                                     
         return
     
-    def run_CLAHE (self):
+    def make_record (self):
+        '''
+        method to make the result record of the sample for a result store: the
+        sample directory, the stats, and the percentiles and gsd as arrays
+        '''
+        self.make_stats ()
+        record = dict (sample = os.path.dirname (os.path.abspath (self.image_file)))
+        record.update (self.stats)
+        record['percentiles'] = np.asarray (self.dgs_stats['percentiles'], dtype = np.float64)
+        record['percentile_values'] = np.asarray (self.dgs_stats['percentile_values'], dtype = np.float64)
+        record['bins'] = np.asarray (self.dgs_stats['grain size bins'], dtype = np.float64)
+        record['freqs'] = np.asarray (self.dgs_stats['grain size frequencies'], dtype = np.float64)
+        return (record)
+    
+    def load_image (self, image, factor = 1):
+        '''
+        method to hand over an image that is already in memory, so the CLAHE and
+        the grainsize analysis work on the array rather than decoding the image file
+        image = the image (a numpy array, colour images are converted to greyscale)
+        factor = the reduction factor the image was decoded at
+        '''
+        if image.ndim == 3:
+            image = cv2.cvtColor (image, cv2.COLOR_BGR2GRAY)
+        self.image = image
+        self.image_factor = factor
+        return
+    
+    def run_CLAHE (self, write_image = True):
         '''
         method to create a copy of the image with contrast limited adaptive histogram
         equalization applied with the specified image. This creates a copy that is
         stored locally, and the self.image_file variable is updated so the dgs
         analysis gets run on the updated image.
+        
+        If an image was handed over with load_image, the CLAHE is applied to that
+        array and the result is kept in memory for the analysis.
+        
+        write_image = write the clahe image to disk (always written if there is no
+                      in-memory image)
         '''
         
         # construct a new name
@@ -145,21 +256,165 @@ class dgs_analysis:
         clahe_out_file = os.path.join (file_dir, 'clahe_image.jpg')
         
         # convert to greyscale
-        bgr_raw = cv2.imread (self.image_file)
-        gry_raw = cv2.cvtColor (bgr_raw, cv2.COLOR_BGR2GRAY)
+        if self.image is None:
+            with timer ('decode'):
+                if self.decode_factor > 1:
+                    gry_raw = read_grey (self.image_file, self.decode_factor)
+                else:
+                    bgr_raw = cv2.imread (self.image_file)
+                    gry_raw = cv2.cvtColor (bgr_raw, cv2.COLOR_BGR2GRAY)
+            self.image_factor = self.decode_factor
+            write_image = True
+        else:
+            gry_raw = self.image
+
+        # deblur before the clahe (optional)
+        if self.config.get ('deblur_radius') is not None:
+            gry_raw = self.run_deblur (gry_raw, self.image_factor)
         
-        # create the clahe object
+        # get the clahe object
         clahe_dims = (int (self.config['clahe_dims']), int (self.config['clahe_dims']))
-        clahe = cv2.createCLAHE (clipLimit = 2.0, tileGridSize = clahe_dims)
+        clahe = clahe_object (clahe_dims)
         
         # apply the clahe analysis
-        clahe_out = clahe.apply (gry_raw)
+        with timer ('clahe'):
+            clahe_out = clahe.apply (gry_raw)
+
+        # keep the result in memory if we are working in memory
+        if self.image is not None:
+            self.image = clahe_out
 
         # write to disk and change image name
-        cv2.imwrite (clahe_out_file, clahe_out)
-        self.image_file = clahe_out_file
+        if write_image:
+            with timer ('write_clahe'):
+                cv2.imwrite (clahe_out_file, clahe_out)
+            self.image_file = clahe_out_file
         
         return
+
+    def run_deblur (self, image, factor = 1):
+        '''
+        method to apply the tinted highpass filter (see deblur) to the greyscale image
+        before the clahe, if the config file has a deblur_radius (in pixels of the
+        full size image) and optionally a deblur_tint (0 is the highpass alone). The
+        filter works in strips with bounded memory, and writes over the image.
+        image = the greyscale image (uint8)
+        factor = the reduction factor the image was decoded at
+        '''
+        radius = float (self.config['deblur_radius']) / factor
+        tint = float (self.config.get ('deblur_tint', default_tint))
+        with timer ('deblur'):
+            return (lean_highpass (image, radius, tint, out = image))
+
+# clahe objects made so far in each thread (they are not safe to share between threads)
+_clahe_objects = threading.local ()
+
+def clahe_object (tile_grid, clip_limit = 2.0):
+    '''
+    function to get a clahe object for a tile grid, kept for reuse by the thread
+    (a long running process, e.g. the worker_server, keeps them warm)
     
+    tile_grid = the tile grid size (columns, rows)
+    clip_limit = the clahe clip limit
+    '''
+    objects = getattr (_clahe_objects, 'objects', None)
+    if objects is None:
+        objects = _clahe_objects.objects = dict ()
+    key = (int (tile_grid[0]), int (tile_grid[1]), float (clip_limit))
+    if key not in objects:
+        objects[key] = cv2.createCLAHE (clipLimit = clip_limit, tileGridSize = key[:2])
+    return (objects[key])
+
+def replace_file (file_name, write, mode = 0o644):
+    '''
+    function to write a file atomically: the file is written under a temporary name
+    in the same directory and renamed over the file, so a reader (e.g. coallation)
+    sees the old file or the whole new file, never a half written one
     
+    file_name = the file to write
+    write = function that writes the file given its (temporary) name
+    mode = permissions of the file
+    '''
+    file_dir = os.path.dirname (os.path.abspath (file_name))
+    fd, tmp_file = tempfile.mkstemp (dir = file_dir, prefix = '.' + os.path.basename (file_name),
+                                     suffix = '.tmp')
+    os.close (fd)
+    try:
+        write (tmp_file)
+        os.chmod (tmp_file, mode)
+        os.replace (tmp_file, file_name)
+    except BaseException:
+        if os.path.exists (tmp_file):
+            os.unlink (tmp_file)
+        raise
+    return
+
+def use_native (config):
+    '''
+    function to check if the config selects the built in wavelet engine
+    (engine: native) rather than DGS (engine: dgs, the default)
+    config = the config dict
+    '''
+    return (str (config.get ('engine', 'dgs')).lower () == 'native')
+
+def check_dgs ():
+    '''
+    function to stop with a clear error if DGS is needed but not installed
+    '''
+    if DGS is None:
+        raise ImportError ('DGS is not installed, install it or set engine: native in the config file')
+    return
+
+def dgs_takes_arrays (config):
+    '''
+    function to check whether DGS.dgs is given the image as a numpy array: only with
+    dgs_arrays: 'yes' in the config (for a DGS that takes arrays, the released pyDGS
+    reads the image from a file). Otherwise the image in memory is written to a
+    lossless png and DGS decodes it again, so the handover costs a png encode and
+    decode but does not change the results.
+    config = the config dict
+    '''
+    return (str (config.get ('dgs_arrays', 'no')).lower () in ('yes', 'true', '1'))
+
+def dgs_array (image, config, scales, handover_file = None):
+    '''
+    function to run the DGS analysis on a greyscale image that is already in memory.
+    Unless the config says DGS.dgs takes the array directly (see dgs_takes_arrays),
+    the image is written to a lossless png that DGS decodes again, so the results
+    are not changed by jpeg re-encoding. With engine: native in the config the built in wavelet engine works
+    on the array directly.
     
+    image = the greyscale image (a numpy array)
+    config = the config dict
+    scales = scales for analysis (a numpy array)
+    handover_file = png file to hand the image over in (optional): it is written if it
+                    is not there yet and kept, so several analyses of the same image
+                    (e.g. a parameter sweep) only write it once
+    '''
+    if use_native (config):
+        return (wavelet_gsd (image, config, scales))
+    check_dgs ()
+    
+    args = (config ['density'], config ['resolution'], config ['dofilter'],
+            config ['maxscale'], config ['notes'], config ['verbose'])
+    kwargs = dict (minscale = config ['minscale'], scales = scales)
+    
+    if dgs_takes_arrays (config):
+        return (DGS.dgs (image, *args, **kwargs))
+    
+    # hand over through the given lossless file
+    if handover_file is not None:
+        if not os.path.isfile (handover_file):
+            cv2.imwrite (handover_file, image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        return (DGS.dgs (handover_file, *args, **kwargs))
+    
+    # hand over through a temporary lossless file
+    fd, tmp_file = tempfile.mkstemp (suffix = '.png')
+    os.close (fd)
+    try:
+        cv2.imwrite (tmp_file, image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        dgs_stats = DGS.dgs (tmp_file, *args, **kwargs)
+    finally:
+        os.unlink (tmp_file)
+        
+    return (dgs_stats)
@@ -21,21 +21,217 @@
 
 import os
 import sys
+import ast
+import hashlib
+import tempfile
+import threading
+import concurrent.futures
 import cv2
 import yaml
 import numpy as np
 
+from instrumentation import timer, sample_timer
+from config_resolver import resolve_config
+
+# default directory for the undistortion maps kept on disk
+default_map_dir = os.path.join (os.path.expanduser ('~'), '.photoseive', 'undistort_maps')
+
+def read_calibration_file (calibration_file):
+    '''
+    function to read the camera matrix K and distortion coefficients d from a
+    calibration file from the U of C distortion calibration toolbox. The files are
+    python, but rather than executing them this only evaluates simple assignments
+    of literals and numpy arrays of literals (e.g. K = np.array ([[...]])), other
+    statements are ignored.
+
+    calibration_file = the calibration file name
+
+    This returns (K, d) as float64 numpy arrays
+    '''
+    with open (calibration_file, 'r') as f:
+        tree = ast.parse (f.read (), calibration_file)
+
+    values = dict ()
+    for node in tree.body:
+        if not (isinstance (node, ast.Assign) and len (node.targets) == 1 and
+                isinstance (node.targets[0], ast.Name)):
+            continue
+
+        value = node.value
+        # np.array (...), numpy.array (...), array (...) or matrix (...)
+        if isinstance (value, ast.Call):
+            func = value.func
+            func_name = func.attr if isinstance (func, ast.Attribute) else getattr (func, 'id', None)
+            if func_name not in ('array', 'asarray', 'matrix') or len (value.args) != 1:
+                continue
+            value = value.args[0]
+
+        try:
+            values[node.targets[0].id] = ast.literal_eval (value)
+        except ValueError:
+            continue
+
+    if 'K' not in values or 'd' not in values:
+        raise ValueError ('no K and d in calibration file: ' + calibration_file)
+
+    K = np.array (values['K'], dtype = np.float64).reshape ((3, 3))
+    d = np.array (values['d'], dtype = np.float64).ravel ()
+    return (K, d)
+
+class calibration_registry:
+    def __init__ (self, map_dir = default_map_dir, max_maps = 4):
+        '''
+        constructor for the registry of calibrations and undistortion maps. Each
+        calibration file is read once, and the undistortion maps are built once per
+        (calibration, image size) and kept in memory and on disk.
+
+        map_dir = directory to keep the maps on disk in (None keeps them in memory only)
+        max_maps = number of map pairs kept in memory (they are ~6 bytes per pixel)
+        '''
+        self.map_dir = map_dir
+        self.max_maps = max_maps
+        self.calibrations = dict ()
+        self.maps = dict ()
+        self.map_order = []
+        self.lock = threading.Lock ()
+        return
+
+    def get_calibration (self, calibration_file):
+        '''
+        method to get (K, d, hash) for a calibration file, read once and then
+        remembered (reread if the file changes)
+        calibration_file = the calibration file name
+        '''
+        calibration_file = os.path.abspath (calibration_file)
+        mtime = os.path.getmtime (calibration_file)
+        cal = self.calibrations.get (calibration_file)
+        if cal is None or cal[0] != mtime:
+            K, d = read_calibration_file (calibration_file)
+            cal_hash = hashlib.sha256 (K.tobytes () + d.tobytes ()).hexdigest ()[:16]
+            cal = (mtime, K, d, cal_hash)
+            self.calibrations[calibration_file] = cal
+        return (cal[1:])
+
+    def calibration_hash (self, calibration_file):
+        '''
+        method to get the hash of the K and d of a calibration file (reread if the
+        file changes), for keys of images unwarped with it
+        calibration_file = the calibration file name
+        '''
+        with self.lock:
+            return (self.get_calibration (calibration_file)[2])
+
+    def get_maps (self, calibration_file, size, scale = 1, roi = None):
+        '''
+        method to get the undistortion maps for a calibration and image size, from
+        memory, then from disk, else build them with initUndistortRectifyMap
+        calibration_file = the calibration file name
+        size = (width, height) of the image
+        scale = reduction factor of the image relative to the calibrated camera
+                images (e.g. 4 for a 1/4 size decode), the camera matrix is scaled
+        roi = (x, y, width, height) region of the unwarped image to get the maps for
+              (optional): the maps of the region are a view of the maps of the whole
+              image (so only those are kept), and remap with them gives the region
+              of the whole unwarped image
+        '''
+        if roi is not None:
+            x, y, w, h = [int (v) for v in roi]
+            map1, map2 = self.get_maps (calibration_file, size, scale)
+            return (map1[y:y + h, x:x + w], map2[y:y + h, x:x + w])
+
+        with self.lock:
+            K, d, cal_hash = self.get_calibration (calibration_file)
+            key = cal_hash + '_' + str (size[0]) + 'x' + str (size[1])
+            if scale != 1:
+                K = K.copy ()
+                K[:2] = K[:2] / scale
+                key = key + '_r' + str (scale)
+
+            if key in self.maps:
+                self.map_order.remove (key)
+                self.map_order.append (key)
+                return (self.maps[key])
+
+        # read or build without the lock (other threads keep getting their maps),
+        # two threads may both build the same maps, the first kept is used
+        maps = self.load_maps (K, d, size, key)
+
+        with self.lock:
+            if key in self.maps:
+                self.map_order.remove (key)
+                self.map_order.append (key)
+                return (self.maps[key])
+
+            # keep in memory, dropping the least recently used
+            self.maps[key] = maps
+            self.map_order.append (key)
+            while len (self.map_order) > self.max_maps:
+                del self.maps[self.map_order.pop (0)]
+
+            return (maps)
+
+    def load_maps (self, K, d, size, key):
+        '''
+        method to read the undistortion maps from disk, else build them with
+        initUndistortRectifyMap and write them to disk for the next run
+        K, d = the camera matrix (scaled) and distortion coefficients
+        size = (width, height) of the image
+        key = the name of the maps (calibration hash, size and scale)
+        '''
+        map_file = None
+        if self.map_dir is not None:
+            map_file = os.path.join (self.map_dir, key + '.npz')
+            try:
+                with np.load (map_file) as m:
+                    return ((m['map1'], m['map2']))
+            except (IOError, OSError, KeyError, ValueError):
+                pass
+
+        newcamera, roi = cv2.getOptimalNewCameraMatrix (K, d, size, 0)
+        maps = cv2.initUndistortRectifyMap (K, d, None, newcamera, size, cv2.CV_16SC2)
+
+        # keep on disk for the next run (written atomically)
+        if map_file is not None:
+            try:
+                if not os.path.isdir (self.map_dir):
+                    os.makedirs (self.map_dir, exist_ok = True)
+                fd, tmp_file = tempfile.mkstemp (dir = self.map_dir, suffix = '.tmp')
+                with os.fdopen (fd, 'wb') as f:
+                    np.savez (f, map1 = maps[0], map2 = maps[1])
+                os.replace (tmp_file, map_file)
+            except (IOError, OSError):
+                print ('WARNING: cannot write the undistortion maps to: ' + self.map_dir)
+        return (maps)
+
+    def undistort (self, img, calibration_file, scale = 1, roi = None):
+        '''
+        method to unwarp an image with the cached maps for its calibration and size
+        img = the image (a numpy array, colour or greyscale)
+        calibration_file = the calibration file name
+        scale = reduction factor of the image (see get_maps)
+        roi = (x, y, width, height) region of the unwarped image to make (optional),
+              only the pixels of the region are unwarped
+        '''
+        h, w = img.shape[:2]
+        map1, map2 = self.get_maps (calibration_file, (w, h), scale, roi)
+        return (cv2.remap (img, map1, map2, cv2.INTER_LINEAR))
+
+# the registry shared in this process
+registry = calibration_registry ()
+
 class distortion_calibration:
-    def __init__ (self, image_file):
+    def __init__ (self, image_file, cache = None):
         '''
         constructor takes the file name of the image to evaluate
         image_file = the input image name
+        cache = a sample_cache to get and keep the calibrated image in (optional)
         '''
         
         self.image_file = image_file
+        self.cache = cache
         file_dir = os.path.dirname (image_file)
         self.config_file = os.path.join (file_dir, 'config.txt')
-        self.out_image_file = image_file.strip('.JPG') + '_c.JPG'
+        self.out_image_file = os.path.splitext (image_file)[0] + '_c.JPG'
         
         # read the config file
         self.read_config ()
@@ -46,13 +242,12 @@ class distortion_calibration:
         '''
         method to read the config file to figure out the stats
         the config file is a simple yaml file that gets interpreted into
-        a python dict
+        a python dict, on top of the defaults files above it (see config_resolver)
         '''
         self.config_file_error = False
         
         try:
-            with open (self.config_file, 'r') as f:
-                self.config = yaml.load (f)
+            self.config = resolve_config (self.config_file)
             
         except:
             self.config_file_error = True
@@ -63,38 +258,94 @@ class distortion_calibration:
     def run (self):
         '''
         method to unwarp the image. This uses a calibration file which comes out of
-        the U of C distortion calibration toolbox. Note that the calibration files
-        are simply executed carte blanche (not a secure way to go about this . . but
-        fine for this as backwards compatibility here is likely more valuable than
-        security).
+        the U of C distortion calibration toolbox. The calibration files are read
+        with read_calibration_file (the K and d assignments are evaluated, the files
+        are not executed), and the undistortion maps come from the shared registry.
         
-        This returns the image name for posterity
+        This returns the calibrated image name, or None if the image cannot be
+        calibrated
         '''
-        
-        # run the unwarping
-        if not self.config_file_error:
-            
-            # run the calibration file
-            try:
-                execfile (str(self.config ['calibration_file']), globals())
-            except:
-                print ('ERROR: cannot read the calibration file: ' + self.config ['calibration_file'])
-            
-            # read in the image
+        if self.config_file_error:
+            return None
+
+        # copy over the cached calibrated image if we have it, the key has the hash
+        # of the calibration (so an edited calibration file unwarps again)
+        if self.cache is not None:
+            calibration_file = str (self.config ['calibration_file'])
             try:
-                img = cv2.imread (self.image_file)
-            except:
-                print ('ERROR: cannot read the image file: ' + self.image_file)
-                
-            # unwarp the image
-            h, w = img.shape[:2]
-            newcamera, roi = cv2.getOptimalNewCameraMatrix (K, d, (w,h), 0) 
-            newimg = cv2.undistort (img, K, d, None, newcamera)
-    
-            # write the image
-            cv2.imwrite (self.out_image_file, newimg)  
-            
+                cal_hash = registry.calibration_hash (calibration_file)
+            except (IOError, OSError, ValueError, SyntaxError):
+                print ('ERROR: cannot read the calibration file: ' + calibration_file)
+                raise
+            cal_key = self.cache.stage_key (self.image_file, 'calibrated', cal_hash)
+            if self.cache.get_file (cal_key, 'calibrated.jpg', self.out_image_file) is not None:
+                return (self.out_image_file)
+
+        # read in the image
+        with timer ('decode'):
+            img = cv2.imread (self.image_file)
+        if img is None:
+            print ('ERROR: cannot read the image file: ' + self.image_file)
+            return None
+
+        # unwarp the image
+        newimg = self.undistort (img)
+
+        # write the image
+        with timer ('write_calibrated'):
+            cv2.imwrite (self.out_image_file, newimg)
+        if self.cache is not None:
+            self.cache.put_file (cal_key, 'calibrated.jpg', self.out_image_file)
+
         return (self.out_image_file)
-            
-            
-            
\ No newline at end of file
+
+    def undistort (self, img, scale = 1, roi = None):
+        '''
+        method to unwarp an image that is already in memory with the calibration
+        file named in the config file. This works on colour or greyscale images.
+
+        img = the image (a numpy array)
+        scale = reduction factor of the image, if it was decoded at a reduced size
+        roi = (x, y, width, height) region of the unwarped image (in pixels of img) to
+              return in place of the whole image (optional)
+
+        This returns the unwarped image
+        '''
+
+        try:
+            with timer ('undistort'):
+                newimg = registry.undistort (img, str (self.config ['calibration_file']), scale, roi)
+        except (IOError, OSError, ValueError, SyntaxError):
+            print ('ERROR: cannot read the calibration file: ' + str (self.config ['calibration_file']))
+            raise
+
+        return (newimg)
+
+def undistort_batch (image_files, jobs = 4, cache = None):
+    '''
+    function to unwarp a batch of images on a thread pool (opencv releases the
+    gil for the decode, remap and encode). Images from the same camera share
+    the cached undistortion maps. Returns the list of calibrated image names
+    (None for the images that failed).
+
+    image_files = list of image file names
+    jobs = number of threads
+    cache = a sample_cache to get and keep the calibrated images in (optional)
+    '''
+    def calibrate (image_file):
+        try:
+            with sample_timer (image_file):
+                dst = distortion_calibration (image_file, cache)
+                out_file = dst.run ()
+            if out_file is None:
+                return None
+            print ('completed image: ' + image_file)
+            return (out_file)
+        except Exception as e:
+            print ('ERROR: cannot calibrate: ' + image_file + ' (' + str (e) + ')')
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor (max_workers = jobs) as pool:
+        out_files = list (pool.map (calibrate, image_files))
+
+    return (out_files)
@@ -0,0 +1,341 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# instrumentation: timers around the processing stages, written as json lines
+#                  events (one per stage and one per sample) to an events file,
+#                  with optional cProfile and tracemalloc hooks, and a summary of
+#                  a run made from the events. The settings are passed to worker
+#                  processes in environment variables, as the thread limits are,
+#                  and each process appends its own events to the file. When no
+#                  events file is set the timers do nothing.
+
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import threading
+
+# environment variables that carry the settings to the worker processes
+events_env = 'PHOTOSEIVE_EVENTS'
+profile_env = 'PHOTOSEIVE_PROFILE_DIR'
+trace_memory_env = 'PHOTOSEIVE_TRACE_MEMORY'
+run_env = 'PHOTOSEIVE_RUN_ID'
+
+# the sample being worked on in each thread, stage events are tagged with it
+_current = threading.local ()
+_write_lock = threading.Lock ()
+
+def configure (events_file = None, profile_dir = None, trace_memory = False, run_id = None):
+    '''
+    function to turn the instrumentation on (or off with no events file) for this
+    process and the worker processes started after this call. Returns the run id.
+
+    events_file = json lines file to append the events to (None turns it off)
+    profile_dir = directory to write a cProfile .prof file per sample to (optional)
+    trace_memory = record the peak python memory of each sample with tracemalloc
+    run_id = id of the run the events are tagged with (made from the time if not given)
+    '''
+    if events_file is None:
+        for var in (events_env, profile_env, trace_memory_env, run_env):
+            os.environ.pop (var, None)
+        return None
+
+    if run_id is None:
+        run_id = time.strftime ('%Y%m%d%H%M%S') + '-' + uuid.uuid4 ().hex[:8]
+    os.environ[events_env] = os.path.abspath (events_file)
+    os.environ[run_env] = run_id
+    if profile_dir is not None:
+        if not os.path.isdir (profile_dir):
+            os.makedirs (profile_dir)
+        os.environ[profile_env] = os.path.abspath (profile_dir)
+    else:
+        os.environ.pop (profile_env, None)
+    if trace_memory:
+        os.environ[trace_memory_env] = '1'
+    else:
+        os.environ.pop (trace_memory_env, None)
+    return (run_id)
+
+def enabled ():
+    '''
+    function to check if the events are being recorded
+    '''
+    return (events_env in os.environ)
+
+def emit (event, **fields):
+    '''
+    function to append an event to the events file (does nothing if the
+    instrumentation is off). Each event is one json line with the time, run id,
+    host and process id.
+
+    event = the event type (e.g. 'stage', 'sample', 'run_start')
+    fields = the event fields
+    '''
+    events_file = os.environ.get (events_env)
+    if events_file is None:
+        return
+
+    record = dict (event = event, time = time.time (), run = os.environ.get (run_env),
+                   host = socket.gethostname (), pid = os.getpid ())
+    record.update (fields)
+    line = (json.dumps (record, default = str) + '\n').encode ('utf-8')
+
+    # one write per line in append mode, so lines from several processes do not mix
+    with _write_lock:
+        fd = os.open (events_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write (fd, line)
+        finally:
+            os.close (fd)
+    return
+
+class timer:
+    def __init__ (self, stage, sample = None):
+        '''
+        context manager to time a stage and emit a 'stage' event, e.g.
+            with timer ('clahe'):
+                ...
+        stage = the stage name
+        sample = the sample the stage is for (defaults to the sample being worked on)
+        '''
+        self.stage = stage
+        self.sample = sample
+        return
+
+    def __enter__ (self):
+        self.start = time.perf_counter ()
+        return (self)
+
+    def __exit__ (self, exc_type, exc_value, tb):
+        self.seconds = time.perf_counter () - self.start
+        if enabled ():
+            sample = self.sample if self.sample is not None else getattr (_current, 'sample', None)
+            emit ('stage', stage = self.stage, sample = sample, seconds = self.seconds,
+                  ok = exc_type is None)
+        return (False)
+
+class sample_tag:
+    def __init__ (self, sample):
+        '''
+        context manager to tag the stage events inside it with a sample, without a
+        'sample' event (for the parts of the work on a sample done in other threads,
+        see prefetch_pipeline)
+        sample = the sample name (e.g. the image file)
+        '''
+        self.sample = sample
+        return
+
+    def __enter__ (self):
+        self.previous = getattr (_current, 'sample', None)
+        _current.sample = self.sample
+        return (self)
+
+    def __exit__ (self, exc_type, exc_value, tb):
+        _current.sample = self.previous
+        return (False)
+
+class sample_timer:
+    def __init__ (self, sample):
+        '''
+        context manager around the work on one sample: the stage events inside it
+        are tagged with the sample, and a 'sample' event is emitted at the end with
+        the time, whether it worked (and the error if not), and the peak python
+        memory (with trace_memory). With a profile directory the sample is run
+        under cProfile and the stats are written to <profile_dir>/<sample>.prof.
+        sample = the sample name (e.g. the image file)
+        '''
+        self.sample = sample
+        self.profiler = None
+        self.tracing = False
+        return
+
+    def __enter__ (self):
+        self.previous = getattr (_current, 'sample', None)
+        _current.sample = self.sample
+        if not enabled ():
+            return (self)
+
+        if os.environ.get (trace_memory_env):
+            import tracemalloc
+            if not tracemalloc.is_tracing ():
+                tracemalloc.start ()
+            tracemalloc.reset_peak ()
+            self.tracing = True
+
+        if os.environ.get (profile_env):
+            import cProfile
+            try:
+                self.profiler = cProfile.Profile ()
+                self.profiler.enable ()
+            except ValueError:
+                self.profiler = None        # another profiler is active (e.g. another thread)
+
+        self.start = time.perf_counter ()
+        return (self)
+
+    def __exit__ (self, exc_type, exc_value, tb):
+        _current.sample = self.previous
+        if not enabled ():
+            return (False)
+
+        seconds = time.perf_counter () - self.start
+        fields = dict (sample = self.sample, seconds = seconds, ok = exc_type is None)
+        if exc_type is not None:
+            fields['error'] = exc_type.__name__ + ': ' + str (exc_value)
+
+        if self.profiler is not None:
+            self.profiler.disable ()
+            name = str (self.sample).strip (os.sep).replace (os.sep, '_').replace (':', '')
+            prof_file = os.path.join (os.environ[profile_env], name + '.prof')
+            self.profiler.dump_stats (prof_file)
+            fields['profile'] = prof_file
+
+        if self.tracing:
+            import tracemalloc
+            fields['peak_python_memory'] = tracemalloc.get_traced_memory ()[1]
+
+        emit ('sample', **fields)
+        return (False)
+
+def start_run (events_file, profile_dir = None, trace_memory = False, **fields):
+    '''
+    function to start an instrumented run: turns the instrumentation on (see
+    configure) and emits the 'run_start' event. Returns the run id.
+    events_file = the json lines events file
+    profile_dir = directory for the cProfile files of each sample (optional)
+    trace_memory = record the peak python memory of each sample
+    fields = details of the run for the 'run_start' event (e.g. the base directory)
+    '''
+    run_id = configure (events_file, profile_dir, trace_memory)
+    emit ('run_start', **fields)
+    return (run_id)
+
+def read_events (events_file, run_id = None):
+    '''
+    function to read the events of a run from an events file
+    events_file = the json lines events file
+    run_id = the run to read (optional, all the events if not given)
+    '''
+    events = []
+    with open (events_file, 'r') as f:
+        for line in f:
+            try:
+                e = json.loads (line)
+            except ValueError:
+                continue                    # a line cut short by a killed process
+            if run_id is None or e.get ('run') == run_id:
+                events.append (e)
+    return (events)
+
+def summarise (events, slowest = 10):
+    '''
+    function to make the summary of a run from its events: the total time of each
+    stage, the slowest samples, the throughput (images per minute) and the failures
+
+    events = list of event dicts (see read_events)
+    slowest = number of slowest samples to list
+    '''
+    stages = dict ()
+    sample_stages = dict ()
+    samples = []
+    failures = []
+    starts = [e['time'] for e in events if e['event'] == 'run_start']
+    ends = [e['time'] for e in events if e['event'] == 'run_end']
+
+    for e in events:
+        if e['event'] == 'stage':
+            s = stages.setdefault (e['stage'], dict (seconds = 0.0, count = 0))
+            s['seconds'] = s['seconds'] + e['seconds']
+            s['count'] = s['count'] + 1
+            if e.get ('sample') is not None:
+                per = sample_stages.setdefault (e['sample'], dict ())
+                per[e['stage']] = per.get (e['stage'], 0.0) + e['seconds']
+        elif e['event'] == 'sample':
+            samples.append (e)
+            if not e['ok']:
+                failures.append (dict (sample = e['sample'], error = e.get ('error')))
+        elif e['event'] == 'failure':
+            if not any (f['sample'] == e['sample'] for f in failures):
+                failures.append (dict (sample = e['sample'], error = e.get ('error')))
+
+    for s in stages.values ():
+        s['mean'] = s['seconds'] / s['count']
+
+    # the wall time of the run, from the run events or else the sample events
+    if starts and ends:
+        wall = max (ends) - min (starts)
+    elif samples:
+        wall = max (e['time'] for e in samples) - min (e['time'] - e['seconds'] for e in samples)
+    else:
+        wall = 0.0
+
+    completed = [e for e in samples if e['ok']]
+    samples.sort (key = lambda e: e['seconds'], reverse = True)
+    return (dict (run = events[0].get ('run') if events else None,
+                  wall_seconds = wall,
+                  samples = len (samples),
+                  completed = len (completed),
+                  images_per_minute = len (completed) / (wall / 60.0) if wall > 0 else None,
+                  stages = stages,
+                  slowest = [dict (sample = e['sample'], seconds = e['seconds'],
+                                   stages = sample_stages.get (e['sample'], dict ()))
+                             for e in samples[:slowest]],
+                  failures = failures))
+
+def write_summary (summary, summary_file):
+    '''
+    function to write a run summary as json and print the main numbers
+    summary = the summary dict (see summarise)
+    summary_file = the json file to write
+    '''
+    with open (summary_file, 'w') as f:
+        json.dump (summary, f, indent = 1, default = str)
+
+    print ('---------------------------------------------------------------')
+    print ('run ' + str (summary['run']) + ': ' + str (summary['completed']) + ' of ' +
+           str (summary['samples']) + ' samples in ' + '%.1f' % summary['wall_seconds'] + ' s')
+    if summary['images_per_minute'] is not None:
+        print ('throughput: ' + '%.1f' % summary['images_per_minute'] + ' images per minute')
+    for stage, s in sorted (summary['stages'].items (), key = lambda i: -i[1]['seconds']):
+        print ('%-16s %10.2f s total %8.3f s mean (%d)' % (stage, s['seconds'], s['mean'], s['count']))
+    for s in summary['slowest']:
+        print ('slow: ' + '%.2f' % s['seconds'] + ' s ' + str (s['sample']))
+    for f in summary['failures']:
+        print ('failed: ' + str (f['sample']) + ' (' + str (f['error']) + ')')
+    print ('summary written to: ' + summary_file)
+    return
+
+def finish_run (events_file, summary_file = None, slowest = 10):
+    '''
+    function to end a run: emits the 'run_end' event, writes the summary of the
+    run next to the events file (<events>_summary.json) or to summary_file, and
+    turns the instrumentation off. Returns the summary.
+    events_file = the json lines events file
+    summary_file = the summary file (optional)
+    slowest = number of slowest samples to list
+    '''
+    emit ('run_end')
+    if summary_file is None:
+        summary_file = os.path.splitext (events_file)[0] + '_summary.json'
+    summary = summarise (read_events (events_file, os.environ.get (run_env)), slowest)
+    write_summary (summary, summary_file)
+    configure ()
+    return (summary)
@@ -0,0 +1,385 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# lease_queue: a work queue on a shared filesystem, so any number of worker
+#              processes on any number of hosts can pull tasks (samples) from
+#              it without a server. The task list is written once, a worker
+#              claims a task by making its lease file (an exclusive create, so
+#              only one worker gets it), keeps the lease alive by touching it
+#              while it works, and marks the task done or failed at the end.
+#              A lease that has not been touched for lease_seconds belongs to
+#              a worker that died, and another worker takes it over (renaming
+#              the lease away first, so only one worker does). The lease ages
+#              are measured against the filesystem clock, not the host clock.
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import hashlib
+import tempfile
+import threading
+import traceback
+
+# default queue directory name, in the base directory of a tree
+queue_dir_name = '.photoseive_queue'
+
+# default seconds before a lease that is not renewed expires, seconds between
+# looks at the queue while the remaining tasks are leased by other workers, and
+# number of times a task is started before it is given up on (a task that keeps
+# killing its worker)
+default_lease_seconds = 300.0
+default_poll_seconds = 10.0
+default_max_attempts = 3
+
+def task_id (task):
+    '''
+    function to make the id of a task (used for its file names)
+    task = the task (a string, e.g. an image file name)
+    '''
+    return (hashlib.sha1 (task.encode ('utf-8')).hexdigest ()[:20])
+
+def write_new_file (file_name, text):
+    '''
+    function to write a file only if it does not exist, atomically (the file is
+    written under a temporary name and linked into place). Returns False if the
+    file was already there.
+    file_name = the file name
+    text = the file contents
+    '''
+    fd, tmp_file = tempfile.mkstemp (dir = os.path.dirname (file_name), suffix = '.tmp')
+    try:
+        with os.fdopen (fd, 'w') as f:
+            f.write (text)
+        os.chmod (tmp_file, 0o644)
+        os.link (tmp_file, file_name)
+        return (True)
+    except FileExistsError:
+        return (False)
+    finally:
+        os.unlink (tmp_file)
+
+class heartbeat:
+    def __init__ (self, queue, tid):
+        '''
+        context manager to renew a lease in a background thread while a task runs
+        queue = the lease_queue
+        tid = the task id
+        '''
+        self.queue = queue
+        self.tid = tid
+        self.lost = False                   # another worker took the lease over
+        self.stop = threading.Event ()
+        self.thread = threading.Thread (target = self.beat, daemon = True)
+        return
+
+    def beat (self):
+        '''
+        method run in the thread: renew the lease a few times per lease period
+        '''
+        while not self.stop.wait (self.queue.lease_seconds / 4.0):
+            if not self.queue.renew (self.tid):
+                print ('WARNING: lost the lease of task ' + self.tid + ', another worker took it over')
+                self.lost = True
+                return
+        return
+
+    def __enter__ (self):
+        self.thread.start ()
+        return (self)
+
+    def __exit__ (self, exc_type, exc_value, tb):
+        self.stop.set ()
+        self.thread.join ()
+        return (False)
+
+class lease_queue:
+    def __init__ (self, queue_dir, lease_seconds = default_lease_seconds,
+                  poll_seconds = default_poll_seconds, max_attempts = default_max_attempts):
+        '''
+        constructor takes the queue directory (on the shared filesystem, made if it
+        does not exist)
+        queue_dir = the queue directory
+        lease_seconds = seconds before a lease that is not renewed expires (the
+                        heartbeat renews it every quarter of this)
+        poll_seconds = seconds between looks at the queue while the remaining tasks
+                       are leased by other workers
+        max_attempts = number of times a task is started before it is marked failed
+        '''
+        self.queue_dir = queue_dir
+        self.lease_seconds = float (lease_seconds)
+        self.poll_seconds = float (poll_seconds)
+        self.max_attempts = int (max_attempts)
+        self.tasks_file = os.path.join (queue_dir, 'tasks.json')
+        self.worker = socket.gethostname () + '-' + str (os.getpid ()) + '-' + uuid.uuid4 ().hex[:8]
+
+        for d in ('leases', 'done', 'failed', 'clock'):
+            path = os.path.join (queue_dir, d)
+            if not os.path.isdir (path):
+                os.makedirs (path, exist_ok = True)
+        return
+
+    def create (self, tasks):
+        '''
+        method to write the task list, if there is not one already (the first worker
+        to start writes it, the others use it). Returns the task list of the queue.
+        tasks = list of tasks (strings, e.g. image file names)
+        '''
+        write_new_file (self.tasks_file, json.dumps (list (tasks), indent = 0))
+        return (self.tasks ())
+
+    def tasks (self):
+        '''
+        method to read the task list
+        '''
+        with open (self.tasks_file, 'r') as f:
+            return (json.load (f))
+
+    def file_name (self, kind, tid):
+        '''
+        method to get the lease, done or failed file of a task
+        kind = 'leases', 'done' or 'failed'
+        tid = the task id
+        '''
+        return (os.path.join (self.queue_dir, kind, tid))
+
+    def now (self):
+        '''
+        method to get the time on the shared filesystem (the modification time of a
+        file this worker touches), so lease ages do not depend on the host clocks
+        '''
+        clock_file = self.file_name ('clock', self.worker)
+        with open (clock_file, 'a'):
+            os.utime (clock_file)
+        return (os.stat (clock_file).st_mtime)
+
+    def read_lease (self, lease_file):
+        '''
+        method to read a lease file, returns a dict (empty if it cannot be read)
+        lease_file = the lease file
+        '''
+        try:
+            with open (lease_file, 'r') as f:
+                return (json.load (f))
+        except (OSError, ValueError):
+            return (dict ())
+
+    def claim (self, tid, now = None):
+        '''
+        method to try to claim a task. A task with a live lease is left alone, an
+        expired lease is taken over. Returns True if this worker has the lease.
+        tid = the task id
+        now = the filesystem time (see now, looked up if not given)
+        '''
+        lease_file = self.file_name ('leases', tid)
+        attempts = 0
+
+        if os.path.exists (lease_file):
+            try:
+                age = (self.now () if now is None else now) - os.stat (lease_file).st_mtime
+            except OSError:
+                age = None                  # released in the meantime
+            if age is not None:
+                if age < self.lease_seconds:
+                    return (False)
+
+                # take the expired lease away, only one worker can rename it
+                expired = self.read_lease (lease_file)
+                attempts = expired.get ('attempts', 1)
+                expired_file = lease_file + '.' + self.worker + '.expired'
+                try:
+                    os.rename (lease_file, expired_file)
+                except OSError:
+                    return (False)
+
+                # another worker may have taken the lease over between the age check
+                # and the rename, then the lease taken away is its fresh one: put it
+                # back (unless there is a lease again) and leave the task to it
+                taken = self.read_lease (expired_file)
+                try:
+                    taken_age = self.now () - os.stat (expired_file).st_mtime
+                except OSError:
+                    taken_age = None
+                if taken.get ('worker') != expired.get ('worker') or \
+                   taken.get ('claimed') != expired.get ('claimed') or \
+                   (taken_age is not None and taken_age < self.lease_seconds):
+                    try:
+                        os.link (expired_file, lease_file)
+                    except OSError:
+                        pass
+                    os.unlink (expired_file)
+                    return (False)
+                os.unlink (expired_file)
+                print ('taking over the expired lease of task ' + tid)
+
+                if attempts >= self.max_attempts:
+                    self.fail (tid, 'the lease expired ' + str (attempts) + ' times')
+                    return (False)
+
+        lease = dict (worker = self.worker, host = socket.gethostname (), pid = os.getpid (),
+                      claimed = time.time (), attempts = attempts + 1)
+        return (write_new_file (lease_file, json.dumps (lease)))
+
+    def renew (self, tid):
+        '''
+        method to renew the lease of a task. Returns False if the lease is no longer
+        this worker's.
+        tid = the task id
+        '''
+        lease_file = self.file_name ('leases', tid)
+        if self.read_lease (lease_file).get ('worker') != self.worker:
+            return (False)
+        try:
+            os.utime (lease_file)
+        except OSError:
+            return (False)
+        return (True)
+
+    def release (self, tid):
+        '''
+        method to give up the lease of a task (if it is still this worker's)
+        tid = the task id
+        '''
+        lease_file = self.file_name ('leases', tid)
+        if self.read_lease (lease_file).get ('worker') == self.worker:
+            try:
+                os.unlink (lease_file)
+            except OSError:
+                pass
+        return
+
+    def complete (self, tid):
+        '''
+        method to mark a task done and release its lease
+        tid = the task id
+        '''
+        write_new_file (self.file_name ('done', tid), self.worker)
+        self.release (tid)
+        return
+
+    def fail (self, tid, message):
+        '''
+        method to mark a task failed (it is not tried again) and release its lease
+        tid = the task id
+        message = the error message
+        '''
+        write_new_file (self.file_name ('failed', tid), message)
+        self.release (tid)
+        return
+
+    def finished (self):
+        '''
+        method to get the ids of the tasks that are done or failed
+        '''
+        return (set (os.listdir (os.path.join (self.queue_dir, 'done'))) |
+                set (os.listdir (os.path.join (self.queue_dir, 'failed'))))
+
+    def work (self, func):
+        '''
+        method to run tasks from the queue until every task is done or failed. The
+        tasks are tried from a random starting point so the workers spread out.
+        When the remaining tasks are all leased by other workers, this waits
+        poll_seconds and looks again (to take over the leases of workers that died).
+        Returns (the tasks this worker completed, the tasks it failed).
+
+        func = function called with the task, an exception marks the task failed
+        '''
+        tasks = self.tasks ()
+        start = random.randrange (max (1, len (tasks)))
+        tasks = tasks[start:] + tasks[:start]
+        completed = []
+        failed = []
+
+        while True:
+            finished = self.finished ()
+            remaining = [t for t in tasks if task_id (t) not in finished]
+            if len (remaining) == 0:
+                break
+
+            claimed = False
+            now = self.now ()
+            for task in remaining:
+                tid = task_id (task)
+                if not self.claim (tid, now):
+                    continue
+
+                # another worker may have finished it before the claim
+                if os.path.exists (self.file_name ('done', tid)):
+                    self.release (tid)
+                    continue
+
+                claimed = True
+                try:
+                    with heartbeat (self, tid) as beat:
+                        func (task)
+
+                    # the task is another worker's if the lease was lost, that
+                    # worker marks it done (or failed)
+                    if beat.lost or not self.renew (tid):
+                        print ('WARNING: lost the lease of task ' + tid + ', not marking it done')
+                    else:
+                        self.complete (tid)
+                        completed.append (task)
+                except Exception:
+                    message = traceback.format_exc ()
+                    print ('ERROR with: ' + task)
+                    print (message)
+                    if self.renew (tid):
+                        self.fail (tid, message)
+                        failed.append (task)
+                now = self.now ()
+
+            if not claimed:
+                time.sleep (self.poll_seconds)
+
+        try:
+            os.unlink (self.file_name ('clock', self.worker))
+        except OSError:
+            pass
+        return (completed, failed)
+
+    def status (self):
+        '''
+        method to count the tasks that are done, failed, leased and waiting
+        '''
+        tasks = self.tasks ()
+        done = set (os.listdir (os.path.join (self.queue_dir, 'done')))
+        failed = set (os.listdir (os.path.join (self.queue_dir, 'failed')))
+        leased = set (os.listdir (os.path.join (self.queue_dir, 'leases')))
+        ids = [task_id (t) for t in tasks]
+        return (dict (tasks = len (ids),
+                      done = sum (1 for i in ids if i in done),
+                      failed = sum (1 for i in ids if i in failed),
+                      leased = sum (1 for i in ids if i in leased and i not in done and i not in failed),
+                      waiting = sum (1 for i in ids if i not in done and i not in failed and i not in leased)))
+
+    def failures (self):
+        '''
+        method to get the (task, error message) tuples of the failed tasks
+        '''
+        res = []
+        for task in self.tasks ():
+            failed_file = self.file_name ('failed', task_id (task))
+            if os.path.exists (failed_file):
+                with open (failed_file, 'r') as f:
+                    res.append ((task, f.read ()))
+        return (res)
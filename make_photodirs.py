@@ -17,44 +17,184 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-# STEP 1: take raw photos, and put them into directories
+# STEP 1: take raw photos, and put them into directories. On the same filesystem
+#         the images are hard linked (or reflinked) into the sample directories
+#         rather than copied, otherwise they are copied on a pool of threads and
+#         each copy is checked against the checksum of the original. Rerunning
+#         skips the samples that are already there.
 
 import os
 import sys
-import glob
+import hashlib
 import shutil
+import concurrent.futures
 import numpy as np
 import pandas as pd
 
-def make_photodirs (target_dir):
+from sample_index import find_samples, is_image
+
+# the blank config file copied into each sample directory
+default_config_file = 'C:\\data\\data\\stripes\\photoseives\\config.txt'
+
+# linux ioctl to clone a file's extents (a reflink, btrfs and xfs)
+FICLONE = 0x40049409
+
+def reflink (src, dst):
+    '''
+    function to make dst a copy on write clone of src (linux only), raises OSError
+    if the filesystem cannot do it
+    src = the source file
+    dst = the new file
+    '''
+    import fcntl
+    with open (src, 'rb') as s, open (dst, 'wb') as d:
+        try:
+            fcntl.ioctl (d.fileno (), FICLONE, s.fileno ())
+        except OSError:
+            d.close ()
+            os.unlink (dst)
+            raise
+    shutil.copystat (src, dst)
+    return
+
+def file_hash (file_name):
+    '''
+    function to get the sha256 of a file
+    file_name = the file
+    '''
+    h = hashlib.sha256 ()
+    with open (file_name, 'rb') as f:
+        for chunk in iter (lambda: f.read (1024**2), b''):
+            h.update (chunk)
+    return (h.hexdigest ())
+
+def copy_verified (src, dst):
+    '''
+    function to copy a file, hashing it on the way, then check the copy has the same
+    hash (raises IOError if it does not)
+    src = the source file
+    dst = the new file
+    '''
+    h = hashlib.sha256 ()
+    with open (src, 'rb') as s, open (dst, 'wb') as d:
+        for chunk in iter (lambda: s.read (1024**2), b''):
+            h.update (chunk)
+            d.write (chunk)
+        d.flush ()
+        os.fsync (d.fileno ())
+    shutil.copystat (src, dst)
+    if file_hash (dst) != h.hexdigest ():
+        os.unlink (dst)
+        raise IOError ('the copy does not match the original: ' + src)
+    return
+
+def place_image (src, dst, method = 'link'):
+    '''
+    function to put an image in a sample directory without copying it if it can:
+    'link' tries a hard link, then a reflink, then a verified copy; 'reflink' tries
+    a reflink, then a verified copy (the sample image is a separate file); 'copy'
+    always makes a verified copy. Returns the way it was done.
+    src = the image
+    dst = the image in the sample directory
+    method = 'link', 'reflink' or 'copy'
+    '''
+    if method == 'link':
+        try:
+            os.link (src, dst)
+            return ('hardlink')
+        except OSError:
+            pass
+    if method in ('link', 'reflink'):
+        try:
+            reflink (src, dst)
+            return ('reflink')
+        except (OSError, ImportError):
+            pass
+    copy_verified (src, dst)
+    return ('copy')
+
+def make_photodirs (target_dir, config_file = default_config_file, source_dir = None, jobs = 8,
+                    method = 'link', key_file = None):
     '''
     function to make sub directories for each image, labeled with the
-    image name. Also copy over a blank config file.
+    image name. Also copy over a blank config file. Samples that are already
+    there are skipped. Returns the key table (see make_key_dataframe) of the
+    samples made or found.
     target_dir = directory that contains all the images
+    config_file = the blank config file to copy into each directory (None writes
+                  an empty config.txt, for trees with config_defaults.txt files)
+    source_dir = directory the images are in, if not target_dir (e.g. a card)
+    jobs = number of threads to copy images on
+    method = 'link' (hard link, reflink or copy), 'reflink' or 'copy' (see place_image)
+    key_file = the csv file to write the key table to (optional)
     '''
-    
-    default_config_file = 'C:\\data\\data\\stripes\\photoseives\\config.txt'
-    
-    oldwd = os.getcwd ()
-    os.chdir (target_dir)
-    
-    images = glob.glob ('*.jpg')
+    if config_file is not None:
+        config_file = os.path.abspath (config_file)
+    if source_dir is None:
+        source_dir = target_dir
+
+    # the images picked up from the target (or source) directory, in any case
+    images = sorted (e.path for e in os.scandir (source_dir) if e.is_file () and is_image (e.name))
     if len(images) == 0:
         print ('no images found!')
+
+    def run (image_file):
+        try:
+            return (make_photodir (image_file, target_dir, config_file, method, True))
+        except Exception as e:
+            print ('ERROR with: ' + image_file + ' (' + str (e) + ')')
+            return (None, 'failed')
+
+    counts = dict ()
+    rows = []
+    with concurrent.futures.ThreadPoolExecutor (max_workers = jobs) as pool:
+        for image_file, (sample_image, how) in zip (images, pool.map (run, images)):
+            counts[how] = counts.get (how, 0) + 1
+            if sample_image is not None:
+                rows.append ((os.path.basename (sample_image), os.path.dirname (sample_image)))
+            print (how + ': ' + os.path.basename (image_file))
+
+    print ('complete! ' + ', '.join (k + ' ' + str (v) for k, v in sorted (counts.items ())))
+    key = pd.DataFrame (rows, columns = ['name', 'location'])
+    if key_file is not None:
+        key.to_csv (key_file, index = False)
+    return (key)
+
+def make_photodir (image_file, target_dir, config_file, method = 'copy', existing = False):
+    '''
+    function to make the sample directory for one image (image_<name>, in the
+    target directory) with the image and a copy of the config file (a config file
+    that is already there is kept). Returns the image file in the sample directory,
+    or None if the image is already there.
+    image_file = the image file
+    target_dir = directory to make the sample directory in
+    config_file = the config file to copy in (None writes an empty config.txt)
+    method = how to put the image in, 'link', 'reflink' or 'copy' (see place_image)
+    existing = return (image in the sample directory, how it was put in), with
+               'exists' for an image that was already there
+    '''
+    image_base = os.path.basename (image_file)
+    dir_name = os.path.join (target_dir, 'image_' + os.path.splitext (image_base)[0])
+    sample_image = os.path.join (dir_name, image_base)
+    if os.path.exists (sample_image):
+        return ((sample_image, 'exists') if existing else None)
+    if not os.path.isdir (dir_name):
+        os.makedirs (dir_name, exist_ok = True)
     
-    for im in images:
-        im_name = im.strip ('.jpg')         # get image name
-        im_name = im.strip ('.JPG') 
-        dir_name = 'image_' + im_name       # make a dir name
-        os.mkdir (dir_name)                 # make a directory
-        shutil.copy2 (im, os.path.join(os.getcwd(), dir_name, im))
-        shutil.copy2 (default_config_file, os.path.join (os.getcwd(), dir_name, 'config.txt'))
-        print ('completed: ' + im)
+    config_out = os.path.join (dir_name, 'config.txt')
+    if not os.path.exists (config_out):
+        if config_file is None:
+            open (config_out, 'a').close ()
+        else:
+            shutil.copy2 (config_file, config_out)
     
-    os.chdir (oldwd)
-    print ('complete!')
-        
-    return
+    # the image goes in last, under a temporary name, so a sample directory with
+    # the image in it is always complete
+    if os.path.exists (sample_image + '.tmp'):
+        os.unlink (sample_image + '.tmp')       # left by an interrupted run
+    how = place_image (image_file, sample_image + '.tmp', method)
+    os.replace (sample_image + '.tmp', sample_image)
+    return ((sample_image, how) if existing else sample_image)
 
 def make_key_dataframe (base_dir, output_dataframe):
     '''
@@ -62,42 +202,28 @@ def make_key_dataframe (base_dir, output_dataframe):
     base_dir = base directory to walk down through
     output_dataframe = the output file to write the dataframe
     '''
-    indices = ('name', 'location')
-    key_dataframe = pd.DataFrame (index = indices)
-
-    for dir in os.walk (base_dir):
-        files = dir[2]
-        
-        # look for a config file
-        if files.count('config.txt') == 1:
-            # we found one, let's see try to find the image
-            images = glob.glob (os.path.join (dir[0], '*.JPG'))
-            if len (images) != 1:
-                print ('ERROR: there is a problem with the images here: ' + str(dir[0]))
-            else:    
-                # ok, looks good, there is 1 image, lets get that image name
-                image_name = images[0]
-                image_name_base = os.path.basename (image_name)
-                image_location = os.path.dirname (image_name)
-                
-                # construct the new row and append
-                add_row = pd.Series (data = (image_name_base, image_location), index = indices)
-                key_dataframe = key_dataframe.append (add_row, ignore_index = True)
+    rows = []
+
+    # get the sample directories (with a config file) from the index
+    for sample in find_samples (base_dir):
+        # we found one, let's see try to find the image
+        images = sample['images']
+        if len (images) != 1:
+            print ('ERROR: there is a problem with the images here: ' + str(sample['directory']))
+        else:    
+            # ok, looks good, there is 1 image, lets get that image name
+            image_name = images[0]
+            rows.append ((os.path.basename (image_name), os.path.dirname (image_name)))
 
     # write out the dataframe to disk
+    key_dataframe = pd.DataFrame (rows, columns = ['name', 'location'])
     key_dataframe.to_csv (output_dataframe, index = False)
     print ('complete!')
     
-    return
-
-
-if __name__ == '__main__':    
-    target_dirs = 'C://data//data//stripes//photoseives//pismo'
-    #make_photodirs (target_dirs)
-
-    output_dataframe = 'C://data//data//stripes//photoseives//pismo_key.csv'
-    make_key_dataframe (target_dirs, output_dataframe)
-
-
+    return (key_dataframe)
 
 
+if __name__ == '__main__':
+    # e.g. python make_photodirs.py /data/pismo --config config.txt --key /data/pismo_key.csv --jobs 8
+    from photoseive import main
+    sys.exit (main (['photodirs'] + sys.argv[1:]))
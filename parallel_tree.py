@@ -0,0 +1,239 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# parallel_tree: run the per-sample work of a tree run on a pool of worker
+#                processes. Each sample is an independent task, the parent
+#                keeps track of progress and errors, and only admits as many
+#                tasks as fit in the memory budget.
+
+import os
+import struct
+import traceback
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+
+# environment variables that set the size of the thread pools in the numerical libraries
+thread_env_vars = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+# rough peak bytes per image pixel for one sample: the bgr decode, the grey and clahe
+# copies and the floating point working arrays in the grain size analysis
+default_bytes_per_pixel = 24
+
+def set_worker_threads (threads):
+    '''
+    function to limit the number of threads that opencv and the blas libraries use
+    in this process. This is the pool initializer, so the workers do not oversubscribe
+    the cores (jobs x threads should be about the number of cores).
+
+    threads = number of threads each worker is allowed
+    '''
+    for var in thread_env_vars:
+        os.environ[var] = str (threads)
+
+    try:
+        import cv2
+        cv2.setNumThreads (threads)
+    except ImportError:
+        pass
+
+    return
+
+def read_image_size (image_file):
+    '''
+    function to read the (width, height) of a jpeg image from the frame header
+    without decoding the image. Returns None if the size cannot be found.
+
+    image_file = the image file name
+    '''
+    try:
+        with open (image_file, 'rb') as f:
+            if f.read (2) != b'\xff\xd8':
+                return None
+
+            while True:
+                marker = f.read (2)
+                if len (marker) < 2 or marker[0:1] != b'\xff':
+                    return None
+
+                # skip fill bytes
+                while marker[1:2] == b'\xff':
+                    marker = marker[1:2] + f.read (1)
+                code = marker[1]
+
+                # standalone markers have no length
+                if code == 0x01 or 0xd0 <= code <= 0xd7:
+                    continue
+
+                length = struct.unpack ('>H', f.read (2))[0]
+
+                # start of frame markers (not DHT, JPG or DAC) hold the image size
+                if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+                    height, width = struct.unpack ('>xHH', f.read (5))
+                    return (width, height)
+
+                f.seek (length - 2, 1)
+    except (IOError, OSError, struct.error):
+        return None
+
+def estimate_memory (image_file, bytes_per_pixel = default_bytes_per_pixel):
+    '''
+    function to estimate the peak memory (bytes) needed to analyse an image
+
+    image_file = the image file name
+    bytes_per_pixel = peak bytes needed per image pixel
+    '''
+    size = read_image_size (image_file)
+    if size is None:
+        # not a jpeg we can read the header of, assume a 10x compression ratio
+        try:
+            return os.path.getsize (image_file) * 10 * bytes_per_pixel // 3
+        except OSError:
+            return 0
+
+    return size[0] * size[1] * bytes_per_pixel
+
+def _run_task (func, args):
+    '''
+    function run in the worker to call the task and catch any errors, so a
+    failed sample comes back to the parent rather than killing the pool
+    '''
+    try:
+        return (True, func (*args))
+    except Exception:
+        return (False, traceback.format_exc ())
+
+def run_parallel (func, tasks, jobs, names = None, memory = None, max_memory = None,
+                  worker_threads = 1, on_result = None):
+    '''
+    function to run func on each task in a pool of worker processes (or in this
+    process if jobs is 1). Progress and errors are printed in the parent as the
+    tasks complete. Returns a list of (name, error message) tuples for the tasks
+    that failed.
+
+    func = the function to run, must be importable by the worker processes
+    tasks = list of argument tuples, one per task
+    jobs = number of worker processes (1 runs the tasks here, one at a time)
+    names = list of names for the tasks, used in the progress messages (optional)
+    memory = list of estimated peak memory (bytes) for each task (optional)
+    max_memory = total memory budget (bytes) for the tasks in flight (optional). A
+                 task is only started when it fits in the budget, though one task
+                 is always allowed to run.
+    worker_threads = number of opencv and blas threads allowed in each worker
+    on_result = function called in the parent with (name, result) for each task
+                that completes (optional)
+    '''
+    if names is None:
+        names = [str (t) for t in tasks]
+    if memory is None or max_memory is None:
+        memory = [0] * len (tasks)
+
+    failures = []
+    finished = []
+    def report (i, ok, result):
+        finished.append (i)
+        if ok:
+            print ('completed: ' + names[i] + ' (' + str (len (finished)) + ' of ' +
+                   str (len (tasks)) + ')')
+            if on_result is not None:
+                on_result (names[i], result)
+        else:
+            print ('ERROR with: ' + names[i])
+            print (result)
+            failures.append ((names[i], result))
+
+    if jobs == 1:
+        for i, task in enumerate (tasks):
+            report (i, *_run_task (func, task))
+        return (failures)
+
+    # the spawned workers inherit the environment, so the thread limits are set
+    # while they start (before they import numpy and opencv), then put back
+    saved = dict ((var, os.environ.get (var)) for var in thread_env_vars)
+    for var in thread_env_vars:
+        os.environ[var] = str (worker_threads)
+
+    pending = list (range (len (tasks)))
+    pending.reverse ()
+    in_flight = dict ()
+    in_flight_memory = 0
+
+    context = multiprocessing.get_context ('spawn')
+    try:
+        while pending:
+            # a worker that dies (e.g. killed by the oom killer) breaks the pool: the
+            # tasks in flight fail, and a new pool runs the rest
+            reported = len (finished)
+            broken = False
+            with concurrent.futures.ProcessPoolExecutor (max_workers = jobs, mp_context = context,
+                                                         initializer = set_worker_threads,
+                                                         initargs = (worker_threads,)) as pool:
+                while (pending and not broken) or in_flight:
+
+                    # admit tasks while there are free workers and the memory budget allows
+                    while pending and not broken and len (in_flight) < jobs:
+                        i = pending[-1]
+                        if in_flight and max_memory is not None and \
+                           in_flight_memory + memory[i] > max_memory:
+                            break
+                        try:
+                            future = pool.submit (_run_task, func, tasks[i])
+                        except BrokenProcessPool:
+                            broken = True
+                            break
+                        pending.pop ()
+                        in_flight[future] = i
+                        in_flight_memory = in_flight_memory + memory[i]
+                    if not in_flight:
+                        continue
+
+                    # wait for something to finish
+                    done, not_done = concurrent.futures.wait (in_flight,
+                                            return_when = concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        i = in_flight.pop (future)
+                        in_flight_memory = in_flight_memory - memory[i]
+
+                        try:
+                            ok, result = future.result ()
+                        except BrokenProcessPool:
+                            broken = True
+                            ok, result = False, ('a worker process died while this task ran\n' +
+                                                 traceback.format_exc ())
+                        except Exception:
+                            ok, result = False, traceback.format_exc ()
+                        report (i, ok, result)
+
+            if broken and pending:
+                if len (finished) == reported:
+                    # the new pool broke before any task came back, so give up on the rest
+                    while pending:
+                        report (pending.pop (), False, 'the worker processes could not be started')
+                else:
+                    print ('WARNING: a worker process died, starting a new pool for the ' +
+                           str (len (pending)) + ' remaining tasks')
+    finally:
+        for var, value in saved.items ():
+            if value is None:
+                os.environ.pop (var, None)
+            else:
+                os.environ[var] = value
+
+    return (failures)
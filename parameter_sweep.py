@@ -0,0 +1,179 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# parameter_sweep: run the grainsize analysis of a sample over a grid of config
+#                  values (e.g. density, minscale, clahe_dims). The image is
+#                  decoded and unwarped once, each clahe variant is made once per
+#                  clahe_dims (and deblur setting) in the grid, and the results of
+#                  every combination go in one table, a row per combination.
+
+import os
+import sys
+import shutil
+import tempfile
+import itertools
+import cv2
+import numpy as np
+
+from distortion_calibration import distortion_calibration
+from dgs_analysis import dgs_analysis, dgs_array, clahe_object
+from coallate_gsd_data import read_sample, build_table
+from instrumentation import timer
+from sample_cache import deblur_params
+from deblur import lean_highpass, default_tint
+
+# file the sweep table of a sample is written to, in the sample directory
+sweep_file_name = 'sweep.csv'
+
+# the keys that make a new clahe variant, in the order the grid is expanded
+variant_keys = ('deblur_radius', 'deblur_tint', 'clahe_dims')
+
+def grid_combinations (grid):
+    '''
+    function to expand a grid of config values into a list of config override
+    dicts, one per combination (the combinations with the same clahe_dims and
+    deblur are next to each other, so each clahe variant is only needed once)
+
+    grid = dict of config key: list of values
+    '''
+    keys = [k for k in variant_keys if k in grid] + [k for k in grid if k not in variant_keys]
+    values = [v if isinstance (v, (list, tuple, np.ndarray)) else [v] for v in
+              (grid[k] for k in keys)]
+    return ([dict (zip (keys, c)) for c in itertools.product (*values)])
+
+class parameter_sweep:
+    def __init__ (self, image_file, scales, grid, calibrate = None, cache = None):
+        '''
+        constructor takes the file name of the raw (or calibrated) image
+        image_file = the input image name
+        scales = input scales for analysis (a numpy array)
+        grid = dict of config key: list of values to sweep, e.g.
+               {'clahe_dims': [8, 16, 24], 'density': [10, 20]}
+        calibrate = unwarp the image in memory (None decides from the config file,
+                    as sample_pipeline does)
+        cache = a sample_cache to get and keep the clahe variants in (optional)
+        '''
+        self.image_file = image_file
+        self.scales = scales
+        self.grid = grid
+        self.cache = cache
+        self.sample_dir = os.path.dirname (os.path.abspath (image_file))
+        self.sweep_file = os.path.join (self.sample_dir, sweep_file_name)
+
+        # the analysis object reads the config file and makes the records
+        self.gs = dgs_analysis (image_file, scales)
+        self.config = self.gs.config if not self.gs.config_file_error else dict ()
+
+        if calibrate is None:
+            calibrate = ('calibration_file' in self.config and
+                         str (self.config.get ('used_calibrated', 'yes')) != 'no' and
+                         not image_file.endswith ('_c.JPG'))
+        self.calibrate = calibrate
+
+        self.grey = None                    # the decoded (and unwarped) greyscale image
+        return
+
+    def read_image (self):
+        '''
+        method to decode the image to greyscale and unwarp it, once per sweep (the
+        deblur is applied to each clahe variant, see clahe_image)
+        '''
+        if self.grey is None:
+            with timer ('decode'):
+                img = cv2.imread (self.image_file, cv2.IMREAD_GRAYSCALE)
+            if img is None:
+                raise IOError ('cannot read the image file: ' + self.image_file)
+            if self.calibrate:
+                img = distortion_calibration (self.image_file).undistort (img)
+            self.grey = img
+        return (self.grey)
+
+    def clahe_image (self, config):
+        '''
+        method to get the clahe variant of the image for the clahe_dims and deblur
+        of a combination, from the cache if it is there
+        config = the config of the combination
+        '''
+        clahe_dims = config['clahe_dims']
+        if self.cache is not None:
+            clahe_key = self.cache.stage_key (self.image_file, 'clahe',
+                                (self.calibrate, self.config.get ('calibration_file'),
+                                 clahe_dims) + deblur_params (config))
+            clahe_img = self.cache.get_array (clahe_key, 'clahe.npy')
+            if clahe_img is not None:
+                return (clahe_img)
+
+        img = self.read_image ()
+        if config.get ('deblur_radius') is not None:
+            with timer ('deblur'):
+                img = lean_highpass (img, float (config['deblur_radius']),
+                                     float (config.get ('deblur_tint', default_tint)))
+        with timer ('clahe'):
+            clahe_img = clahe_object ((clahe_dims, clahe_dims)).apply (img)
+
+        if self.cache is not None:
+            self.cache.put_array (clahe_key, 'clahe.npy', clahe_img)
+        return (clahe_img)
+
+    def run (self, write_table = True):
+        '''
+        method to run the analysis for every combination in the grid. Returns the
+        list of rows (dicts in the coallated table form, with a 'combination'
+        column), and writes them to sweep.csv in the sample directory.
+        write_table = write the sweep table
+        '''
+        if self.gs.config_file_error:
+            print ('ERROR: cannot run the sweep without a config file: ' + self.image_file)
+            return ([])
+
+        unknown = [k for k in self.grid if k not in self.config]
+        if len (unknown) > 0:
+            print ('WARNING: sweeping keys that are not in the config file: ' + str (unknown))
+        if self.config.get ('rois'):
+            print ('WARNING: the sweep analyses the whole image, not the rois: ' + self.image_file)
+
+        rows = []
+        tmp_dir = tempfile.mkdtemp (prefix = 'photoseive_sweep_')
+        try:
+            variant = None
+            for i, combination in enumerate (grid_combinations (self.grid)):
+                config = dict (self.config)
+                config.update (combination)
+
+                # a new clahe variant only when the clahe dims or the deblur change
+                if variant is None or (config['clahe_dims'],) + deblur_params (config) != variant:
+                    variant = (config['clahe_dims'],) + deblur_params (config)
+                    clahe_img = self.clahe_image (config)
+                    handover_file = os.path.join (tmp_dir, 'clahe_' + str (i) + '.png')
+
+                self.gs.config = config
+                self.gs.extra_stats = dict (combination = i)
+                with timer ('dgs'):
+                    self.gs.dgs_stats = dgs_array (clahe_img, config, self.scales, handover_file)
+                rows.append (read_sample (self.sample_dir, self.gs.make_record (), config))
+        finally:
+            self.gs.config = self.config
+            self.grey = None
+            shutil.rmtree (tmp_dir, ignore_errors = True)
+
+        if write_table:
+            build_table (rows).to_csv (self.sweep_file, index = False)
+
+        print ('completed sweep: ' + self.image_file + ' (' + str (len (rows)) + ' combinations)')
+        return (rows)
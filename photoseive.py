@@ -0,0 +1,281 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# photoseive: the command line entry point, with a subcommand for each step of the
+#             pipeline, in place of editing the paths and 'if False:' blocks of
+#             run_dgs_analysis.py. Only the standard library is imported at start
+#             up, each subcommand imports the modules it needs (opencv, pandas,
+#             DGS) when it runs, so --help and the index listing start quickly.
+#                 python photoseive.py photodirs /data/pismo --config config.txt
+#                 python photoseive.py calibrate /data/pismo --jobs 8
+#                 python photoseive.py config /data/pismo density 10
+#                 python photoseive.py analyse /data/pismo --jobs 8 --fused --cache
+#                 python photoseive.py coallate /data/pismo /data/pismo.csv
+#                 python photoseive.py index /data/pismo --stale
+
+import os
+import sys
+import argparse
+
+def parse_bytes (text):
+    '''
+    function to read a size in bytes, with an optional K, M or G suffix (e.g. 16G)
+    text = the size
+    '''
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+    text = text.strip ().upper ().rstrip ('B')
+    if text and text[-1] in units:
+        return (int (float (text[:-1]) * units[text[-1]]))
+    return (int (float (text)))
+
+def read_scales (scales_file):
+    '''
+    function to get the scales of analysis: read from a text file (one scale in
+    pixels per line), or the default scales of run_dgs_analysis
+    scales_file = the scales file (optional)
+    '''
+    import numpy as np
+    if scales_file is None:
+        from run_dgs_analysis import default_scales
+        return (default_scales ())
+    return (np.atleast_1d (np.loadtxt (scales_file, dtype = np.float64)))
+
+def report_failures (failures):
+    '''
+    function to print the samples that failed, returns the exit status
+    failures = list of (image name, error message) tuples
+    '''
+    if len (failures) == 0:
+        return (0)
+    print (str (len (failures)) + ' samples failed:')
+    for f in failures:
+        print ('    ' + f[0])
+    return (1)
+
+def do_photodirs (args):
+    from make_photodirs import make_photodirs, make_key_dataframe
+    if args.key_only:
+        if args.key is None:
+            print ('ERROR: --key-only needs the --key file')
+            return (1)
+        make_key_dataframe (args.target_dir, args.key)
+    else:
+        make_photodirs (args.target_dir, None if args.no_config else args.config, args.source,
+                        args.jobs, args.method, args.key)
+    return (0)
+
+def do_config (args):
+    import yaml
+    from run_dgs_analysis import change_config
+    change_config (args.target_dir, args.key, yaml.safe_load (args.value))
+    return (0)
+
+def do_collapse (args):
+    from config_resolver import collapse_configs
+    keys = collapse_configs (args.target_dir)
+    print ('moved to the defaults file: ' + ', '.join (keys))
+    return (0)
+
+def do_calibrate (args):
+    from run_dgs_analysis import run_calibration_tree
+    run_calibration_tree (args.target_dir, args.cache, jobs = args.jobs,
+                          events_file = args.events)
+    return (0)
+
+def do_analyse (args):
+    from run_dgs_analysis import run_photoseive_tree, run_distributed_tree
+    scales = read_scales (args.scales)
+    tiled_memory = parse_bytes (args.tiled_memory) if args.tiled_memory else None
+    if args.distributed:
+        failures = run_distributed_tree (args.target_dir, scales, args.jobs, args.worker_threads,
+                                         args.queue_dir, args.fused, args.stale_only, args.store,
+                                         tiled_memory, args.reduce)
+    else:
+        max_memory = parse_bytes (args.max_memory) if args.max_memory else None
+        failures = run_photoseive_tree (args.target_dir, scales, args.jobs, max_memory,
+                                        args.worker_threads, args.fused, args.cache,
+                                        stale_only = args.stale_only, store = args.store,
+                                        tiled_memory = tiled_memory, reduce = args.reduce,
+                                        events_file = args.events, prefetch = args.prefetch)
+    return (report_failures (failures))
+
+def do_sweep (args):
+    import yaml
+    from run_dgs_analysis import run_sweep_tree
+    grid = dict ()
+    for item in args.grid:
+        key, values = item.split ('=', 1)
+        grid[key] = [yaml.safe_load (v) for v in values.split (',')]
+    run_sweep_tree (args.target_dir, read_scales (args.scales), grid, args.output_file,
+                    args.jobs, cache = args.cache)
+    return (0)
+
+def do_coallate (args):
+    from coallate_gsd_data import coallate_gsd_data
+    coallate_gsd_data (args.target_dir, args.output_file, args.jobs, args.incremental,
+                       store = args.store)
+    return (0)
+
+def do_deblur (args):
+    from deblur import deblur
+    db = deblur (args.image)
+    if len (args.radius) == 1 and len (args.tint) == 1:
+        db.tinted_highpass (radius = args.radius[0], tint = args.tint[0],
+                            output_file = args.output_file)
+    else:
+        db.highpass_variants (args.radius, args.tint, args.output_file)
+    return (0)
+
+def do_deblur_tree (args):
+    from run_dgs_analysis import run_deblur_tree
+    run_deblur_tree (args.target_dir, args.radius, args.tint, args.jobs)
+    return (0)
+
+def do_bench (args):
+    from benchmark import main as benchmark_main
+    return (benchmark_main (args.bench_args))
+
+def do_index (args):
+    from sample_index import find_samples
+    samples = find_samples (args.target_dir, args.stale)
+    for sample in samples:
+        print (('stale  ' if sample['stale'] else 'ok     ') + sample['directory'])
+    print (str (len (samples)) + ' samples (' + str (sum (s['stale'] for s in samples)) + ' stale)')
+    return (0)
+
+def make_parser ():
+    '''
+    function to make the argument parser, with a subparser for each subcommand
+    '''
+    parser = argparse.ArgumentParser (prog = 'photoseive',
+                                      description = 'photoseive grain size analysis pipeline')
+    commands = parser.add_subparsers (dest = 'command', metavar = 'command')
+    commands.required = True
+
+    def add_command (name, func, help, jobs = None):
+        p = commands.add_parser (name, help = help, description = help)
+        p.set_defaults (func = func)
+        p.add_argument ('target_dir', help = 'base directory of the tree')
+        if jobs is not None:
+            p.add_argument ('-j', '--jobs', type = int, default = jobs,
+                            help = 'number of parallel jobs (default: ' + str (jobs) + ')')
+        return (p)
+
+    p = add_command ('photodirs', do_photodirs, 'make a sample directory for each image', jobs = 8)
+    p.add_argument ('--config', default = 'config.txt',
+                    help = 'blank config file to copy into each directory (default: config.txt)')
+    p.add_argument ('--no-config', action = 'store_true',
+                    help = 'write empty config files (the values come from config_defaults.txt)')
+    p.add_argument ('--source', default = None,
+                    help = 'directory the images are in (default: the target directory)')
+    p.add_argument ('--method', default = 'link', choices = ('link', 'reflink', 'copy'),
+                    help = 'hard link the images where possible, reflink them, or copy them '
+                           '(default: link)')
+    p.add_argument ('--key', default = None, help = 'also write the key table to this csv file')
+    p.add_argument ('--key-only', action = 'store_true',
+                    help = 'only write the key table (the directories are already made)')
+
+    p = add_command ('config', do_config, 'set a key for every sample of a tree (in one defaults file)')
+    p.add_argument ('key', help = 'the config key, e.g. density')
+    p.add_argument ('value', help = 'the value (read as yaml, so 10 is a number)')
+
+    p = add_command ('collapse', do_collapse,
+                     'move the config values shared by every sample to one defaults file')
+
+    p = add_command ('calibrate', do_calibrate, 'unwarp the images of a tree', jobs = 1)
+    p.add_argument ('--cache', action = 'store_true', help = 'reuse calibrated images')
+    p.add_argument ('--events', default = None, help = 'json lines file to record timings in')
+
+    p = add_command ('analyse', do_analyse, 'run the grain size analysis over a tree', jobs = 1)
+    p.add_argument ('--scales', default = None,
+                    help = 'text file of the scales in pixels (default: the standard scales)')
+    p.add_argument ('--worker-threads', type = int, default = 1,
+                    help = 'opencv and blas threads for each job')
+    p.add_argument ('--max-memory', default = None,
+                    help = 'memory budget for the samples running at once, e.g. 16G')
+    p.add_argument ('--fused', action = 'store_true', help = 'run the in-memory pipeline')
+    p.add_argument ('--cache', action = 'store_true', help = 'skip unchanged samples')
+    p.add_argument ('--stale-only', action = 'store_true',
+                    help = 'only run the samples the index finds stale')
+    p.add_argument ('--store', default = None, help = 'result store directory')
+    p.add_argument ('--tiled-memory', default = None,
+                    help = 'run the tiled analysis with this strip budget, e.g. 512M')
+    p.add_argument ('--reduce', action = 'store_true', help = 'decode at a reduced size')
+    p.add_argument ('--prefetch', type = int, default = None,
+                    help = 'run the prefetching pipeline with this queue depth')
+    p.add_argument ('--events', default = None, help = 'json lines file to record timings in')
+    p.add_argument ('--distributed', action = 'store_true',
+                    help = 'share the samples with other hosts through a lease queue')
+    p.add_argument ('--queue-dir', default = None, help = 'lease queue directory (distributed)')
+
+    p = add_command ('sweep', do_sweep, 'sweep config parameters over a tree', jobs = 1)
+    p.add_argument ('output_file', help = 'the sweep table (csv)')
+    p.add_argument ('grid', nargs = '+', help = 'key=value,value,... e.g. clahe_dims=8,16,24')
+    p.add_argument ('--scales', default = None, help = 'text file of the scales in pixels')
+    p.add_argument ('--cache', action = 'store_true', help = 'reuse decoded images')
+
+    p = add_command ('coallate', do_coallate, 'coallate the results of a tree', jobs = 8)
+    p.add_argument ('output_file', help = 'the coallated table (csv)')
+    p.add_argument ('--incremental', action = 'store_true', help = 'only read changed samples')
+    p.add_argument ('--store', default = None, help = 'result store directory')
+
+    p = commands.add_parser ('deblur', help = 'highpass filter an image',
+                             description = 'highpass filter an image')
+    p.set_defaults (func = do_deblur)
+    p.add_argument ('image', help = 'the input image')
+    p.add_argument ('output_file', help = 'the output image')
+    p.add_argument ('--radius', type = float, nargs = '+', default = [20],
+                    help = 'disk radius in pixels (several make a variant of each)')
+    p.add_argument ('--tint', type = float, nargs = '+', default = [0.0],
+                    help = 'fraction of the original to keep (several make a variant of each)')
+
+    p = add_command ('deblur_tree', do_deblur_tree,
+                     'highpass filter the sample images of a tree (deblur_image.jpg)', jobs = 1)
+    p.add_argument ('--radius', type = float, default = None,
+                    help = 'disk radius in pixels (default: deblur_radius of each config)')
+    p.add_argument ('--tint', type = float, default = None,
+                    help = 'fraction of the original to keep (default: deblur_tint or 0)')
+
+    p = commands.add_parser ('bench', help = 'time the processing stages (see benchmark.py)',
+                             description = 'time the processing stages, the arguments are '
+                                           'passed to benchmark.py', add_help = False)
+    p.set_defaults (func = do_bench)
+    p.add_argument ('bench_args', nargs = '*', help = 'benchmark arguments, e.g. --trees 10 100')
+
+    p = add_command ('index', do_index, 'list the samples of a tree')
+    p.add_argument ('--stale', action = 'store_true', help = 'only list the stale samples')
+    return (parser)
+
+def main (argv = None):
+    '''
+    function to run a subcommand, returns the exit status
+    argv = the command line arguments (optional, defaults to sys.argv)
+    '''
+    if argv is None:
+        argv = sys.argv[1:]
+    if len (argv) > 0 and argv[0] == 'bench':
+        # the options are benchmark.py's, passed on in order (argparse would move
+        # the values of nargs options like --trees 10 100 ahead of the option)
+        return (do_bench (argparse.Namespace (command = 'bench', bench_args = list (argv[1:]))))
+    args = make_parser ().parse_args (argv)
+    return (args.func (args))
+
+# MAIN
+if __name__ == '__main__':
+    sys.exit (main ())
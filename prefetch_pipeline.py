@@ -0,0 +1,217 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# prefetch_pipeline: run the in-memory pipeline (see sample_pipeline) over a list
+#                    of images in three overlapping stages: reader threads read
+#                    the configs and decode (and unwarp) the next images, the
+#                    calling thread runs the clahe and the grainsize analysis,
+#                    and a writer thread writes the stats, gsd and percentiles.
+#                    The stages are joined by bounded queues, so at most depth
+#                    decoded images wait for the analysis (plus one being decoded
+#                    by each reader), and the disk or network reads and writes
+#                    happen while the cpu works on the analysis. The decode and
+#                    writes are mostly in opencv, numpy and the os, which release
+#                    the gil.
+
+import os
+import sys
+import queue
+import threading
+import traceback
+
+from sample_pipeline import sample_pipeline
+from sample_cache import sample_cache, default_max_bytes
+from instrumentation import sample_tag, sample_timer
+
+# default number of decoded images that can wait for the analysis, and reader threads
+default_depth = 2
+default_readers = 2
+
+class prefetch_pipeline:
+    def __init__ (self, images, scales, depth = default_depth, readers = default_readers,
+                  cache = None, store = None, reduce = False):
+        '''
+        constructor takes the list of images to analyse
+        images = list of image file names
+        scales = input scales for analysis (a numpy array)
+        depth = number of decoded images that can wait for the analysis (the size of
+                the reader queue), and results that can wait to be written
+        readers = number of reader threads
+        cache = a sample_cache to get and keep the clahe images in (optional)
+        store = where to put the results in place of the output files (optional, see
+                dgs_analysis), it is only used from the writer thread
+        reduce = decode the images at a reduced size if the scales allow it (see
+                 decode_planner)
+        '''
+        self.images = list (images)
+        self.scales = scales
+        self.depth = max (1, int (depth))
+        self.readers = max (1, min (int (readers), len (self.images)))
+        self.cache = cache
+        self.store = store
+        self.reduce = reduce
+
+        self.failures = []                  # (image name, error message) tuples
+        self.completed = []                 # the images written
+        self.lock = threading.Lock ()
+        return
+
+    def fail (self, image_name, message):
+        '''
+        method to record a failed image
+        image_name = the image name
+        message = the error message (traceback)
+        '''
+        print ('ERROR with: ' + image_name)
+        print (message)
+        with self.lock:
+            self.failures.append ((image_name, message))
+        return
+
+    def read_images (self, tasks, decoded):
+        '''
+        method run by each reader thread: take images off the task queue, read the
+        config and decode the image, and put them on the decoded queue (this blocks
+        while the queue is full). A None is put on the queue when there are no
+        images left.
+        tasks = queue of image names
+        decoded = bounded queue of (image name, sample_pipeline, image, error)
+        '''
+        while True:
+            try:
+                image_name = tasks.get_nowait ()
+            except queue.Empty:
+                break
+
+            try:
+                with sample_tag (image_name):
+                    sp = sample_pipeline (image_name, self.scales, cache = self.cache,
+                                          store = self.store, reduce = self.reduce)
+                    img = sp.read ()
+                decoded.put ((image_name, sp, img, None))
+            except Exception:
+                decoded.put ((image_name, None, None, traceback.format_exc ()))
+
+        decoded.put (None)
+        return
+
+    def write_results (self, analysed):
+        '''
+        method run by the writer thread: write the results of the analysed samples
+        until a None comes off the queue
+        analysed = bounded queue of (image name, sample_pipeline)
+        '''
+        while True:
+            item = analysed.get ()
+            if item is None:
+                break
+
+            image_name, sp = item
+            try:
+                with sample_tag (image_name):
+                    for gs in sp.analyses:
+                        gs.write_results ()
+                with self.lock:
+                    self.completed.append (image_name)
+                print ('completed: ' + image_name + ' (' + str (len (self.completed)) + ' of ' +
+                       str (len (self.images)) + ')')
+            except Exception:
+                self.fail (image_name, traceback.format_exc ())
+        return
+
+    def run (self):
+        '''
+        method to run the pipeline over the images. Returns the list of (image name,
+        error message) tuples for the images that failed.
+        '''
+        if len (self.images) == 0:
+            return (self.failures)
+
+        tasks = queue.Queue ()
+        for image_name in self.images:
+            tasks.put (image_name)
+        decoded = queue.Queue (maxsize = self.depth)
+        analysed = queue.Queue (maxsize = self.depth)
+
+        # daemon threads, so an interrupted run does not hang on the full queues
+        readers = [threading.Thread (target = self.read_images, args = (tasks, decoded),
+                                     daemon = True) for i in range (self.readers)]
+        writer = threading.Thread (target = self.write_results, args = (analysed,), daemon = True)
+        for t in readers:
+            t.start ()
+        writer.start ()
+
+        # the analysis, in this thread, until every reader is done
+        finished = 0
+        while finished < len (readers):
+            item = decoded.get ()
+            if item is None:
+                finished = finished + 1
+                continue
+
+            image_name, sp, img, error = item
+            if error is not None:
+                self.fail (image_name, error)
+                continue
+            if img is None:
+                # the reader printed the problem
+                self.fail (image_name, 'cannot read the config or image file: ' + image_name)
+                continue
+
+            try:
+                with sample_timer (image_name):
+                    sp.prepare (img)
+                    del img
+                    for gs in sp.analyses:
+                        gs.analyse ()
+                for gs in sp.analyses:
+                    gs.image = None         # only the results wait for the writer
+                analysed.put ((image_name, sp))
+            except Exception:
+                self.fail (image_name, traceback.format_exc ())
+
+        analysed.put (None)
+        writer.join ()
+        for t in readers:
+            t.join ()
+        return (self.failures)
+
+def run_prefetch_batch (images, scales, depth = default_depth, readers = default_readers,
+                        cache_dir = None, cache_max_bytes = default_max_bytes, to_store = False,
+                        reduce = False):
+    '''
+    function to run a prefetch pipeline on a batch of images, the unit of work for
+    each worker process of a parallel tree run. Returns (the result records if
+    to_store else None, the images completed, the (image name, error message)
+    tuples of the images that failed).
+
+    images = list of image file names
+    scales = input scales for analysis (a numpy array)
+    depth = number of decoded images that can wait for the analysis
+    readers = number of reader threads
+    cache_dir = directory of the sample_cache to get and keep clahe images in (optional)
+    cache_max_bytes = size cap of the cached intermediates
+    to_store = return the result records rather than writing the output files
+    reduce = decode the images at a reduced size if the scales allow it
+    '''
+    records = [] if to_store else None
+    cache = sample_cache (cache_dir, cache_max_bytes) if cache_dir is not None else None
+    pp = prefetch_pipeline (images, scales, depth, readers, cache, records, reduce)
+    failures = pp.run ()
+    return (records, pp.completed, failures)
@@ -0,0 +1,361 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# result_store: a single store for the results of a campaign in place of the
+#               stats.txt, gsd.txt and percentiles.txt files in each sample
+#               directory. The store is a directory of parquet partitions, each
+#               written by one writer in one go (temporary file then rename), so
+#               any number of writers can append at once without locking. The
+#               latest record of a sample wins when the store is read.
+
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import tempfile
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# record fields that hold arrays, everything else is a stats column
+array_fields = ('percentiles', 'percentile_values', 'bins', 'freqs')
+
+# a compaction lock older than this (seconds) is left by a compaction that died
+compact_lock_seconds = 3600.0
+
+# times a read lists the partitions again when one is removed by a compaction
+read_retries = 5
+
+def read_lock (lock_file):
+    '''
+    function to read the holder of a compaction lock (empty while it is written)
+    lock_file = the lock file name
+    '''
+    try:
+        with open (lock_file, 'r') as f:
+            return (json.load (f))
+    except (IOError, OSError, ValueError):
+        return (dict ())
+
+def process_alive (pid):
+    '''
+    function to check if a process on this host is still running
+    pid = the process id
+    '''
+    try:
+        os.kill (pid, 0)
+    except ProcessLookupError:
+        return (False)
+    except OSError:
+        return (True)                       # running, as another user
+    return (True)
+
+def latest_records (table):
+    '''
+    function to keep only the latest record of each sample (and region of interest)
+    in an arrow table (sorted by sample)
+    table = the arrow table
+    '''
+    samples = table.column ('sample').to_numpy (zero_copy_only = False)
+    if 'roi' in table.column_names:
+        # the regions of interest of a sample each have a record
+        rois = table.column ('roi').to_numpy (zero_copy_only = False)
+        samples = np.array ([s if r is None else s + '\0' + r for s, r in zip (samples, rois)],
+                            dtype = object)
+    order = np.lexsort ((table.column ('write_time').to_numpy (), samples))
+    samples = samples[order]
+    last = np.append (samples[1:] != samples[:-1], True)
+    return (table.take (pa.array (order[last])))
+
+class result_store:
+    def __init__ (self, store_dir, batch_size = 500):
+        '''
+        constructor takes the store directory (made if it does not exist)
+        store_dir = the store directory
+        batch_size = number of records buffered before a partition is written
+        '''
+        if pa is None:
+            raise ImportError ('the result store needs pyarrow installed')
+
+        self.store_dir = store_dir
+        self.batch_size = batch_size
+        self.buffer = []
+        self.written = set ()               # the samples written by this store object
+        self.buffered = set ()              # the samples with records in the buffer
+
+        if not os.path.isdir (store_dir):
+            os.makedirs (store_dir)
+        return
+
+    def append (self, record):
+        '''
+        method to add the record of a sample (see dgs_analysis.make_record), the
+        records are written when the buffer is full or on flush/close. Returns the
+        samples written (see flush), empty while the record waits in the buffer.
+        record = the record dict
+        '''
+        return (self.extend ([record]))
+
+    def extend (self, records):
+        '''
+        method to add the records of a sample (one, or one for each region of
+        interest), these are always written in the same partition. Returns the
+        samples written (see flush), empty while the records wait in the buffer.
+        records = list of record dicts
+        '''
+        now = time.time ()
+        for record in records:
+            record = dict (record)
+            record['write_time'] = now
+            self.buffer.append (record)
+            self.buffered.add (record['sample'])
+        if len (self.buffer) >= self.batch_size:
+            return (self.flush ())
+        return ([])
+
+    def flush (self):
+        '''
+        method to write the buffered records as a new partition. Returns the
+        samples (sample directories) written, which are also added to self.written.
+        '''
+        if len (self.buffer) == 0:
+            return ([])
+
+        # the stats columns are the union over the records
+        stats_keys = []
+        for r in self.buffer:
+            for k in r:
+                if k not in array_fields and k not in stats_keys:
+                    stats_keys.append (k)
+
+        columns = dict ()
+        for k in stats_keys:
+            columns[k] = [r.get (k) for r in self.buffer]
+        for k in array_fields:
+            columns[k] = [np.asarray (r[k], dtype = np.float64) for r in self.buffer]
+        table = pa.table (columns)
+
+        # unique name for this writer, written atomically
+        name = 'part-' + time.strftime ('%Y%m%d%H%M%S') + '-' + socket.gethostname () + \
+               '-' + str (os.getpid ()) + '-' + uuid.uuid4 ().hex[:8] + '.parquet'
+        fd, tmp_file = tempfile.mkstemp (dir = self.store_dir, suffix = '.tmp')
+        os.close (fd)
+        pq.write_table (table, tmp_file)
+        os.replace (tmp_file, os.path.join (self.store_dir, name))
+
+        samples = sorted (set (r['sample'] for r in self.buffer))
+        self.written.update (samples)
+        self.buffer = []
+        self.buffered = set ()
+        return (samples)
+
+    def is_written (self, sample):
+        '''
+        method to check that the records of a sample have been written (none of them
+        are waiting in the buffer)
+        sample = the sample directory
+        '''
+        return (sample in self.written and sample not in self.buffered)
+
+    def close (self):
+        '''
+        method to write anything left in the buffer, returns the samples written
+        '''
+        return (self.flush ())
+
+    def partitions (self):
+        '''
+        method to list the partition files in the store
+        '''
+        return (sorted (os.path.join (self.store_dir, f) for f in os.listdir (self.store_dir)
+                        if f.startswith ('part-') and f.endswith ('.parquet')))
+
+    def read_partitions (self):
+        '''
+        method to read the partitions as a list of arrow tables. A compaction may
+        remove partitions after they are listed (once the merged partition is in
+        place), then the partitions are listed and read again.
+        '''
+        for attempt in range (read_retries):
+            try:
+                return ([pq.read_table (p) for p in self.partitions ()])
+            except FileNotFoundError:
+                if attempt == read_retries - 1:
+                    raise
+                time.sleep (0.1)
+
+    def read_table (self):
+        '''
+        method to read the whole store as one arrow table, with only the latest
+        record of each sample
+        '''
+        tables = self.read_partitions ()
+        if len (tables) == 0:
+            return None
+
+        return (latest_records (pa.concat_tables (tables, promote_options = 'default')))
+
+    def read_stats (self):
+        '''
+        method to read the stats and percentiles of all the samples into a
+        dataframe indexed by sample (the percentiles are p_ columns as in the
+        coallated table)
+        '''
+        table = self.read_table ()
+        if table is None:
+            return None
+
+        stats_cols = [c for c in table.column_names if c not in array_fields]
+        res = table.select (stats_cols).to_pandas ().set_index ('sample')
+
+        percentiles, values = self.read_matrix (table, 'percentiles', 'percentile_values')
+        for i, p in enumerate (percentiles):
+            res['p_' + str (p)] = values[:, i]
+        return (res)
+
+    def read_gsd (self):
+        '''
+        method to read the grain size frequencies of all the samples as a
+        samples x bins matrix in one vectorized read. Returns (samples, bins, freqs).
+        '''
+        table = self.read_table ()
+        if table is None:
+            return (None, None, None)
+
+        samples = table.column ('sample').to_pylist ()
+        bins, freqs = self.read_matrix (table, 'bins', 'freqs')
+        return (samples, bins, freqs)
+
+    def read_matrix (self, table, key_field, value_field):
+        '''
+        method to read a pair of array columns as (keys, samples x keys matrix). If
+        the samples have the same keys this is a reshape of the flat column, else
+        the values are aligned on the union of the keys (missing values are NaN).
+        table = the arrow table
+        key_field = the array column of the keys (e.g. bins)
+        value_field = the array column of the values (e.g. freqs)
+        '''
+        keys = table.column (key_field).combine_chunks ()
+        values = table.column (value_field).combine_chunks ()
+        n = len (table)
+
+        lengths = keys.value_lengths ().to_numpy ()
+        flat_keys = keys.flatten ().to_numpy ()
+        flat_values = values.flatten ().to_numpy ()
+
+        # fast path, every sample has the same keys
+        if n > 0 and np.all (lengths == lengths[0]):
+            key_matrix = flat_keys.reshape ((n, lengths[0]))
+            if np.all (key_matrix == key_matrix[0]):
+                return (key_matrix[0].copy (), flat_values.reshape ((n, lengths[0])))
+
+        # align on the union of the keys
+        union = np.unique (flat_keys)
+        matrix = np.full ((n, len (union)), np.nan)
+        rows = np.repeat (np.arange (n), lengths)
+        matrix[rows, np.searchsorted (union, flat_keys)] = flat_values
+        return (union, matrix)
+
+    def take_stale_lock (self, lock_file):
+        '''
+        method to take away the compaction lock of a compaction that died: its
+        process is gone (if it ran on this host) or the lock is older than
+        compact_lock_seconds. Only one compaction can rename the lock away, and a
+        fresh lock taken in the meantime is put back. Returns True if the lock was
+        taken away.
+        lock_file = the lock file name
+        '''
+        held = read_lock (lock_file)
+        try:
+            age = time.time () - os.stat (lock_file).st_mtime
+        except OSError:
+            return (True)                   # released in the meantime
+        dead = age > compact_lock_seconds
+        if not dead and held.get ('host') == socket.gethostname () and held.get ('pid'):
+            dead = not process_alive (held['pid'])
+        if not dead:
+            return (False)
+
+        stale_file = lock_file + '.' + uuid.uuid4 ().hex[:8] + '.stale'
+        try:
+            os.rename (lock_file, stale_file)
+        except OSError:
+            return (False)
+        if read_lock (stale_file) != held:
+            try:
+                os.link (stale_file, lock_file)
+            except OSError:
+                pass
+            os.unlink (stale_file)
+            return (False)
+        os.unlink (stale_file)
+        print ('taking over the lock of a compaction that died: ' + self.store_dir)
+        return (True)
+
+    def compact (self):
+        '''
+        method to merge the partitions into one, with only the latest record of
+        each sample. A lock file stops two compactions at once (the lock of a
+        compaction that died is taken over, see take_stale_lock), and the new
+        partition is in place before the old ones are removed, so readers always
+        see every sample (a read that loses a partition lists them again).
+        '''
+        lock_file = os.path.join (self.store_dir, 'compact.lock')
+        lock = dict (host = socket.gethostname (), pid = os.getpid (), token = uuid.uuid4 ().hex)
+        for attempt in range (2):
+            try:
+                fd = os.open (lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                if attempt == 0 and self.take_stale_lock (lock_file):
+                    continue
+                print ('the store is already being compacted: ' + self.store_dir)
+                return
+        with os.fdopen (fd, 'w') as f:
+            json.dump (lock, f)
+
+        try:
+            parts = self.partitions ()
+            if len (parts) < 2:
+                return
+            table = latest_records (pa.concat_tables ([pq.read_table (p) for p in parts],
+                                                      promote_options = 'default'))
+
+            name = 'part-' + time.strftime ('%Y%m%d%H%M%S') + '-compact-' + \
+                   uuid.uuid4 ().hex[:8] + '.parquet'
+            fd, tmp_file = tempfile.mkstemp (dir = self.store_dir, suffix = '.tmp')
+            os.close (fd)
+            pq.write_table (table, tmp_file)
+            os.replace (tmp_file, os.path.join (self.store_dir, name))
+
+            for p in parts:
+                os.unlink (p)
+        finally:
+            # only our own lock (a compaction that ran too long may have lost it)
+            if read_lock (lock_file).get ('token') == lock['token']:
+                os.unlink (lock_file)
+
+        return
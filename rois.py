@@ -0,0 +1,83 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# rois: the regions of interest of a sample from its config, and the output files
+#       of a sample (those of each region). Only the standard library is needed,
+#       so the sample index and the config resolver do not load numpy.
+
+import os
+import re
+
+# output files that must be present for a sample to be skipped
+output_files = ('stats.txt', 'gsd.txt', 'percentiles.txt')
+
+def parse_rois (config):
+    '''
+    function to get the regions of interest of a sample from its config: rois is a
+    mapping of name: [x, y, width, height] in pixels of the full size (calibrated)
+    image. Returns a list of (name, (x, y, width, height)) in config order, empty
+    when there are none. Raises ValueError for a name that is not letters, digits,
+    _ and - (it goes in the output file names), or a region that is not four whole
+    numbers with a positive size.
+    config = the config dict of the sample
+    '''
+    rois = config.get ('rois')
+    if not rois:
+        return ([])
+    if not isinstance (rois, dict):
+        raise ValueError ('rois should be a mapping of name: [x, y, width, height]')
+
+    res = []
+    for name, box in rois.items ():
+        if not re.match (r'^[A-Za-z0-9_-]+$', str (name)):
+            raise ValueError ('roi name ' + repr (name) + ' should only be letters, digits, _ and -')
+        try:
+            x, y, w, h = [int (v) for v in box]
+        except (TypeError, ValueError):
+            raise ValueError ('roi ' + str (name) + ' should be [x, y, width, height]: ' + str (box))
+        if x < 0 or y < 0 or w <= 0 or h <= 0:
+            raise ValueError ('roi ' + str (name) + ' is not a region of the image: ' + str (box))
+        res.append ((str (name), (x, y, w, h)))
+    return (res)
+
+def roi_file_name (file_name, roi = None):
+    '''
+    function to get the name of an output file for a region of interest, e.g.
+    stats_tray1.txt for stats.txt (the file name itself without a region)
+    file_name = the output file name
+    roi = the region name (optional)
+    '''
+    if roi is None:
+        return (file_name)
+    stem, ext = os.path.splitext (file_name)
+    return (stem + '_' + roi + ext)
+
+def sample_outputs (config):
+    '''
+    function to get the output files of a sample: stats.txt, gsd.txt and
+    percentiles.txt, or those of each region of interest
+    config = the config dict of the sample
+    '''
+    try:
+        rois = parse_rois (config)
+    except ValueError:
+        return (output_files)               # the run reports the bad region
+    if len (rois) == 0:
+        return (output_files)
+    return (tuple (roi_file_name (f, name) for name, box in rois for f in output_files))
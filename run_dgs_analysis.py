@@ -22,12 +22,44 @@
 import os
 import sys
 import glob
+import time
 import numpy as np
 import pandas as pd
+import yaml
 
 from distortion_calibration import *
 from dgs_analysis import *
 from coallate_gsd_data import *
+from sample_pipeline import sample_pipeline, has_rois
+from tiled_analysis import tiled_analysis
+from sample_cache import sample_cache, default_max_bytes, cache_dir_name, deblur_params, sample_outputs
+from parallel_tree import run_parallel, estimate_memory
+from sample_index import find_samples
+from result_store import result_store
+from parameter_sweep import parameter_sweep
+from instrumentation import sample_timer, start_run, finish_run, emit
+from prefetch_pipeline import prefetch_pipeline, run_prefetch_batch, default_readers
+from lease_queue import lease_queue, queue_dir_name, default_lease_seconds, default_poll_seconds
+from deblur import deblur_batch, deblur_image_name, default_tint
+from config_resolver import resolve_config, set_config
+from deblur import default_max_bytes as deblur_max_bytes
+
+# images made in the sample directories that are not the sample image
+derived_images = ('clahe_image.jpg', deblur_image_name)
+
+# the cache manifest is saved after this many completed samples or seconds (and at
+# the end of the run), rather than after every sample
+manifest_every = 200
+manifest_seconds = 30.0
+
+def default_scales ():
+    '''
+    method to make the default scales of analysis: a linear interval, finer at the
+    small scales
+    '''
+    scales1 = np.arange (0.02, 0.5, 0.02)
+    scales2 = np.arange (0.5, 8.0, 0.2)
+    return (np.append (scales1, scales2))
 
 def run_test ():
     '''
@@ -42,7 +74,77 @@ def run_test ():
     gs.run ()
     return
 
-def run_photoseive_tree (base_dir, scales):
+def run_photoseive_sample (image_name, scales, fused = False, cache_dir = None,
+                           cache_max_bytes = default_max_bytes, to_store = False,
+                           tiled_memory = None, reduce = False):
+    '''
+    method to run the photoseive analysis on a single image. This is the unit of
+    work for a tree run, in serial or on a pool of worker processes.
+
+    image_name = the image to analyse
+    scales = user supplied scales
+    fused = run the in-memory pipeline (single decode, unwarp, CLAHE and analysis
+            without writing the intermediate images), samples with regions of
+            interest (rois in the config) always run it
+    cache_dir = directory of the sample_cache to get and keep clahe images in (optional)
+    cache_max_bytes = size cap of the cached intermediates
+    to_store = return the result records for a result store (one, or one for each
+               region of interest) rather than writing the output files in the
+               sample directory
+    tiled_memory = run the tiled analysis with this memory budget (bytes) for the
+                   strips (optional, for very large images, see tiled_analysis)
+    reduce = decode oversampled images at a reduced size (see decode_planner), not
+             used by the tiled analysis
+
+    This returns the list of result records if to_store, else the image name
+    '''
+    records = [] if to_store else None
+    cache = None
+    if cache_dir is not None:
+        cache = sample_cache (cache_dir, cache_max_bytes)
+
+    with sample_timer (image_name):
+        if tiled_memory is not None:
+            ta = tiled_analysis (image_name, scales, tiled_memory, store = records)
+            ta.run ()
+        elif fused or has_rois (image_name):
+            sp = sample_pipeline (image_name, scales, cache = cache, store = records,
+                                  reduce = reduce)
+            sp.run ()
+        else:
+            gs = dgs_analysis (image_name, scales, records, reduce)
+            if cache is None:
+                gs.run_CLAHE ()
+            else:
+                # reuse the clahe image if it was made with the same clahe dims, deblur
+                # and decode size
+                params = gs.config.get ('clahe_dims')
+                if deblur_params (gs.config):
+                    params = (params,) + deblur_params (gs.config)
+                if gs.decode_factor > 1:
+                    params = (params, gs.decode_factor)
+                clahe_key = cache.stage_key (image_name, 'clahe', params)
+                clahe_file = os.path.join (os.path.dirname (image_name), 'clahe_image.jpg')
+                if cache.get_file (clahe_key, 'clahe.jpg', clahe_file) is not None:
+                    gs.image_file = clahe_file
+                    gs.image_factor = gs.decode_factor
+                else:
+                    gs.run_CLAHE ()
+                    cache.put_file (clahe_key, 'clahe.jpg', gs.image_file)
+            gs.run ()
+
+        if to_store and len (records) == 0:
+            raise RuntimeError ('no results for: ' + image_name)
+
+    if to_store:
+        return (records)
+    return (image_name)
+
+def run_photoseive_tree (base_dir, scales, jobs = 1, max_memory = None, worker_threads = 1,
+                         fused = False, cache = None, cache_max_bytes = default_max_bytes,
+                         stale_only = False, store = None, tiled_memory = None, reduce = False,
+                         events_file = None, profile_dir = None, trace_memory = False,
+                         prefetch = None):
     '''
     method to run photoseives for a tree of subdirectories from the base_dir.
     This looks for a config file and 1 image. The config.txt file contains all 
@@ -54,63 +156,431 @@ def run_photoseive_tree (base_dir, scales):
     
     base_dir = base directory to start the walk
     scales = user supplied scales
+    jobs = number of worker processes, each sample directory is a separate task
+           (1 runs everything in this process)
+    max_memory = memory budget in bytes for the samples running at once (optional),
+                 this is estimated from the image dimensions
+    worker_threads = number of opencv and blas threads for each worker process
+    fused = run the in-memory pipeline on each image (see sample_pipeline), this
+            unwarps the raw image in memory rather than needing a '_c.JPG' image
+    cache = skip samples whose image, config and scales have not changed since the
+            last run: True keeps the cache in base_dir/.photoseive_cache, or give
+            a cache directory (None or False runs everything)
+    cache_max_bytes = size cap of the cached intermediate images (bytes)
+    stale_only = only run the samples the sample index finds stale (an output file
+                 is missing, or the config or image is newer than the outputs)
+    store = result store directory to put the results in, in place of the stats.txt,
+            gsd.txt and percentiles.txt files in each sample directory (optional)
+    tiled_memory = run the tiled analysis with this memory budget (bytes) for the strips
+                   of each image (optional), this bounds the peak memory of a sample
+                   by the budget plus the 1 byte per pixel greyscale image
+    reduce = decode each image at the largest reduced size (1/2, 1/4 or 1/8) that still
+             resolves the finest scale analysed (see decode_planner), the factor is
+             written to the stats as decode_factor
+    events_file = json lines file to record the stage and sample timings in (optional),
+                  a summary of the run is written next to it at the end (see
+                  instrumentation)
+    profile_dir = directory to write a cProfile file for each sample to (optional,
+                  needs events_file)
+    trace_memory = record the peak python memory of each sample (needs events_file)
+    prefetch = number of decoded images to keep ready for the analysis (optional):
+               runs the in-memory pipeline with reader threads decoding ahead and a
+               writer thread writing the results while the analysis runs (see
+               prefetch_pipeline). With jobs > 1 each worker runs a pipeline on a
+               batch of the samples. Not used with tiled_memory.
     '''
 
-    # walk down the dirs, looking for config files and images
-    for dir in os.walk (base_dir):
-        files = dir[2]
+    # record the timings
+    if events_file is not None:
+        start_run (events_file, profile_dir, trace_memory, base_dir = os.path.abspath (base_dir),
+                   jobs = jobs, fused = fused, tiled = tiled_memory is not None)
+
+    try:
+        if prefetch and tiled_memory is not None:
+            print ('WARNING: prefetch is not used with the tiled analysis')
+            prefetch = None
+
+        # set up the result store, the records come back to this process to be written
+        rs = result_store (store) if store else None
+        to_store = rs is not None
+
+        # set up the cache
+        if cache is True:
+            cache = os.path.join (base_dir, cache_dir_name)
+        if cache:
+            sc = sample_cache (cache, cache_max_bytes)
+        else:
+            cache = None
+            sc = None
+
+        images_to_run = []
+        keys = dict ()
 
-        # look for a config file
-        if files.count('config.txt') == 1:
-            images = glob.glob (os.path.join (dir[0], '*.JPG'))
-            
+        # get the sample directories (with a config file) from the index
+        for sample in find_samples (base_dir, stale_only):
+            images = sample['images']
+        
             # try to delete any clahe images, we will remake during analysis
             for i in images:
                 if os.path.basename (i) == 'clahe_image.jpg':
                     os.unlink (i)
-            
-            images = glob.glob (os.path.join (dir[0], '*.JPG'))
-            
+            images = [i for i in images if os.path.basename (i) not in derived_images]
+        
             if len (images) != 1:
-                print ('ERROR: there is a problem with the images here: ' + str(dir[0]))
+                print ('ERROR: there is a problem with the images here: ' + str(sample['directory']))
             else:    
                 # ok, looks good, there is 1 image, lets get that image name
                 image_name = images[0]
-                
-                # run the analysis
-                gs = dgs_analysis (image_name, scales)
-                gs.run_CLAHE ()
-                gs.run ()
-                
-    return
+
+                # skip the sample if nothing has changed since the last run
+                if sc is not None:
+                    config = resolve_config (os.path.join (sample['directory'], 'config.txt'))
+                    extra = ('fused' if fused or prefetch else 'file', store, tiled_memory is not None)
+                    if reduce:
+                        extra = extra + ('reduce',)
+                    keys[image_name] = sc.sample_key (image_name, config, scales, extra)
+                    if sc.is_current (image_name, keys[image_name], not to_store,
+                                      sample_outputs (config)):
+                        print ('unchanged, skipping: ' + image_name)
+                        continue
+
+                images_to_run.append (image_name)
+
+        # save the image hashes so the workers do not need to hash again
+        if sc is not None:
+            sc.write_manifest ()
+
+        # the samples that completed are recorded in the cache once their results are
+        # written (with a store, once their records are out of the buffer), so a run
+        # that dies does not leave samples current that have no results. The buffered
+        # samples are only checked again after the store writes a partition, and the
+        # manifest is saved in batches (see manifest_every) and at the end.
+        pending = []
+        store_written = [0]
+        unsaved = [0]
+        saved_time = [time.time ()]
+        def record_completed (image_names, final = False):
+            if sc is None:
+                return
+            if rs is None:
+                ready = list (image_names)
+            else:
+                pending.extend (image_names)
+                ready = []
+                if final or len (rs.written) != store_written[0]:
+                    store_written[0] = len (rs.written)
+                    waiting = []
+                    for image_name in pending:
+                        if rs.is_written (os.path.dirname (os.path.abspath (image_name))):
+                            ready.append (image_name)
+                        else:
+                            waiting.append (image_name)
+                    pending[:] = waiting
+
+            for image_name in ready:
+                sc.record (image_name, keys[image_name])
+            unsaved[0] = unsaved[0] + len (ready)
+            if unsaved[0] > 0 and (final or unsaved[0] >= manifest_every or
+                                   time.time () - saved_time[0] >= manifest_seconds):
+                sc.write_manifest ()
+                unsaved[0] = 0
+                saved_time[0] = time.time ()
+            return
+
+        # run the analysis
+        try:
+            if prefetch and jobs == 1:
+                pp = prefetch_pipeline (images_to_run, scales, prefetch, default_readers,
+                                        sample_cache (cache, cache_max_bytes) if cache else None,
+                                        rs, reduce)
+                failures = pp.run ()
+                for f in failures:
+                    emit ('failure', sample = f[0], error = f[1].strip ().split ('\n')[-1])
+                record_completed (pp.completed)
+            elif prefetch:
+                failures, completed = run_prefetch_tree (images_to_run, scales, jobs, max_memory,
+                                                         worker_threads, cache, cache_max_bytes,
+                                                         to_store, reduce, prefetch, rs)
+                record_completed (completed)
+            else:
+                if tiled_memory is None:
+                    memory = [estimate_memory (i) for i in images_to_run]
+                else:
+                    memory = [estimate_memory (i, 1) + tiled_memory for i in images_to_run]
+
+                # in this process each sample is recorded as it completes
+                def on_result (image_name, records):
+                    if rs is not None:
+                        rs.extend (records)
+                    if jobs == 1:
+                        record_completed ([image_name])
+
+                failures = run_parallel (run_photoseive_sample,
+                                         [(i, scales, fused, cache, cache_max_bytes, to_store,
+                                           tiled_memory, reduce) for i in images_to_run],
+                                         jobs, names = images_to_run, memory = memory,
+                                         max_memory = max_memory, worker_threads = worker_threads,
+                                         on_result = on_result)
+                for f in failures:
+                    print ('failed: ' + f[0])
+                    emit ('failure', sample = f[0], error = f[1].strip ().split ('\n')[-1])
+
+                # record the samples that worked (in this process, done as they completed)
+                if jobs > 1:
+                    failed = set (f[0] for f in failures)
+                    record_completed ([i for i in images_to_run if i not in failed])
+        finally:
+            try:
+                if rs is not None:
+                    rs.close ()
+            finally:
+                # the rest of the samples (now their records are written), and the
+                # manifest, are saved even if the run fails
+                record_completed ([], final = True)
+    finally:
+        # the instrumentation is turned off even if the run fails
+        if events_file is not None:
+            finish_run (events_file)
+
+    return (failures)
+
+def run_prefetch_tree (images, scales, jobs, max_memory, worker_threads, cache,
+                       cache_max_bytes, to_store, reduce, depth, rs = None):
+    '''
+    method to run prefetch pipelines (see prefetch_pipeline) on a pool of worker
+    processes: the images are split into batches (a few per worker so the work
+    stays balanced), and each worker runs a pipeline on a batch. Returns (the list of
+    (image name, error message) tuples for the images that failed, the list of the
+    images completed).
+
+    images = list of image names
+    scales = user supplied scales
+    jobs = number of worker processes
+    max_memory = memory budget in bytes for the batches running at once (optional)
+    worker_threads = number of opencv and blas threads for each worker process
+    cache = sample_cache directory for the clahe images (optional)
+    cache_max_bytes = size cap of the cached intermediate images (bytes)
+    to_store = the records come back to be put in the result store rs
+    reduce = decode the images at a reduced size if the scales allow it
+    depth = number of decoded images to keep ready in each pipeline
+    rs = the result store (needed with to_store)
+    '''
+    n_batches = min (len (images), jobs * 4)
+    batches = [images[k::n_batches] for k in range (n_batches)]
+    names = ['batch ' + str (k + 1) + ' of ' + str (n_batches) for k in range (n_batches)]
+
+    # a batch holds up to depth + readers + 1 images in memory at once
+    memory = [(depth + default_readers + 1) * max ([estimate_memory (i) for i in b] + [0])
+              for b in batches]
+
+    failures = []
+    completed = []
+    def on_result (name, result):
+        results, batch_completed, batch_failures = result
+        if rs is not None:
+            rs.extend (results)
+        completed.extend (batch_completed)
+        failures.extend (batch_failures)
+
+    batch_failures = run_parallel (run_prefetch_batch,
+                                   [(b, scales, depth, default_readers, cache, cache_max_bytes,
+                                     to_store, reduce) for b in batches],
+                                   jobs, names = names, memory = memory,
+                                   max_memory = max_memory, worker_threads = worker_threads,
+                                   on_result = on_result)
+
+    # a batch that died takes all its images with it
+    for name, error in batch_failures:
+        failures.extend ((i, error) for i in batches[names.index (name)])
+
+    for f in failures:
+        print ('failed: ' + f[0])
+        emit ('failure', sample = f[0], error = f[1].strip ().split ('\n')[-1])
+    return (failures, completed)
+
+def run_distributed_worker (queue_dir, scales, fused = False, store = None, tiled_memory = None,
+                            reduce = False, lease_seconds = default_lease_seconds,
+                            poll_seconds = default_poll_seconds):
+    '''
+    method to run one worker of a distributed tree run: take samples from the lease
+    queue and analyse them until every sample is done or failed. With a result store
+    each record is written to the store before its sample is marked done, so a
+    worker that dies does not lose results it has reported. Returns the number of
+    samples this worker completed.
+
+    queue_dir = the lease queue directory
+    scales = user supplied scales
+    fused = run the in-memory pipeline on each image
+    store = result store directory (optional)
+    tiled_memory = run the tiled analysis with this memory budget (optional)
+    reduce = decode oversampled images at a reduced size
+    lease_seconds = seconds before a lease that is not renewed expires
+    poll_seconds = seconds between looks at the queue while waiting on other workers
+    '''
+    rs = result_store (store) if store else None
+    q = lease_queue (queue_dir, lease_seconds, poll_seconds)
+
+    def analyse (image_name):
+        result = run_photoseive_sample (image_name, scales, fused, None, default_max_bytes,
+                                        rs is not None, tiled_memory, reduce)
+        if rs is not None:
+            rs.extend (result)
+            rs.flush ()
+
+    completed, failed = q.work (analyse)
+    return (len (completed))
+
+def run_distributed_tree (base_dir, scales, jobs = 1, worker_threads = 1, queue_dir = None,
+                          fused = False, stale_only = False, store = None, tiled_memory = None,
+                          reduce = False, lease_seconds = default_lease_seconds,
+                          poll_seconds = default_poll_seconds):
+    '''
+    method to run photoseives for a tree from any number of hosts at once: run this
+    with the same base_dir on each host (a shared filesystem), and the samples are
+    shared out through a lease queue (see lease_queue) rather than split by hand.
+    The first host to start writes the list of samples to the queue, every worker
+    then claims samples one at a time, and the samples of a worker that dies are
+    taken over by another once their leases expire. The output files are written
+    atomically, so coallation never reads a half written file. Returns the list of
+    (image name, error message) tuples for the samples that failed.
+
+    To run the tree again, delete the queue directory (or give a new one).
+
+    base_dir = base directory of the tree
+    scales = user supplied scales
+    jobs = number of worker processes on this host
+    worker_threads = number of opencv and blas threads for each worker process
+    queue_dir = the lease queue directory (default base_dir/.photoseive_queue)
+    fused = run the in-memory pipeline on each image (see sample_pipeline)
+    stale_only = only queue the samples the sample index finds stale
+    store = result store directory (optional, see run_photoseive_tree)
+    tiled_memory = run the tiled analysis with this memory budget (optional)
+    reduce = decode oversampled images at a reduced size (see decode_planner)
+    lease_seconds = seconds before a lease that is not renewed expires, longer than
+                    a heartbeat can be held up (the heartbeat renews every quarter of it)
+    poll_seconds = seconds between looks at the queue while waiting on other workers
+    '''
+    if queue_dir is None:
+        queue_dir = os.path.join (base_dir, queue_dir_name)
+    q = lease_queue (queue_dir, lease_seconds, poll_seconds)
+
+    # the samples with one image (clahe images from earlier runs are left, they may
+    # be in use by another host)
+    images = []
+    for sample in find_samples (base_dir, stale_only):
+        sample_images = [i for i in sample['images'] if os.path.basename (i) not in derived_images]
+        if len (sample_images) != 1:
+            print ('ERROR: there is a problem with the images here: ' + str (sample['directory']))
+        else:
+            images.append (sample_images[0])
+    tasks = q.create (images)
+    print ('queue: ' + queue_dir + ' (' + str (len (tasks)) + ' samples)')
+
+    args = (queue_dir, scales, fused, store, tiled_memory, reduce, lease_seconds, poll_seconds)
+    if jobs == 1:
+        run_distributed_worker (*args)
+    else:
+        worker_failures = run_parallel (run_distributed_worker, [args] * jobs, jobs,
+                                        names = ['worker ' + str (k + 1) for k in range (jobs)],
+                                        worker_threads = worker_threads)
+        for f in worker_failures:
+            print ('worker failed: ' + f[0])
+
+    status = q.status ()
+    print ('queue: ' + str (status['done']) + ' done, ' + str (status['failed']) + ' failed, ' +
+           str (status['leased'] + status['waiting']) + ' left of ' + str (status['tasks']))
+    return (q.failures ())
+
+def run_sweep_sample (image_name, scales, grid, cache_dir = None,
+                      cache_max_bytes = default_max_bytes):
+    '''
+    method to run a parameter sweep on a single image, the unit of work for a
+    sweep tree run. Returns the sweep table rows of the sample.
+
+    image_name = the image to analyse
+    scales = user supplied scales
+    grid = dict of config key: list of values to sweep (see parameter_sweep)
+    cache_dir = directory of the sample_cache to get and keep clahe images in (optional)
+    cache_max_bytes = size cap of the cached intermediates
+    '''
+    cache = None
+    if cache_dir is not None:
+        cache = sample_cache (cache_dir, cache_max_bytes)
+
+    ps = parameter_sweep (image_name, scales, grid, cache = cache)
+    return (ps.run ())
+
+def run_sweep_tree (base_dir, scales, grid, output_file = None, jobs = 1, max_memory = None,
+                    worker_threads = 1, cache = None, cache_max_bytes = default_max_bytes):
+    '''
+    method to run a parameter sweep over a tree, in place of editing the config
+    files with change_config and rerunning the tree for every combination. Each
+    image is decoded once, each clahe variant is made once, and the results of
+    every sample and combination go in one table (a row per sample and
+    combination). The table of each sample is also written to its directory
+    as sweep.csv. Returns the table.
+
+    base_dir = base directory to start the walk
+    scales = user supplied scales
+    grid = dict of config key: list of values to sweep, e.g.
+           {'clahe_dims': [8, 16, 24, 48, 100], 'density': [10, 20]}
+    output_file = csv file to write the sweep table of the tree to (optional),
+                  parquet and feather copies are written next to it
+    jobs = number of worker processes (1 runs everything in this process)
+    max_memory = memory budget in bytes for the samples running at once (optional)
+    worker_threads = number of opencv and blas threads for each worker process
+    cache = keep the clahe variants for later sweeps: True keeps the cache in
+            base_dir/.photoseive_cache, or give a cache directory (optional)
+    cache_max_bytes = size cap of the cached intermediate images (bytes)
+    '''
+    if cache is True:
+        cache = os.path.join (base_dir, cache_dir_name)
+    if not cache:
+        cache = None
+
+    images_to_run = []
+    for sample in find_samples (base_dir):
+        images = [i for i in sample['images'] if os.path.basename (i) not in derived_images]
+        if len (images) != 1:
+            print ('ERROR: there is a problem with the images here: ' + str(sample['directory']))
+        else:
+            images_to_run.append (images[0])
+
+    rows = []
+    failures = run_parallel (run_sweep_sample,
+                             [(i, scales, grid, cache, cache_max_bytes) for i in images_to_run],
+                             jobs, names = images_to_run,
+                             memory = [estimate_memory (i) for i in images_to_run],
+                             max_memory = max_memory, worker_threads = worker_threads,
+                             on_result = lambda name, result: rows.extend (result))
+    for f in failures:
+        print ('failed: ' + f[0])
+
+    res = build_table (rows)
+    if output_file is not None:
+        res.to_csv (output_file, index = False)
+        write_columnar (res, output_file)
+
+    return (res)
 
 def change_config (base_dir, key, value):
     '''
-    method to change some part of the config file
+    method to change some part of the config for every sample in the tree. The
+    key is written to the config_defaults.txt file of base_dir and taken out of
+    the config files below it that set it (see config_resolver), so only those
+    files are written rather than every config file.
     
     base_dir = base directory to start the walk
     key = key to modify
     value = value to modify the key to
     '''
-
-    # walk down the dirs, looking for config files and images
-    for dir in os.walk (base_dir):
-        files = dir[2]
-
-        # look for a config file
-        if files.count('config.txt') == 1:
-            # get that image name to open the dgs analysis object
-            image_name = images[0]
-            
-            # init the dgs analysis object, then modify the config key and write
-            gs = dgs_analysis (image_name, None)
-            gs.config[key] = value
-            gs.write_config ()
-                
-                
+    written = set_config (base_dir, key, value)
+    print ('set ' + str (key) + ': ' + str (value) + ' for ' + base_dir + ' (' +
+           str (written) + ' files written)')
     return
 
-def run_calibration_tree (base_dir):
+def run_calibration_tree (base_dir, cache = None, cache_max_bytes = default_max_bytes, jobs = 1,
+                          events_file = None):
     '''
     method to run camera distortion calibrations for a tree of subdirectories 
     from the base_dir. This looks for a config file and 1 image. The config.txt
@@ -119,100 +589,98 @@ def run_calibration_tree (base_dir):
     present is analysed.
     
     base_dir = base directory to start the walk
+    cache = reuse calibrated images made from the same image and calibration file:
+            True keeps the cache in base_dir/.photoseive_cache, or give a cache
+            directory (None or False always unwarps)
+    cache_max_bytes = size cap of the cached intermediate images (bytes)
+    jobs = number of threads to unwarp images on
+    events_file = json lines file to record the stage and image timings in (optional),
+                  a summary of the run is written next to it at the end
     '''
-    
-    # walk down the dirs, looking for config files and images
-    for dir in os.walk (base_dir):
-        files = dir[2]
-        
-        # look for a config file
-        if files.count('config.txt') == 1:
-            # we found one, let's see try to find the images
-            images = glob.glob (os.path.join (dir[0], '*.JPG'))
-            
-            # ok let's do the calibration on all the images present
-            for i in images:
-                
-                # check to see if we calibrated this image already
-                i_strip = i.strip ('.JPG')
-                if not i_strip[(len(i_strip) - 1)] == 'c':
 
-                    # run the unwarping
-                    dst = distortion_calibration (i)
-                    cal_test_file = dst.run ()
-                    
-                    print ('completed image: ' + i)
+    # record the timings
+    if events_file is not None:
+        start_run (events_file, base_dir = os.path.abspath (base_dir), jobs = jobs,
+                   calibration = True)
 
-    return
+    try:
+        # set up the cache
+        if cache is True:
+            cache = os.path.join (base_dir, cache_dir_name)
+        sc = sample_cache (cache, cache_max_bytes) if cache else None
 
-    
-########################################################################################
-# MAIN
-if __name__ == '__main__':
+        images_to_run = []
 
-    # set directories
-    argentina_2014_directory = 'C:\\data\\data\\stripes\\photoseives\\argentina_2014'
-    argentina_2015_directory = 'C:\\data\\data\\stripes\\photoseives\\argentina_2015'
-    pismo_directory = 'C:\\data\\data\\stripes\\photoseives\\pismo'
+        # get the sample directories (with a config file) from the index
+        for sample in find_samples (base_dir):
+            # ok let's do the calibration on all the images present
+            for i in sample['images']:
 
-    # set the scales of analysis as linear interval
-    scales1 = np.arange (0.02, 0.5, 0.02)
-    scales2 = np.arange (0.5, 8.0, 0.2)
-    scales = np.append (scales1, scales2)
+                # check to see if we calibrated this image already (or made it)
+                if not i.endswith ('_c.JPG') and os.path.basename (i) not in derived_images:
+                    images_to_run.append (i)
 
-    ##############################################################################
-    # run the distortion calibration
-    # run_calibration_tree (argentina_2014_directory)
-    # run_calibration_tree (argentina_2015_directory)
-    # run_calibration_tree (pismo_directory)
-    
-    ## STOP! CROP THE PHOTOS! ##
-    ## MEASURE THE SCALES ##
-    
-    ##############################################################################
-    # UPDATE THE PARAMETERS IN CONFIG FILES
-    if False:
-        # change the density for more detail
-        new_density = 10
-        change_config (argentina_2014_directory, 'density', new_density)
-        change_config (argentina_2015_directory, 'density', new_density)
-        change_config (pismo_directory, 'density', new_density)
-        
-        # add a minscale to the calculations (in pixels)
-        new_minscale = 3.14
-        change_config (argentina_2014_directory, 'minscale', new_minscale)
-        change_config (argentina_2015_directory, 'minscale', new_minscale)
-        change_config (pismo_directory, 'minscale', new_minscale)
-    
-        # add CLAHE dims to config
-        new_clahe_dims = 16
-        change_config (argentina_2014_directory, 'clahe_dims', new_clahe_dims)
-        change_config (argentina_2015_directory, 'clahe_dims', new_clahe_dims)
-        change_config (pismo_directory, 'clahe_dims', new_clahe_dims)
-    
-    ##############################################################################
-    # RUN PHOTOSEIVE CALCULATIONS
-    if False:
-        # run the photoseive calculations
-        run_photoseive_tree (argentina_2014_directory, scales)
-        run_photoseive_tree (argentina_2015_directory, scales)
-        run_photoseive_tree (pismo_directory, scales)
-    
-    ##############################################################################
-    # COALLATE THE DATA
-    if True:
-        # coallate the output data
-        argentina_2014_coallated_data = 'C:\\data\\data\\stripes\\photoseives\\argentina_2014.csv'
-        argentina_2015_coallated_data = 'C:\\data\\data\\stripes\\photoseives\\argentina_2015.csv'
-        pismo_coallated_data = 'C:\\data\\data\\stripes\\photoseives\\pismo.csv'
-        
-        # run the coallate data function
-        coallate_gsd_data (argentina_2014_directory, argentina_2014_coallated_data)
-        coallate_gsd_data (argentina_2015_directory, argentina_2015_coallated_data)
-        coallate_gsd_data (pismo_directory, pismo_coallated_data)
+        # run the unwarping, the undistortion maps are built once per camera
+        undistort_batch (images_to_run, jobs, sc)
 
-    
-    
+        if sc is not None:
+            sc.write_manifest ()
+    finally:
+        # the instrumentation is turned off even if the run fails
+        if events_file is not None:
+            finish_run (events_file)
 
+    return
 
 
+def run_deblur_tree (base_dir, radius = None, tint = None, jobs = 1,
+                     max_bytes = deblur_max_bytes):
+    '''
+    method to deblur the sample image of each sample directory in a tree (the
+    calibrated image if there is one), writing deblur_image.jpg next to it (see
+    deblur). This is for looking at the filter; the analysis applies it in memory
+    when the config file has a deblur_radius. Returns the list of deblurred
+    image names.
+
+    base_dir = base directory to start the walk
+    radius = the circular radius of the highpass mean filter (the deblur_radius of
+             each config file if not given)
+    tint = from 0 (the highpass) to 1 (the image), the deblur_tint of each config
+           file (or 0) if not given
+    jobs = number of threads to deblur images on
+    max_bytes = working memory for the strips of each thread (bytes)
+    '''
+    batches = dict ()
+    for sample in find_samples (base_dir):
+        images = [i for i in sample['images'] if os.path.basename (i) not in derived_images]
+        calibrated = [i for i in images if i.endswith ('_c.JPG')]
+        if len (calibrated) == 1:
+            images = calibrated
+        if len (images) != 1:
+            print ('ERROR: there is a problem with the images here: ' + str (sample['directory']))
+            continue
+
+        config = resolve_config (os.path.join (sample['directory'], 'config.txt'))
+        r = radius if radius is not None else config.get ('deblur_radius')
+        t = tint if tint is not None else config.get ('deblur_tint', default_tint)
+        if r is None:
+            print ('ERROR: no deblur_radius for: ' + str (sample['directory']))
+            continue
+        batches.setdefault ((float (r), float (t)), []).append (images[0])
+
+    # the images with the same filter go to the thread pool together
+    out_files = []
+    for (r, t), images in batches.items ():
+        out_files.extend (f for f in deblur_batch (images, r, t, jobs, max_bytes) if f is not None)
+    return (out_files)
+    
+########################################################################################
+# MAIN
+if __name__ == '__main__':
+    # the pipeline is run from the command line (see photoseive.py), e.g.
+    #     python run_dgs_analysis.py calibrate /data/pismo --jobs 8
+    #     python run_dgs_analysis.py config /data/pismo density 10
+    #     python run_dgs_analysis.py analyse /data/pismo --jobs 8 --max-memory 16G
+    #     python run_dgs_analysis.py coallate /data/pismo /data/pismo.csv
+    from photoseive import main
+    sys.exit (main ())
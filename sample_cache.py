@@ -0,0 +1,301 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# sample_cache: content addressed cache for tree runs. A sample is keyed on a
+#               hash of the image bytes, the config keys that change the result
+#               and the scales, so unchanged samples can be skipped on a rerun.
+#               Intermediate images (clahe, calibrated) are kept in a size
+#               capped blob store with least recently used eviction.
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+# the regions of interest and the output files (in a module of their own, without
+# numpy, for the sample index)
+from rois import output_files, parse_rois, roi_file_name, sample_outputs
+
+# name of the cache directory in the base directory of a tree run
+cache_dir_name = '.photoseive_cache'
+
+# config keys that change the grainsize results
+cache_config_keys = ('density', 'resolution', 'dofilter', 'maxscale', 'minscale', 'notes',
+                     'clahe_dims')
+
+# config keys added later that change the results, with their defaults: they are
+# only part of the key when set to something else, so existing keys stay valid
+optional_config_keys = (('engine', 'dgs'), ('sampling', 'fixed'), ('sampling_tolerance', None),
+                        ('scale_selection', 'dense'), ('deblur_radius', None),
+                        ('deblur_tint', 0.0), ('rois', None))
+
+# default size cap of the intermediate blob store (bytes)
+default_max_bytes = 4 * 1024**3
+
+def deblur_params (config):
+    '''
+    function to get the deblur config (see dgs_analysis.run_deblur) for the key of a
+    clahe image, an empty tuple when the deblur is not used (so keys stay valid)
+    config = the config dict of the sample
+    '''
+    if config.get ('deblur_radius') is None:
+        return (())
+    return ((('deblur', float (config['deblur_radius']), float (config.get ('deblur_tint', 0.0))),))
+
+def hash_key (*parts):
+    '''
+    function to make a hex key from a list of parts, the parts are strings,
+    bytes, or anything that json can dump (dicts are sorted by key)
+    '''
+    h = hashlib.sha256 ()
+    for p in parts:
+        if isinstance (p, bytes):
+            h.update (p)
+        elif isinstance (p, str):
+            h.update (p.encode ('utf-8'))
+        else:
+            h.update (json.dumps (p, sort_keys = True, default = str).encode ('utf-8'))
+        h.update (b'\x00')
+    return (h.hexdigest ())
+
+def _write_json (file_name, data):
+    '''
+    function to write a json file atomically (write a temporary file then rename)
+    '''
+    fd, tmp_file = tempfile.mkstemp (dir = os.path.dirname (file_name), suffix = '.tmp')
+    with os.fdopen (fd, 'w') as f:
+        json.dump (data, f, indent = 1, sort_keys = True)
+    os.replace (tmp_file, file_name)
+    return
+
+class sample_cache:
+    def __init__ (self, cache_dir, max_bytes = default_max_bytes):
+        '''
+        constructor takes the directory to keep the cache in
+        cache_dir = the cache directory (made if it does not exist)
+        max_bytes = size cap of the intermediate blob store in bytes
+        '''
+        self.cache_dir = cache_dir
+        self.blob_dir = os.path.join (cache_dir, 'blobs')
+        self.manifest_file = os.path.join (cache_dir, 'manifest.json')
+        self.max_bytes = max_bytes
+
+        if not os.path.isdir (self.blob_dir):
+            os.makedirs (self.blob_dir)
+
+        self.read_manifest ()
+        return
+
+    def read_manifest (self):
+        '''
+        method to read the manifest of sample keys and image hashes
+        '''
+        try:
+            with open (self.manifest_file, 'r') as f:
+                self.manifest = json.load (f)
+        except (IOError, OSError, ValueError):
+            self.manifest = dict (samples = dict (), image_hashes = dict ())
+        return
+
+    def write_manifest (self):
+        '''
+        method to write the manifest (atomically, so a killed run does not corrupt it)
+        '''
+        _write_json (self.manifest_file, self.manifest)
+        return
+
+    def image_hash (self, image_file):
+        '''
+        method to get the sha256 hash of the image bytes. The hash is remembered
+        against the file size and modification time, so unchanged images are not
+        read again on a rerun.
+        image_file = the image file name
+        '''
+        st = os.stat (image_file)
+        stamp = [st.st_size, st.st_mtime_ns]
+        known = self.manifest['image_hashes'].get (image_file)
+        if known is not None and known[0] == stamp:
+            return (known[1])
+
+        h = hashlib.sha256 ()
+        with open (image_file, 'rb') as f:
+            for chunk in iter (lambda: f.read (1024**2), b''):
+                h.update (chunk)
+
+        self.manifest['image_hashes'][image_file] = [stamp, h.hexdigest ()]
+        return (h.hexdigest ())
+
+    def sample_key (self, image_file, config, scales, extra = None):
+        '''
+        method to make the key of a sample
+        image_file = the image file name
+        config = the config dict of the sample
+        scales = scales for analysis (a numpy array)
+        extra = anything else that changes the result (e.g. the run mode)
+        '''
+        config_part = dict ((k, config.get (k)) for k in cache_config_keys)
+        for k, default in optional_config_keys:
+            if config.get (k, default) != default:
+                config_part[k] = config[k]
+        scales_part = np.ascontiguousarray (np.asarray (scales, dtype = np.float64)).tobytes ()
+        return (hash_key (self.image_hash (image_file), config_part, scales_part, extra))
+
+    def stage_key (self, image_file, stage, params):
+        '''
+        method to make the key of an intermediate image, which depends on the image
+        and only the parameters of the stages that made it
+        image_file = the image file name
+        stage = name of the stage (e.g. clahe)
+        params = the parameters of the stages (anything json can dump)
+        '''
+        return (hash_key (self.image_hash (image_file), stage, params))
+
+    def is_current (self, image_file, key, check_outputs = True, outputs = output_files):
+        '''
+        method to check if the stored result of a sample was made with this key,
+        and the output files are still there
+        image_file = the image file name
+        key = the sample key
+        check_outputs = check the output files are there (not for a result store)
+        outputs = the output files of the sample (see sample_outputs)
+        '''
+        directory = os.path.dirname (image_file)
+        entry = self.manifest['samples'].get (directory)
+        if entry is None or entry['key'] != key or entry['image'] != image_file:
+            return False
+
+        for f in outputs:
+            if check_outputs and not os.path.isfile (os.path.join (directory, f)):
+                return False
+        return True
+
+    def record (self, image_file, key):
+        '''
+        method to record that the sample outputs were made with this key (call
+        write_manifest to save)
+        image_file = the image file name
+        key = the sample key
+        '''
+        self.manifest['samples'][os.path.dirname (image_file)] = dict (key = key, image = image_file)
+        return
+
+    def blob_file (self, key, name):
+        '''
+        method to get the file name of an intermediate in the blob store
+        key = the key of the intermediate
+        name = name of the intermediate, with the file extension (e.g. clahe.jpg)
+        '''
+        return (os.path.join (self.blob_dir, key + '_' + name))
+
+    def get_file (self, key, name, dest_file = None):
+        '''
+        method to get an intermediate from the blob store. Returns the blob file
+        name (or dest_file if it was copied there), or None if it is not stored. A
+        blob evicted by another process while it is being got is not stored.
+        key = the key of the intermediate
+        name = name of the intermediate
+        dest_file = copy the intermediate to this file (optional)
+        '''
+        blob = self.blob_file (key, name)
+        try:
+            os.utime (blob, None)               # mark as recently used
+            if dest_file is not None:
+                shutil.copyfile (blob, dest_file)
+                return (dest_file)
+        except OSError:
+            return None
+        return (blob)
+
+    def put_file (self, key, name, src_file):
+        '''
+        method to copy an intermediate into the blob store, then evict the least
+        recently used intermediates until the store is under the size cap
+        key = the key of the intermediate
+        name = name of the intermediate
+        src_file = the file to store
+        '''
+        blob = self.blob_file (key, name)
+        fd, tmp_file = tempfile.mkstemp (dir = self.blob_dir, suffix = '.tmp')
+        os.close (fd)
+        shutil.copyfile (src_file, tmp_file)
+        os.replace (tmp_file, blob)
+        self.evict ()
+        return (blob)
+
+    def put_array (self, key, name, array):
+        '''
+        method to store an array intermediate (lossless .npy) in the blob store
+        key = the key of the intermediate
+        name = name of the intermediate, ending in .npy
+        array = the numpy array
+        '''
+        blob = self.blob_file (key, name)
+        fd, tmp_file = tempfile.mkstemp (dir = self.blob_dir, suffix = '.tmp')
+        with os.fdopen (fd, 'wb') as f:
+            np.save (f, array)
+        os.replace (tmp_file, blob)
+        self.evict ()
+        return (blob)
+
+    def get_array (self, key, name):
+        '''
+        method to get an array intermediate from the blob store, or None
+        key = the key of the intermediate
+        name = name of the intermediate, ending in .npy
+        '''
+        blob = self.get_file (key, name)
+        if blob is None:
+            return None
+        try:
+            return (np.load (blob))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def evict (self):
+        '''
+        method to remove the least recently used intermediates until the blob store
+        is under the size cap. The blob modification times are the use times, so
+        this is safe with several worker processes sharing the store.
+        '''
+        blobs = []
+        total = 0
+        for name in os.listdir (self.blob_dir):
+            if name.endswith ('.tmp'):
+                continue
+            try:
+                st = os.stat (os.path.join (self.blob_dir, name))
+            except OSError:
+                continue
+            blobs.append ((st.st_mtime, st.st_size, name))
+            total = total + st.st_size
+
+        blobs.sort ()
+        for mtime, size, name in blobs:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink (os.path.join (self.blob_dir, name))
+                total = total - size
+            except OSError:
+                pass
+
+        return
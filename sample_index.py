@@ -0,0 +1,329 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# sample_index: persistent index of the sample directories in a campaign tree,
+#               kept in a local sqlite file. The tree is only listed again where
+#               the directory modification times have changed, and the sample
+#               files are checked with a stat, so a refresh of an unchanged
+#               tree does not need a full walk over network storage.
+
+import os
+import sys
+import json
+import fnmatch
+import sqlite3
+
+from rois import output_files, sample_outputs
+
+# default index file, one index holds any number of trees
+default_index_file = os.path.join (os.path.expanduser ('~'), '.photoseive', 'sample_index.sqlite')
+
+# directories that are never samples (the sample_cache and lease_queue directories)
+skip_dirs = ('.photoseive_cache', '.photoseive_queue')
+
+# the sample images, matched in any case (image.jpg, IMAGE.JPG, image.Jpeg ...)
+image_patterns = ('*.jpg', '*.jpeg')
+
+# the layered defaults file (see config_resolver), a sample is stale when one of the
+# defaults files above it is newer than its outputs
+defaults_file_name = 'config_defaults.txt'
+
+def is_image (file_name):
+    '''
+    function to check if a file name is a sample image (see image_patterns), in
+    any case and on any platform
+    file_name = the file name
+    '''
+    name = os.path.basename (file_name).lower ()
+    return (any (fnmatch.fnmatch (name, p) for p in image_patterns))
+
+def _mtime (file_name):
+    '''
+    function to get the modification time (ns) of a file, or None if it is not there
+    '''
+    try:
+        return (os.stat (file_name).st_mtime_ns)
+    except OSError:
+        return None
+
+def _latest (a, b):
+    '''
+    function to get the later of two modification times (either can be None)
+    '''
+    if a is None:
+        return (b)
+    if b is None:
+        return (a)
+    return (max (a, b))
+
+def _output_mtimes (directory, files, outputs):
+    '''
+    function to get the modification times (ns) of an output of a sample over its
+    files (e.g. stats_<roi>.txt of each region of interest): the oldest, for the
+    stale check (None if one of them is missing), and the newest, for the time the
+    results last changed (None if none of them are there)
+    directory = the sample directory
+    files = the files in the directory
+    outputs = the output file names
+    '''
+    oldest = None
+    newest = None
+    missing = False
+    for f in outputs:
+        m = _mtime (os.path.join (directory, f)) if f in files else None
+        if m is None:
+            missing = True
+            continue
+        oldest = m if oldest is None else min (oldest, m)
+        newest = _latest (newest, m)
+    return ((None if missing else oldest), newest)
+
+def _sample_outputs (directory):
+    '''
+    function to get the output files of a sample from its config (see
+    sample_cache.sample_outputs), the plain output files if the config cannot be read
+    directory = the sample directory
+    '''
+    from config_resolver import resolve_config      # config_resolver imports this module
+    try:
+        config = resolve_config (os.path.join (directory, 'config.txt'))
+    except Exception:
+        config = dict ()
+    return (sample_outputs (config))
+
+class sample_index:
+    def __init__ (self, index_file = default_index_file):
+        '''
+        constructor opens (or makes) the index file
+        index_file = the sqlite index file name
+        '''
+        self.index_file = index_file
+        index_dir = os.path.dirname (index_file)
+        if index_dir and not os.path.isdir (index_dir):
+            os.makedirs (index_dir)
+
+        self.db = sqlite3.connect (index_file)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript ('''
+            create table if not exists dirs (
+                path text primary key,
+                mtime integer,
+                subdirs text,
+                files text);
+            ''')
+
+        # the samples table of an older index is made again (the next refresh fills
+        # it from the directory listings, without walking the tree)
+        columns = [row['name'] for row in self.db.execute ('pragma table_info (samples)')]
+        if columns and 'outputs' not in columns:
+            self.db.execute ('drop table samples')
+        self.db.executescript ('''
+            create table if not exists samples (
+                directory text primary key,
+                images text,
+                config_mtime integer,
+                image_mtime integer,
+                stats_mtime integer,
+                gsd_mtime integer,
+                percentiles_mtime integer,
+                output_mtime integer,
+                outputs text,
+                outputs_key text);
+            ''')
+        return
+
+    def close (self):
+        '''
+        method to close the index file
+        '''
+        self.db.close ()
+        return
+
+    def refresh (self, base_dir):
+        '''
+        method to bring the index up to date for a tree. Directories are only listed
+        again if their modification time has changed, and the config, image and
+        output files of each sample are checked with a stat.
+        base_dir = base directory of the tree
+        '''
+        base_dir = os.path.abspath (base_dir)
+        known = dict ()
+        prefix = os.path.join (base_dir, '')
+        for row in self.db.execute ('select * from dirs where path = ? or substr (path, 1, ?) = ?',
+                                    (base_dir, len (prefix), prefix)):
+            known[row['path']] = row
+
+        # the defaults files above the tree (their modification times, top down)
+        inherited = []
+        parent = os.path.dirname (base_dir)
+        while True:
+            m = _mtime (os.path.join (parent, defaults_file_name))
+            if m is not None:
+                inherited.insert (0, m)
+            if os.path.dirname (parent) == parent:
+                break
+            parent = os.path.dirname (parent)
+        inherited = tuple (inherited)
+
+        seen = set ()
+        stack = [(base_dir, inherited)]
+        with self.db:
+            while stack:
+                path, inherited = stack.pop ()
+                try:
+                    mtime = os.stat (path).st_mtime_ns
+                except OSError:
+                    continue
+                seen.add (path)
+
+                # list the directory only if it has changed
+                row = known.get (path)
+                if row is not None and row['mtime'] == mtime:
+                    subdirs = json.loads (row['subdirs'])
+                    files = json.loads (row['files'])
+                else:
+                    subdirs = []
+                    files = []
+                    for entry in os.scandir (path):
+                        if entry.is_dir ():
+                            if entry.name not in skip_dirs:
+                                subdirs.append (entry.name)
+                        else:
+                            files.append (entry.name)
+                    subdirs.sort ()
+                    files.sort ()
+                    self.db.execute ('insert or replace into dirs values (?, ?, ?, ?)',
+                                     (path, mtime, json.dumps (subdirs), json.dumps (files)))
+
+                if defaults_file_name in files:
+                    m = _mtime (os.path.join (path, defaults_file_name))
+                    if m is not None:
+                        inherited = inherited + (m,)
+                stack.extend ((os.path.join (path, s), inherited) for s in reversed (subdirs))
+
+                # update the sample if there is a config file here
+                if files.count ('config.txt') == 1:
+                    self.update_sample (path, files, inherited)
+                else:
+                    self.db.execute ('delete from samples where directory = ?', (path,))
+
+            # forget the directories that have gone
+            for path in known:
+                if path not in seen:
+                    self.db.execute ('delete from dirs where path = ?', (path,))
+                    self.db.execute ('delete from samples where directory = ?', (path,))
+
+        return
+
+    def update_sample (self, directory, files, defaults_mtimes = ()):
+        '''
+        method to update the index entry of a sample directory
+        directory = the sample directory
+        files = the files in the directory
+        defaults_mtimes = the modification times of the defaults files that apply to
+                          the sample (its config time is the latest of these and its
+                          config.txt)
+        '''
+        images = [f for f in files if is_image (f)]
+        image_mtimes = [_mtime (os.path.join (directory, i)) for i in images]
+        image_mtimes = [m for m in image_mtimes if m is not None]
+        config_mtime = _mtime (os.path.join (directory, 'config.txt'))
+
+        # the output files (those of each region of interest) only change with the
+        # config, so the config is only resolved again when one of its files has
+        outputs_key = json.dumps ([config_mtime] + list (defaults_mtimes))
+        row = self.db.execute ('select outputs, outputs_key from samples where directory = ?',
+                               (directory,)).fetchone ()
+        if row is not None and row['outputs_key'] == outputs_key:
+            outputs = tuple (json.loads (row['outputs']))
+        else:
+            outputs = _sample_outputs (directory)
+
+        # stats, gsd and percentiles, each over the regions of interest (the outputs
+        # of each region are in the order of output_files): the oldest of each for
+        # the stale check, and the newest of all for the time the results changed
+        n = len (output_files)
+        output_mtimes = [_output_mtimes (directory, files, outputs[k::n]) for k in range (n)]
+        newest = None
+        for oldest, m in output_mtimes:
+            newest = _latest (newest, m)
+
+        for m in defaults_mtimes:
+            config_mtime = _latest (config_mtime, m)
+        self.db.execute ('insert or replace into samples values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (directory, json.dumps (images), config_mtime,
+                          max (image_mtimes) if image_mtimes else None,
+                          output_mtimes[0][0], output_mtimes[1][0], output_mtimes[2][0],
+                          newest, json.dumps (list (outputs)), outputs_key))
+        return
+
+    def samples (self, base_dir, stale_only = False):
+        '''
+        method to get the samples in a tree from the index (call refresh first).
+        Returns a list of dicts with the directory, the full image names, whether
+        the sample is stale, and the latest config or output file mtime (ns), which
+        changes when any output is written again (e.g. one region of interest).
+        base_dir = base directory of the tree
+        stale_only = only return the stale samples (see is_stale)
+        '''
+        base_dir = os.path.abspath (base_dir)
+        prefix = os.path.join (base_dir, '')
+        res = []
+        for row in self.db.execute ('select * from samples where directory = ? or '
+                                    'substr (directory, 1, ?) = ? order by directory',
+                                    (base_dir, len (prefix), prefix)):
+            stale = self.is_stale (row)
+            if stale_only and not stale:
+                continue
+            mtimes = [row[k] for k in ('config_mtime', 'output_mtime') if row[k] is not None]
+            res.append (dict (directory = row['directory'],
+                              images = [os.path.join (row['directory'], i)
+                                        for i in json.loads (row['images'])],
+                              stale = stale,
+                              mtime = max (mtimes) if mtimes else None))
+        return (res)
+
+    def is_stale (self, row):
+        '''
+        method to check if a sample is stale: an output file is missing, or the
+        config or image is newer than the outputs (the output files of every region,
+        for a sample with regions of interest)
+        row = the samples table row
+        '''
+        outputs = (row['stats_mtime'], row['gsd_mtime'], row['percentiles_mtime'])
+        if None in outputs:
+            return True
+        inputs = [m for m in (row['config_mtime'], row['image_mtime']) if m is not None]
+        return (len (inputs) > 0 and max (inputs) > min (outputs))
+
+def find_samples (base_dir, stale_only = False, index_file = default_index_file):
+    '''
+    function to refresh the index for a tree and get the samples in it. This is
+    what the tree functions use in place of walking the tree.
+    base_dir = base directory of the tree
+    stale_only = only return the stale samples
+    index_file = the sqlite index file name
+    '''
+    idx = sample_index (index_file)
+    try:
+        idx.refresh (base_dir)
+        res = idx.samples (base_dir, stale_only)
+    finally:
+        idx.close ()
+    return (res)
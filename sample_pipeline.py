@@ -0,0 +1,202 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# sample_pipeline: run the whole per-sample chain (undistort, greyscale, CLAHE
+#                  and the grainsize analysis) from a single decode of the image,
+#                  passing the arrays between the stages in memory. A sample
+#                  with regions of interest (rois in the config) has each
+#                  region cut out of the single decode, and only the pixels
+#                  of the regions are unwarped; the clahe and the analysis run
+#                  per region, with a result for each.
+
+import os
+import sys
+import cv2
+import numpy as np
+
+from distortion_calibration import distortion_calibration
+from dgs_analysis import dgs_analysis
+from instrumentation import timer
+from decode_planner import read_grey
+from sample_cache import deblur_params, parse_rois
+from config_resolver import resolve_config
+
+class sample_pipeline:
+    def __init__ (self, image_file, scales, calibrate = None, write_intermediates = False,
+                  cache = None, store = None, reduce = False):
+        '''
+        constructor takes the file name of the raw (or calibrated) image
+        image_file = the input image name
+        scales = input scales for analysis (a numpy array)
+        calibrate = unwarp the image in memory (None decides from the config file: yes
+                    if there is a calibration_file, used_calibrated is not 'no' and
+                    the image is not already a calibrated '_c.JPG' image)
+        write_intermediates = write the calibrated and clahe images to disk as
+                              the file based workflow does
+        cache = a sample_cache to get and keep the clahe image in (optional)
+        store = where to put the results in place of the output files (optional,
+                see dgs_analysis)
+        reduce = decode the image at a reduced size if the scales allow it (see
+                 decode_planner), the unwarp maps are scaled to match
+        '''
+        self.image_file = image_file
+        self.scales = scales
+        self.write_intermediates = write_intermediates
+        self.cache = cache
+
+        # the analysis object reads the config file and writes the outputs
+        self.gs = dgs_analysis (image_file, scales, store, reduce)
+        self.config = self.gs.config if not self.gs.config_file_error else dict ()
+
+        # an analysis object for each region of interest (or the one for the image)
+        self.rois = parse_rois (self.config)
+        if len (self.rois) > 0:
+            self.analyses = [dgs_analysis (image_file, scales, store, reduce, name)
+                             for name, box in self.rois]
+        else:
+            self.analyses = [self.gs]
+
+        if calibrate is None:
+            calibrate = ('calibration_file' in self.config and
+                         str (self.config.get ('used_calibrated', 'yes')) != 'no' and
+                         not image_file.endswith ('_c.JPG'))
+        self.calibrate = calibrate
+
+        return
+
+    def run (self):
+        '''
+        method to run the pipeline: decode once, then everything is in memory
+        '''
+        img = self.read ()
+        if img is None:
+            return
+
+        self.prepare (img)
+        for gs in self.analyses:
+            gs.run ()
+        return
+
+    def read (self):
+        '''
+        method to get the image for the analysis: the clahe image from the cache, or
+        a single decode of the image (at the planned size) unwarped in memory.
+        Returns the image (a list of the region images for a sample with regions of
+        interest), or None if the config file or the image cannot be read.
+        '''
+        self.cached = False
+        if self.gs.config_file_error:
+            print ('ERROR: cannot run the pipeline without a config file: ' + self.image_file)
+            return (None)
+
+        factor = self.gs.decode_factor
+
+        # the clahe image only depends on the image, the unwarp, the clahe dims, the
+        # deblur and the decode size
+        if self.cache is not None:
+            params = (self.calibrate, self.config.get ('calibration_file'),
+                      self.config.get ('clahe_dims')) + deblur_params (self.config)
+            if factor > 1:
+                params = params + (factor,)
+            if len (self.rois) > 0:
+                self.clahe_keys = [self.cache.stage_key (self.image_file, 'clahe', params + (list (box),))
+                                   for name, box in self.rois]
+            else:
+                self.clahe_keys = [self.cache.stage_key (self.image_file, 'clahe', params)]
+            with timer ('cache_get'):
+                clahe_imgs = [self.cache.get_array (k, 'clahe.npy') for k in self.clahe_keys]
+            if all (i is not None for i in clahe_imgs):
+                self.cached = True
+                return (clahe_imgs if len (self.rois) > 0 else clahe_imgs[0])
+
+        # single decode, straight to greyscale (the unwarp commutes with the
+        # greyscale conversion, so this saves two thirds of the unwarp work),
+        # at a reduced size if planned
+        with timer ('decode'):
+            img = read_grey (self.image_file, factor)
+        if img is None:
+            print ('ERROR: cannot read the image file: ' + self.image_file)
+            return (None)
+
+        # cut out (and unwarp) the regions, the rest of the image is not used
+        if len (self.rois) > 0:
+            return (self.cut_rois (img, factor))
+
+        # unwarp (a reduced image is not written as the calibrated image)
+        if self.calibrate:
+            dst = distortion_calibration (self.image_file)
+            img = dst.undistort (img, factor)
+            if self.write_intermediates and factor == 1:
+                cv2.imwrite (dst.out_image_file, img)
+
+        return (img)
+
+    def cut_rois (self, img, factor):
+        '''
+        method to cut the regions of interest out of the decoded image. With the
+        unwarp, only the pixels of each region are unwarped (with maps for the
+        region, see calibration_registry.get_maps), so the regions are the same as
+        cutting them out of the whole calibrated image. Returns the list of region
+        images. Raises ValueError for a region that is not inside the image.
+        img = the decoded greyscale image
+        factor = the reduction factor the image was decoded at
+        '''
+        h, w = img.shape[:2]
+        dst = distortion_calibration (self.image_file) if self.calibrate else None
+        res = []
+        for name, box in self.rois:
+            x, y, bw, bh = [v // factor for v in box]
+            if x + bw > w or y + bh > h:
+                raise ValueError ('roi ' + name + ' is not inside the image: ' + self.image_file)
+            if dst is not None:
+                res.append (dst.undistort (img, factor, (x, y, bw, bh)))
+            else:
+                # a copy, the deblur writes over the image and regions can overlap
+                res.append (img[y:y + bh, x:x + bw].copy ())
+        return (res)
+
+    def prepare (self, img):
+        '''
+        method to hand the image from read to the analysis and run the clahe on it
+        (unless it came from the cache), ready for the grainsize analysis
+        img = the image from read
+        '''
+        images = img if len (self.rois) > 0 else [img]
+        for k, (gs, image) in enumerate (zip (self.analyses, images)):
+            gs.load_image (image, self.gs.decode_factor)
+            if self.cached:
+                continue
+
+            # the region clahe images are not written, they are only in memory
+            gs.run_CLAHE (write_image = self.write_intermediates and len (self.rois) == 0)
+            if self.cache is not None:
+                self.cache.put_array (self.clahe_keys[k], 'clahe.npy', gs.image)
+        return
+
+def has_rois (image_file):
+    '''
+    function to check if the config of a sample has regions of interest (these are
+    analysed by the in-memory pipeline)
+    image_file = the image in the sample directory
+    '''
+    try:
+        config = resolve_config (os.path.join (os.path.dirname (image_file), 'config.txt'))
+    except Exception:
+        return (False)
+    return (bool (config.get ('rois')))
@@ -0,0 +1,130 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# tests for config_resolver: the defaults files from the top down, the config.txt
+# of the sample over them, and bulk edits
+#     python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+import config_resolver
+from config_resolver import resolve_config, write_config, set_config, parse_file, collapse_configs
+from sample_index import find_samples, defaults_file_name
+
+def write_text (file_name, text):
+    '''
+    function to write a text file, making its directory
+    '''
+    if not os.path.isdir (os.path.dirname (file_name)):
+        os.makedirs (os.path.dirname (file_name))
+    with open (file_name, 'w') as f:
+        f.write (text)
+    return (file_name)
+
+class test_config_resolver (unittest.TestCase):
+    def setUp (self):
+        self.tmp_dir = tempfile.mkdtemp (prefix = 'photoseive_test_')
+        self.base_dir = os.path.join (self.tmp_dir, 'campaign')
+        self.site_dir = os.path.join (self.base_dir, 'site_a')
+        write_text (os.path.join (self.base_dir, defaults_file_name),
+                    'resolution: 0.1\nnotes: 8\ndensity: 10\n')
+        write_text (os.path.join (self.site_dir, defaults_file_name), 'notes: 4\n')
+        self.config_files = [write_text (os.path.join (self.site_dir, 'image_1', 'config.txt'),
+                                         'density: 5\n'),
+                             write_text (os.path.join (self.base_dir, 'image_2', 'config.txt'),
+                                         'notes: 16\n')]
+
+        # the tree functions use their own index, not the one in ~/.photoseive
+        index_file = os.path.join (self.tmp_dir, 'sample_index.sqlite')
+        patcher = mock.patch.object (config_resolver, 'find_samples',
+                                     lambda base_dir: find_samples (base_dir, index_file = index_file))
+        patcher.start ()
+        self.addCleanup (patcher.stop)
+        return
+
+    def tearDown (self):
+        shutil.rmtree (self.tmp_dir)
+        return
+
+    def test_nearer_file_wins (self):
+        self.assertEqual (resolve_config (self.config_files[0]),
+                          {'resolution': 0.1, 'notes': 4, 'density': 5})
+        self.assertEqual (resolve_config (self.config_files[1]),
+                          {'resolution': 0.1, 'notes': 16, 'density': 10})
+        return
+
+    def test_resolved_config_is_a_copy (self):
+        resolve_config (self.config_files[0])['density'] = 1
+        self.assertEqual (resolve_config (self.config_files[0])['density'], 5)
+        return
+
+    def test_write_config_keeps_the_differences (self):
+        config = resolve_config (self.config_files[0])
+        config['minscale'] = 3.14
+        write_config (self.config_files[0], config)
+        self.assertEqual (parse_file (self.config_files[0]), {'density': 5, 'minscale': 3.14})
+        self.assertEqual (resolve_config (self.config_files[0]), config)
+
+        # a value back at the inherited one is taken out
+        config['density'] = 10
+        write_config (self.config_files[0], config)
+        self.assertEqual (parse_file (self.config_files[0]), {'minscale': 3.14})
+        return
+
+    def test_set_config_overrides (self):
+        written = set_config (self.base_dir, 'notes', 12)
+        self.assertEqual (written, 3)
+        for config_file in self.config_files:
+            self.assertEqual (resolve_config (config_file)['notes'], 12)
+        self.assertEqual (parse_file (os.path.join (self.site_dir, defaults_file_name)), dict ())
+        self.assertEqual (parse_file (self.config_files[0]), {'density': 5})
+        return
+
+    def test_set_config_keeps_lower_values (self):
+        written = set_config (self.base_dir, 'notes', 12, override = False)
+        self.assertEqual (written, 1)
+        self.assertEqual (resolve_config (self.config_files[0])['notes'], 4)
+        self.assertEqual (resolve_config (self.config_files[1])['notes'], 16)
+        self.assertEqual (parse_file (os.path.join (self.base_dir, defaults_file_name))['notes'], 12)
+        return
+
+    def test_collapse (self):
+        config_file = write_text (os.path.join (self.site_dir, 'image_3', 'config.txt'),
+                                  'density: 5\nnotes: 16\n')
+        write_text (self.config_files[1], 'notes: 16\ndensity: 5\n')
+        write_text (self.config_files[0], 'density: 5\nnotes: 16\n')
+        before = [resolve_config (f) for f in self.config_files + [config_file]]
+
+        self.assertEqual (collapse_configs (self.base_dir), ['density', 'notes', 'resolution'])
+        self.assertEqual ([resolve_config (f) for f in self.config_files + [config_file]], before)
+        for f in self.config_files + [config_file]:
+            self.assertEqual (parse_file (f), dict ())
+        self.assertEqual (parse_file (os.path.join (self.base_dir, defaults_file_name)),
+                          {'resolution': 0.1, 'notes': 16, 'density': 5})
+        return
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,165 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# tests for deblur: the highpass worked out in the frequency domain matches the
+# spatial circular mean filter (cv2.filter2D), for every radius and tint, and the
+# highpass worked out in strips matches the whole image, within a bounded cache
+#     python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import cv2
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+import deblur
+
+def test_image (shape, seed = 0):
+    '''
+    function to make a smooth random uint8 image with some sharp edges
+    shape = the image shape (rows x columns, or rows x columns x channels)
+    seed = the random seed
+    '''
+    rng = np.random.default_rng (seed)
+    image = cv2.GaussianBlur (rng.uniform (0, 255, shape).astype (np.float32), (0, 0), 2.0)
+    image[shape[0] // 3:shape[0] // 2] = image[shape[0] // 3:shape[0] // 2] * 0.5
+    return (np.clip (image, 0, 255).astype (np.uint8))
+
+def spatial_average (frame, radius):
+    '''
+    function to get the circular mean with the spatial filter (float64)
+    frame = the image
+    radius = the circular radius in pixels
+    '''
+    return (cv2.filter2D (frame.astype (np.float64), -1, deblur.disk_kernel (radius)))
+
+def spatial_highpass (frame, radius, tint):
+    '''
+    function to get the tinted highpass with the spatial filter
+    frame = the image
+    radius = the circular radius in pixels
+    tint = from 0 (the highpass) to 1 (the image)
+    '''
+    avg = np.rint (spatial_average (frame, radius))
+    return (np.clip (frame - (1.0 - tint) * avg, 0, 255).astype (np.uint8))
+
+class test_frequency_domain (unittest.TestCase):
+    def test_average (self):
+        frame = test_image ((97, 130))
+        engine = deblur.highpass_engine (frame, 12)
+        for radius in (1.5, 5, 12):
+            avg = engine.average (radius)
+            self.assertEqual (avg.shape, frame.shape)
+            np.testing.assert_allclose (avg, spatial_average (frame, radius), atol = 1e-2)
+        return
+
+    def test_colour_average (self):
+        frame = test_image ((64, 80, 3), seed = 1)
+        avg = deblur.highpass_engine (frame, 7).average (7)
+        self.assertEqual (avg.shape, frame.shape)
+        np.testing.assert_allclose (avg, spatial_average (frame, 7), atol = 1e-2)
+        return
+
+    def test_highpass (self):
+        frame = test_image ((120, 90, 3), seed = 2)
+        out = deblur.deblur (frame).tinted_highpass (8, 0.3)
+        diff = np.abs (out.astype (int) - spatial_highpass (frame, 8, 0.3).astype (int))
+        self.assertLessEqual (diff.max (), 1)        # rounding of a mean at .5
+        self.assertLess (np.mean (diff > 0), 0.01)
+        return
+
+    def test_variants (self):
+        frame = test_image ((80, 100), seed = 3)
+        res = deblur.deblur (frame).highpass_variants ([3, 9], [0.0, 0.5, 1.0])
+        self.assertEqual (sorted (res.keys ()),
+                          [(3, 0.0), (3, 0.5), (3, 1.0), (9, 0.0), (9, 0.5), (9, 1.0)])
+        for (radius, tint), out in res.items ():
+            diff = np.abs (out.astype (int) - spatial_highpass (frame, radius, tint).astype (int))
+            self.assertLessEqual (diff.max (), 1)
+        np.testing.assert_array_equal (res[(9, 1.0)], frame)
+        return
+
+class test_lean_highpass (unittest.TestCase):
+    def setUp (self):
+        self.base_dir = tempfile.mkdtemp (prefix = 'photoseive_test_')
+        return
+
+    def tearDown (self):
+        shutil.rmtree (self.base_dir)
+        return
+
+    def assert_close (self, out, expected):
+        diff = np.abs (out.astype (int) - expected.astype (int))
+        self.assertLessEqual (diff.max (), 1)        # rounding of a mean at .5
+        self.assertLess (np.mean (diff > 0), 0.01)
+        return
+
+    def test_strips_match_whole (self):
+        frame = test_image ((300, 120), seed = 4)
+        whole = deblur.highpass_engine (frame, 6)
+        expected = deblur.tint_highpass (frame, whole.average (6), 0.2)
+        max_bytes = 16 * 128 * deblur.strip_bytes_per_pixel * 8     # strips of a few rows
+        self.assert_close (deblur.lean_highpass (frame, 6, 0.2, max_bytes), expected)
+        self.assert_close (deblur.lean_highpass (frame, 6, 0.2), expected)
+        return
+
+    def test_in_place (self):
+        frame = test_image ((200, 90, 3), seed = 5)
+        expected = deblur.lean_highpass (frame, 4, 0.0, 200000)
+        out = deblur.lean_highpass (frame, 4, 0.0, 200000, out = frame)
+        self.assertIs (out, frame)
+        np.testing.assert_array_equal (frame, expected)
+        return
+
+    def test_spectrum_cache_bounded (self):
+        frame = test_image ((64, 64), seed = 6)
+        cache_bytes = 3 * 64 * 64 * 4
+        for radius in (2, 3, 4, 5, 6, 7):
+            deblur.highpass_engine (frame, 8).average (radius, cache_bytes)
+            self.assertLessEqual (deblur._spectrum_cache_bytes, cache_bytes)
+        self.assertEqual (deblur._spectrum_cache_bytes,
+                          sum (s.nbytes for s in deblur._spectrum_cache.values ()))
+        return
+
+    def test_batch (self):
+        image_files = []
+        for n in range (3):
+            sample_dir = os.path.join (self.base_dir, 'image_' + str (n))
+            os.mkdir (sample_dir)
+            image_files.append (os.path.join (sample_dir, 'image.png'))
+            cv2.imwrite (image_files[-1], test_image ((60, 80, 3), seed = n))
+        image_files.append (os.path.join (self.base_dir, 'missing.png'))
+
+        out_files = deblur.deblur_batch (image_files, 5, jobs = 2)
+        self.assertIsNone (out_files[-1])
+        for image_file, out_file in zip (image_files[:-1], out_files[:-1]):
+            self.assertEqual (out_file, os.path.join (os.path.dirname (image_file),
+                                                      deblur.deblur_image_name))
+            grey = cv2.imread (image_file, cv2.IMREAD_GRAYSCALE)
+            out = cv2.imread (out_file, cv2.IMREAD_GRAYSCALE)
+            self.assertEqual (out.shape, grey.shape)
+        return
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,78 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# tests for decode_planner: the reduction factor from the scales (grain sizes) and
+# the resolution
+#     python -m unittest discover tests
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+from decode_planner import plan_decode_factor, reduced_config
+from run_dgs_analysis import default_scales
+
+class test_decode_planner (unittest.TestCase):
+    def test_default_scales (self):
+        # the finest scale, 0.02, is 2 pixels at resolution 0.01
+        config = {'resolution': 0.01, 'minscale': 0}
+        self.assertEqual (plan_decode_factor (config, default_scales ()), 1)
+        return
+
+    def test_minscale_allows_a_reduction (self):
+        # the finest scale analysed is 8 pixels, still 2 pixels at 1/4 size
+        config = {'resolution': 0.01, 'minscale': 8}
+        self.assertEqual (plan_decode_factor (config, default_scales ()), 4)
+        return
+
+    def test_coarser_resolution (self):
+        # 0.02 at resolution 0.001 is 20 pixels
+        config = {'resolution': 0.001, 'minscale': 0}
+        self.assertEqual (plan_decode_factor (config, default_scales ()), 8)
+        self.assertEqual (plan_decode_factor (config, default_scales (), max_factor = 2), 2)
+        return
+
+    def test_no_scales (self):
+        self.assertEqual (plan_decode_factor ({'resolution': 0.01}, None), 1)
+        config = {'resolution': 0.01, 'minscale': 1000}
+        self.assertEqual (plan_decode_factor (config, default_scales ()), 1)
+        return
+
+    def test_reduced_config (self):
+        config = {'resolution': 0.01, 'minscale': 8, 'density': 10}
+        scales = default_scales ()
+        reduced, reduced_scales = reduced_config (config, scales, 4)
+        self.assertAlmostEqual (reduced['resolution'], 0.04)
+        self.assertAlmostEqual (reduced['minscale'], 2.0)
+        self.assertEqual (reduced['density'], 2)
+        self.assertIs (reduced_scales, scales)
+        self.assertEqual (config['resolution'], 0.01)
+
+        # the same scales are analysed (in pixels, above minscale) in the reduced image
+        full = scales / config['resolution']
+        small = scales / reduced['resolution']
+        np.testing.assert_array_equal (full >= config['minscale'],
+                                       small >= reduced['minscale'])
+        return
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,164 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# tests for lease_queue: claims and takeovers from several local processes
+#     python -m unittest discover tests
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+from lease_queue import lease_queue, task_id
+
+def claim_expired (queue_dir, tid, start, results):
+    '''
+    function run in each claiming process: wait for the start, then try to take the
+    expired lease over
+    '''
+    q = lease_queue (queue_dir, lease_seconds = 60)
+    start.wait ()
+    results.put (q.claim (tid))
+    return
+
+def work_tasks (queue_dir, out_dir):
+    '''
+    function run in each worker process: work the queue, each task makes a marker
+    file that cannot be made twice (so a task run twice fails)
+    '''
+    q = lease_queue (queue_dir, lease_seconds = 60, poll_seconds = 0.05)
+    def func (task):
+        with open (os.path.join (out_dir, task_id (task)), 'x') as f:
+            f.write (q.worker)
+        time.sleep (0.01)
+    q.work (func)
+    return
+
+def write_lease (q, tid, worker, age):
+    '''
+    function to write a lease file as another worker would, age seconds old
+    '''
+    lease_file = q.file_name ('leases', tid)
+    with open (lease_file, 'w') as f:
+        json.dump (dict (worker = worker, claimed = time.time () - age, attempts = 1), f)
+    t = time.time () - age
+    os.utime (lease_file, (t, t))
+    return (lease_file)
+
+class race_queue (lease_queue):
+    def read_lease (self, lease_file):
+        '''
+        a fresh takeover by another worker lands between this worker's age check and
+        its rename (on the first read of the expired lease)
+        '''
+        if not getattr (self, 'raced', False) and lease_file.endswith (self.race_tid):
+            self.raced = True
+            res = lease_queue.read_lease (self, lease_file)
+            write_lease (self, self.race_tid, 'other-worker', 0)
+            return (res)
+        return (lease_queue.read_lease (self, lease_file))
+
+class test_lease_queue (unittest.TestCase):
+    def setUp (self):
+        self.tmp_dir = tempfile.mkdtemp (prefix = 'photoseive_test_')
+        self.queue_dir = os.path.join (self.tmp_dir, 'queue')
+        self.context = multiprocessing.get_context ('spawn')
+        return
+
+    def tearDown (self):
+        shutil.rmtree (self.tmp_dir)
+        return
+
+    def test_claim_is_exclusive (self):
+        q = lease_queue (self.queue_dir)
+        self.assertTrue (q.claim ('t1'))
+        self.assertFalse (lease_queue (self.queue_dir).claim ('t1'))
+        return
+
+    def test_one_process_takes_over_an_expired_lease (self):
+        q = lease_queue (self.queue_dir, lease_seconds = 60)
+        for k in range (5):
+            tid = 'expired' + str (k)
+            write_lease (q, tid, 'dead-worker', 600)
+            start = self.context.Event ()
+            results = self.context.Queue ()
+            procs = [self.context.Process (target = claim_expired,
+                                           args = (self.queue_dir, tid, start, results))
+                     for i in range (4)]
+            for p in procs:
+                p.start ()
+            start.set ()
+            for p in procs:
+                p.join (60)
+            claims = [results.get (timeout = 10) for p in procs]
+            self.assertEqual (claims.count (True), 1)
+        return
+
+    def test_fresh_takeover_is_put_back (self):
+        q = race_queue (self.queue_dir, lease_seconds = 60)
+        q.race_tid = 'raced'
+        write_lease (q, 'raced', 'dead-worker', 600)
+        self.assertFalse (q.claim ('raced'))
+        self.assertEqual (q.read_lease (q.file_name ('leases', 'raced'))['worker'], 'other-worker')
+        return
+
+    def test_lost_lease_is_not_completed (self):
+        q = lease_queue (self.queue_dir, lease_seconds = 60, poll_seconds = 0.05)
+        q.create (['task'])
+        tid = task_id ('task')
+        q.fail = lambda *args: self.fail ('a lost task was marked failed')
+        def func (task):
+            # another worker takes the lease over while this one works
+            os.unlink (q.file_name ('leases', tid))
+            write_lease (q, tid, 'other-worker', 0)
+            # stop the work loop after this task
+            with open (q.file_name ('done', tid), 'w') as f:
+                f.write ('other-worker')
+        completed, failed = q.work (func)
+        self.assertEqual (completed, [])
+        self.assertEqual (failed, [])
+        return
+
+    def test_two_workers_run_each_task_once (self):
+        out_dir = os.path.join (self.tmp_dir, 'out')
+        os.makedirs (out_dir)
+        tasks = ['image_' + str (i) for i in range (30)]
+        lease_queue (self.queue_dir).create (tasks)
+
+        procs = [self.context.Process (target = work_tasks, args = (self.queue_dir, out_dir))
+                 for i in range (2)]
+        for p in procs:
+            p.start ()
+        for p in procs:
+            p.join (120)
+
+        status = lease_queue (self.queue_dir).status ()
+        self.assertEqual (status['done'], len (tasks))
+        self.assertEqual (status['failed'], 0)
+        self.assertEqual (sorted (os.listdir (out_dir)), sorted (task_id (t) for t in tasks))
+        return
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,135 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# tests for make_photodirs: linked and copied samples, reruns that change nothing,
+# and images in any case found by the sample index
+#     python -m unittest discover tests
+
+import os
+import io
+import sys
+import shutil
+import tempfile
+import unittest
+import contextlib
+from unittest import mock
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+import make_photodirs
+from sample_index import find_samples, is_image
+
+class test_make_photodirs (unittest.TestCase):
+    def setUp (self):
+        self.tmp_dir = tempfile.mkdtemp (prefix = 'photoseive_test_')
+        self.source_dir = os.path.join (self.tmp_dir, 'card')
+        self.target_dir = os.path.join (self.tmp_dir, 'tree')
+        os.makedirs (self.source_dir)
+        os.makedirs (self.target_dir)
+        self.names = ['DSC_0001.JPG', 'dsc_0002.jpg', 'dsc_0003.Jpeg']
+        for n, name in enumerate (self.names + ['notes.txt']):
+            with open (os.path.join (self.source_dir, name), 'wb') as f:
+                f.write (bytes ([n]) * 1000)
+
+        # the tree functions use their own index, not the one in ~/.photoseive
+        self.index_file = os.path.join (self.tmp_dir, 'sample_index.sqlite')
+        patcher = mock.patch.object (make_photodirs, 'find_samples',
+                                     lambda base_dir: find_samples (base_dir, index_file = self.index_file))
+        patcher.start ()
+        self.addCleanup (patcher.stop)
+        return
+
+    def tearDown (self):
+        shutil.rmtree (self.tmp_dir)
+        return
+
+    def run_photodirs (self, method):
+        with contextlib.redirect_stdout (io.StringIO ()) as out:
+            key = make_photodirs.make_photodirs (self.target_dir, None, self.source_dir, 2, method)
+        return (key, out.getvalue ())
+
+    def sample_image (self, name):
+        return (os.path.join (self.target_dir, 'image_' + os.path.splitext (name)[0], name))
+
+    def test_link (self):
+        key, out = self.run_photodirs ('link')
+        self.assertEqual (sorted (key['name']), sorted (self.names))
+        for name in self.names:
+            self.assertTrue (os.path.samefile (self.sample_image (name),
+                                               os.path.join (self.source_dir, name)))
+            self.assertTrue (os.path.isfile (os.path.join (os.path.dirname (self.sample_image (name)),
+                                                           'config.txt')))
+        self.assertIn ('hardlink 3', out)
+
+        key, out = self.run_photodirs ('link')
+        self.assertEqual (len (key), 3)
+        self.assertIn ('complete! exists 3', out)
+        return
+
+    def test_copy (self):
+        self.run_photodirs ('copy')
+        config_file = os.path.join (os.path.dirname (self.sample_image (self.names[0])), 'config.txt')
+        with open (config_file, 'w') as f:
+            f.write ('density: 5\n')
+
+        key, out = self.run_photodirs ('copy')
+        self.assertIn ('complete! exists 3', out)
+        with open (config_file) as f:
+            self.assertEqual (f.read (), 'density: 5\n')      # kept on a rerun
+        for name in self.names:
+            self.assertFalse (os.path.samefile (self.sample_image (name),
+                                                os.path.join (self.source_dir, name)))
+            with open (self.sample_image (name), 'rb') as a, \
+                 open (os.path.join (self.source_dir, name), 'rb') as b:
+                self.assertEqual (a.read (), b.read ())
+        return
+
+    def test_interrupted_copy (self):
+        sample_image = self.sample_image (self.names[1])
+        os.makedirs (os.path.dirname (sample_image))
+        with open (sample_image + '.tmp', 'wb') as f:
+            f.write (b'partial')
+        self.run_photodirs ('copy')
+        self.assertFalse (os.path.exists (sample_image + '.tmp'))
+        self.assertEqual (os.path.getsize (sample_image), 1000)
+        return
+
+    def test_index_finds_any_case (self):
+        self.run_photodirs ('link')
+        samples = find_samples (self.target_dir, index_file = self.index_file)
+        self.assertEqual (sorted (os.path.basename (s['images'][0]) for s in samples),
+                          sorted (self.names))
+
+        with contextlib.redirect_stdout (io.StringIO ()) as out:
+            key = make_photodirs.make_key_dataframe (self.target_dir,
+                                                     os.path.join (self.tmp_dir, 'key.csv'))
+        self.assertNotIn ('ERROR', out.getvalue ())
+        self.assertEqual (sorted (key['name']), sorted (self.names))
+        return
+
+    def test_is_image (self):
+        for name in ('a.jpg', 'a.JPG', 'a.jpeg', 'a.JPEG', 'a.JpG', '/data/x/a.jpg'):
+            self.assertTrue (is_image (name))
+        for name in ('a.png', 'a.jpg.tmp', 'config.txt', 'jpg'):
+            self.assertFalse (is_image (name))
+        return
+
+if __name__ == '__main__':
+    unittest.main ()
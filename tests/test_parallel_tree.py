@@ -0,0 +1,92 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# tests for parallel_tree: failed tasks are collected, in this process and in
+# the worker pool, and a dead worker does not stop the run
+#     python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+from parallel_tree import run_parallel, thread_env_vars
+
+def square (x):
+    '''
+    function run as a task: raises for a negative number
+    '''
+    if x < 0:
+        raise ValueError ('negative task')
+    return (x * x)
+
+def die (x):
+    '''
+    function run as a task: the worker process exits (as if the oom killer took it)
+    for a negative number
+    '''
+    if x < 0:
+        os._exit (1)
+    return (x * x)
+
+class test_parallel_tree (unittest.TestCase):
+    def run_tasks (self, func, values, jobs):
+        '''
+        method to run the tasks, returning (results by name, failed names)
+        '''
+        results = dict ()
+        failures = run_parallel (func, [(v,) for v in values], jobs,
+                                 names = ['task' + str (v) for v in values],
+                                 on_result = lambda name, res: results.__setitem__ (name, res))
+        return (results, sorted (name for name, message in failures))
+
+    def test_serial_failures_are_collected (self):
+        results, failed = self.run_tasks (square, [1, -2, 3], 1)
+        self.assertEqual (results, {'task1': 1, 'task3': 9})
+        self.assertEqual (failed, ['task-2'])
+        return
+
+    def test_pool_failures_are_collected (self):
+        results, failed = self.run_tasks (square, [1, -2, 3, 4], 2)
+        self.assertEqual (results, {'task1': 1, 'task3': 9, 'task4': 16})
+        self.assertEqual (failed, ['task-2'])
+        return
+
+    def test_dead_worker_does_not_stop_the_run (self):
+        values = [1, 2, -3, 4, 5, 6, 7, 8]
+        results, failed = self.run_tasks (die, values, 2)
+
+        # the task that killed its worker fails (and maybe the one running beside
+        # it), every other task runs in a new pool
+        self.assertIn ('task-3', failed)
+        self.assertLessEqual (len (failed), 2)
+        self.assertEqual (sorted (list (results) + failed), sorted ('task' + str (v) for v in values))
+        for name, res in results.items ():
+            self.assertEqual (res, int (name[4:])**2)
+        return
+
+    def test_thread_limits_are_put_back (self):
+        saved = dict ((var, os.environ.get (var)) for var in thread_env_vars)
+        self.run_tasks (square, [1, 2], 2)
+        self.assertEqual (saved, dict ((var, os.environ.get (var)) for var in thread_env_vars))
+        return
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,118 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# tests for the photoseive command line: each subcommand reaches its function with
+# its arguments, and the bench arguments reach benchmark.py in the order given
+#     python -m unittest discover tests
+
+import os
+import io
+import sys
+import types
+import unittest
+import contextlib
+from unittest import mock
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+import photoseive
+
+def fake_module (name, **functions):
+    '''
+    function to make a module of mocks, put in place of a pipeline module so the
+    command line is tested without running anything
+    name = the module name
+    functions = the mocks, by name
+    '''
+    module = types.ModuleType (name)
+    for key in functions:
+        setattr (module, key, functions[key])
+    return (module)
+
+class test_bench (unittest.TestCase):
+    def run_bench (self, argv):
+        benchmark_main = mock.Mock (return_value = 0)
+        with mock.patch.dict (sys.modules, benchmark = fake_module ('benchmark', main = benchmark_main)):
+            status = photoseive.main (argv)
+        self.assertEqual (status, 0)
+        return (benchmark_main.call_args[0][0])
+
+    def test_order_kept (self):
+        self.assertEqual (self.run_bench (['bench', '--trees', '10', '100']),
+                          ['--trees', '10', '100'])
+        return
+
+    def test_several_options (self):
+        argv = ['--images', 'a.jpg', 'b.jpg', '--scales', '1', '2', '--repeats', '1']
+        self.assertEqual (self.run_bench (['bench'] + argv), argv)
+        return
+
+    def test_help_is_benchmarks (self):
+        self.assertEqual (self.run_bench (['bench', '--help']), ['--help'])
+        return
+
+class test_commands (unittest.TestCase):
+    def test_analyse (self):
+        run_tree = mock.Mock (return_value = [])
+        ops = fake_module ('run_dgs_analysis', run_photoseive_tree = run_tree,
+                           run_distributed_tree = mock.Mock (), default_scales = lambda: 'scales')
+        with mock.patch.dict (sys.modules, run_dgs_analysis = ops):
+            status = photoseive.main (['analyse', '/data/tree', '--jobs', '4', '--fused',
+                                       '--tiled-memory', '512M', '--prefetch', '3'])
+        self.assertEqual (status, 0)
+        args, kwargs = run_tree.call_args
+        self.assertEqual (args[:3], ('/data/tree', 'scales', 4))
+        self.assertTrue (args[5])
+        self.assertEqual (kwargs['tiled_memory'], 512 * 1024**2)
+        self.assertEqual (kwargs['prefetch'], 3)
+        return
+
+    def test_failures_exit_status (self):
+        ops = fake_module ('run_dgs_analysis', default_scales = lambda: 'scales',
+                           run_photoseive_tree = mock.Mock (return_value = [('a.JPG', 'error')]),
+                           run_distributed_tree = mock.Mock ())
+        with mock.patch.dict (sys.modules, run_dgs_analysis = ops):
+            with contextlib.redirect_stdout (io.StringIO ()):
+                self.assertEqual (photoseive.main (['analyse', '/data/tree']), 1)
+        return
+
+    def test_coallate (self):
+        coallate = mock.Mock ()
+        with mock.patch.dict (sys.modules, coallate_gsd_data = fake_module ('coallate_gsd_data',
+                                                                           coallate_gsd_data = coallate)):
+            photoseive.main (['coallate', '/data/tree', 'out.csv', '--incremental'])
+        coallate.assert_called_once_with ('/data/tree', 'out.csv', 8, True, store = None)
+        return
+
+    def test_unknown_option (self):
+        with contextlib.redirect_stderr (io.StringIO ()):
+            with self.assertRaises (SystemExit):
+                photoseive.main (['analyse', '/data/tree', '--trees', '10'])
+        return
+
+class test_parse_bytes (unittest.TestCase):
+    def test_suffixes (self):
+        self.assertEqual (photoseive.parse_bytes ('16G'), 16 * 1024**3)
+        self.assertEqual (photoseive.parse_bytes ('512mb'), 512 * 1024**2)
+        self.assertEqual (photoseive.parse_bytes ('1000'), 1000)
+        return
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,152 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# tests for prefetch_pipeline: the results are those of the in-memory pipeline run
+# one image at a time, failures are collected, and the decoded images waiting for
+# the analysis are bounded by the depth
+#     python -m unittest discover tests
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import cv2
+import numpy as np
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+from sample_pipeline import sample_pipeline
+from prefetch_pipeline import prefetch_pipeline, run_prefetch_batch
+from run_dgs_analysis import default_scales
+
+# the config of the test samples: the native engine, no calibration
+test_config = ('clahe_dims: 8\ndensity: 4\ndofilter: 1\nmaxscale: 4\nminscale: 2\nnotes: 4\n' +
+               'resolution: 0.1\nused_calibrated: \'no\'\nverbose: 0\nengine: native\n')
+
+def make_samples (base_dir, n):
+    '''
+    function to make n sample directories, each with a config file and an image of
+    blurred noise, returning the image names
+    '''
+    rng = np.random.default_rng (0)
+    images = []
+    for k in range (n):
+        sample_dir = os.path.join (base_dir, 'image_' + str (k))
+        os.makedirs (sample_dir)
+        img = cv2.GaussianBlur ((rng.random ((96, 128)) * 255).astype (np.uint8), (0, 0), 1 + k % 3)
+        images.append (os.path.join (sample_dir, 'IMG_' + str (k) + '.JPG'))
+        cv2.imwrite (images[-1], img)
+        with open (os.path.join (sample_dir, 'config.txt'), 'w') as f:
+            f.write (test_config)
+    return (images)
+
+def read_outputs (image_file):
+    '''
+    function to read the gsd.txt and percentiles.txt of a sample
+    '''
+    directory = os.path.dirname (image_file)
+    res = []
+    for name in ('gsd.txt', 'percentiles.txt'):
+        with open (os.path.join (directory, name), 'r') as f:
+            res.append (f.read ())
+    return (res)
+
+class test_prefetch_pipeline (unittest.TestCase):
+    def setUp (self):
+        self.tmp_dir = tempfile.mkdtemp (prefix = 'photoseive_test_')
+        self.images = make_samples (self.tmp_dir, 6)
+        return
+
+    def tearDown (self):
+        shutil.rmtree (self.tmp_dir)
+        return
+
+    def test_same_results_as_one_at_a_time (self):
+        for image_file in self.images:
+            sample_pipeline (image_file, default_scales ()).run ()
+        expected = [read_outputs (i) for i in self.images]
+        for image_file in self.images:
+            os.unlink (os.path.join (os.path.dirname (image_file), 'gsd.txt'))
+
+        pp = prefetch_pipeline (self.images, default_scales (), depth = 2, readers = 2)
+        self.assertEqual (pp.run (), [])
+        self.assertEqual (sorted (pp.completed), sorted (self.images))
+        self.assertEqual ([read_outputs (i) for i in self.images], expected)
+        return
+
+    def test_failures_are_collected (self):
+        with open (self.images[2], 'w') as f:
+            f.write ('not a jpeg')
+        os.unlink (os.path.join (os.path.dirname (self.images[4]), 'config.txt'))
+        pp = prefetch_pipeline (self.images, default_scales ())
+        failures = pp.run ()
+        self.assertEqual (sorted (f[0] for f in failures), [self.images[2], self.images[4]])
+        self.assertEqual (sorted (pp.completed),
+                          sorted (i for k, i in enumerate (self.images) if k not in (2, 4)))
+        return
+
+    def test_decoded_images_are_bounded (self):
+        # a slow analysis, the readers must wait for it rather than decode everything
+        lock = threading.Lock ()
+        waiting = [0]
+        most = [0]
+        read = sample_pipeline.read
+        prepare = sample_pipeline.prepare
+        def counted_read (sp):
+            img = read (sp)
+            with lock:
+                waiting[0] = waiting[0] + 1
+                most[0] = max (most[0], waiting[0])
+            return (img)
+        def slow_prepare (sp, img):
+            with lock:
+                waiting[0] = waiting[0] - 1
+            time.sleep (0.05)
+            return (prepare (sp, img))
+
+        images = self.images + make_samples (os.path.join (self.tmp_dir, 'more'), 10)
+        with mock.patch.object (sample_pipeline, 'read', counted_read), \
+             mock.patch.object (sample_pipeline, 'prepare', slow_prepare):
+            pp = prefetch_pipeline (images, default_scales (), depth = 2, readers = 2)
+            self.assertEqual (pp.run (), [])
+
+        # the queue, plus an image held by each reader waiting to put it
+        self.assertGreater (most[0], 1)
+        self.assertLessEqual (most[0], 2 + 2)
+        self.assertEqual (len (pp.completed), len (images))
+        return
+
+    def test_batch_returns_records (self):
+        records, completed, failures = run_prefetch_batch (self.images, default_scales (),
+                                                           to_store = True)
+        self.assertEqual (failures, [])
+        self.assertEqual (sorted (r['sample'] for r in records),
+                          sorted (os.path.dirname (os.path.abspath (i)) for i in self.images))
+        for r in records:
+            self.assertAlmostEqual (r['freqs'].sum (), 1.0)
+        for image_file in self.images:
+            self.assertFalse (os.path.exists (os.path.join (os.path.dirname (image_file), 'gsd.txt')))
+        return
+
+if __name__ == '__main__':
+    unittest.main ()
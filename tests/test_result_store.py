@@ -0,0 +1,124 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# tests for result_store: the latest record wins, compaction, the lock of a
+# compaction that died, and reads during a compaction
+#     python -m unittest discover tests
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+import result_store as store_module
+from result_store import result_store
+
+def make_record (sample, mean):
+    '''
+    function to make a record of a sample as dgs_analysis.make_record does
+    '''
+    return (dict (sample = sample, mean = mean, percentiles = [0.5], percentile_values = [mean],
+                  bins = [1.0, 2.0], freqs = [0.5, 0.5]))
+
+class test_result_store (unittest.TestCase):
+    def setUp (self):
+        self.tmp_dir = tempfile.mkdtemp (prefix = 'photoseive_test_')
+        self.store_dir = os.path.join (self.tmp_dir, 'store')
+        self.lock_file = os.path.join (self.store_dir, 'compact.lock')
+        for k in range (3):
+            rs = result_store (self.store_dir)
+            rs.extend ([make_record ('a', float (k)), make_record ('s' + str (k), 1.0)])
+            rs.close ()
+        return
+
+    def tearDown (self):
+        shutil.rmtree (self.tmp_dir)
+        return
+
+    def read_means (self):
+        stats = result_store (self.store_dir).read_stats ()
+        return (dict (zip (stats.index, stats['mean'])))
+
+    def test_compact_keeps_the_latest_records (self):
+        before = self.read_means ()
+        self.assertEqual (before['a'], 2.0)
+        rs = result_store (self.store_dir)
+        rs.compact ()
+        self.assertEqual (len (rs.partitions ()), 1)
+        self.assertEqual (self.read_means (), before)
+        self.assertFalse (os.path.exists (self.lock_file))
+        return
+
+    def test_live_lock_blocks (self):
+        with open (self.lock_file, 'w') as f:
+            json.dump (dict (host = 'other-host', pid = 1, token = 'x'), f)
+        rs = result_store (self.store_dir)
+        rs.compact ()
+        self.assertEqual (len (rs.partitions ()), 3)
+        self.assertTrue (os.path.exists (self.lock_file))
+        return
+
+    def test_dead_lock_is_taken_over (self):
+        # a process of this host that has gone
+        proc = os.fork ()
+        if proc == 0:
+            os._exit (0)
+        os.waitpid (proc, 0)
+        with open (self.lock_file, 'w') as f:
+            json.dump (dict (host = store_module.socket.gethostname (), pid = proc, token = 'x'), f)
+        rs = result_store (self.store_dir)
+        rs.compact ()
+        self.assertEqual (len (rs.partitions ()), 1)
+        self.assertFalse (os.path.exists (self.lock_file))
+        return
+
+    def test_old_lock_is_taken_over (self):
+        with open (self.lock_file, 'w') as f:
+            json.dump (dict (host = 'other-host', pid = 1, token = 'x'), f)
+        t = time.time () - store_module.compact_lock_seconds - 10
+        os.utime (self.lock_file, (t, t))
+        rs = result_store (self.store_dir)
+        rs.compact ()
+        self.assertEqual (len (rs.partitions ()), 1)
+        return
+
+    def test_read_during_compaction (self):
+        # the partitions are listed, then a compaction removes them before the read
+        rs = result_store (self.store_dir)
+        listed = rs.partitions ()
+        calls = []
+        def partitions ():
+            calls.append (1)
+            if len (calls) == 1:
+                result_store (self.store_dir).compact ()
+                return (listed)
+            return (result_store.partitions (rs))
+        rs.partitions = partitions
+        table = rs.read_table ()
+        self.assertEqual (sorted (table.column ('sample').to_pylist ()), ['a', 's0', 's1', 's2'])
+        self.assertEqual (len (calls), 2)
+        return
+
+if __name__ == '__main__':
+    unittest.main ()
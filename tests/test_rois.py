@@ -0,0 +1,77 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# tests for rois: the regions of interest in the config and the output files of
+# a sample
+#     python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+from rois import parse_rois, sample_outputs, output_files
+
+class test_parse_rois (unittest.TestCase):
+    def test_regions_in_config_order (self):
+        config = {'rois': {'tray-2': [10, 20, 30, 40], 'tray_1': ['0', '0', '5', '5']}}
+        self.assertEqual (parse_rois (config), [('tray-2', (10, 20, 30, 40)),
+                                                ('tray_1', (0, 0, 5, 5))])
+        return
+
+    def test_no_regions (self):
+        self.assertEqual (parse_rois (dict ()), [])
+        self.assertEqual (parse_rois ({'rois': None}), [])
+        self.assertEqual (parse_rois ({'rois': dict ()}), [])
+        return
+
+    def test_bad_names (self):
+        for name in ('../up', 'a b', 'tray/1', ''):
+            with self.assertRaises (ValueError):
+                parse_rois ({'rois': {name: [0, 0, 10, 10]}})
+        return
+
+    def test_bad_regions (self):
+        for box in ([0, 0, 10], [0, 0, 0, 10], [-1, 0, 10, 10], 'abcd', 5, [0, 0, 'w', 10]):
+            with self.assertRaises (ValueError):
+                parse_rois ({'rois': {'tray': box}})
+        with self.assertRaises (ValueError):
+            parse_rois ({'rois': [[0, 0, 10, 10]]})
+        return
+
+class test_sample_outputs (unittest.TestCase):
+    def test_plain (self):
+        self.assertEqual (sample_outputs (dict ()), output_files)
+        return
+
+    def test_each_region (self):
+        config = {'rois': {'a': [0, 0, 5, 5], 'b': [5, 5, 5, 5]}}
+        self.assertEqual (sample_outputs (config),
+                          ('stats_a.txt', 'gsd_a.txt', 'percentiles_a.txt',
+                           'stats_b.txt', 'gsd_b.txt', 'percentiles_b.txt'))
+        return
+
+    def test_bad_regions_are_plain (self):
+        self.assertEqual (sample_outputs ({'rois': {'a b': [0, 0, 5, 5]}}), output_files)
+        return
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,111 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# tests for sample_cache: the blob store of intermediates and its least recently
+# used eviction
+#     python -m unittest discover tests
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+from sample_cache import sample_cache
+
+def write_bytes (file_name, size):
+    '''
+    function to write a file of size bytes
+    '''
+    with open (file_name, 'wb') as f:
+        f.write (b'x' * size)
+    return (file_name)
+
+class test_sample_cache (unittest.TestCase):
+    def setUp (self):
+        self.tmp_dir = tempfile.mkdtemp (prefix = 'photoseive_test_')
+        self.cache = sample_cache (os.path.join (self.tmp_dir, 'cache'), max_bytes = 250)
+        self.src_file = write_bytes (os.path.join (self.tmp_dir, 'src.bin'), 100)
+        return
+
+    def tearDown (self):
+        shutil.rmtree (self.tmp_dir)
+        return
+
+    def set_used (self, key, age):
+        '''
+        method to mark a blob as last used age seconds ago
+        '''
+        t = time.time () - age
+        os.utime (self.cache.blob_file (key, 'clahe.jpg'), (t, t))
+        return
+
+    def test_put_and_get_file (self):
+        blob = self.cache.put_file ('a', 'clahe.jpg', self.src_file)
+        self.assertEqual (self.cache.get_file ('a', 'clahe.jpg'), blob)
+        dest_file = os.path.join (self.tmp_dir, 'dest.jpg')
+        self.assertEqual (self.cache.get_file ('a', 'clahe.jpg', dest_file), dest_file)
+        self.assertEqual (os.path.getsize (dest_file), 100)
+        return
+
+    def test_missing_file_is_none (self):
+        self.assertIsNone (self.cache.get_file ('missing', 'clahe.jpg'))
+        dest_file = os.path.join (self.tmp_dir, 'dest.jpg')
+        self.assertIsNone (self.cache.get_file ('missing', 'clahe.jpg', dest_file))
+        self.assertFalse (os.path.exists (dest_file))
+        return
+
+    def test_least_recently_used_is_evicted (self):
+        self.cache.put_file ('a', 'clahe.jpg', self.src_file)
+        self.cache.put_file ('b', 'clahe.jpg', self.src_file)
+        self.set_used ('a', 20)
+        self.set_used ('b', 10)
+
+        # getting a makes b the least recently used
+        self.assertIsNotNone (self.cache.get_file ('a', 'clahe.jpg'))
+        self.cache.put_file ('c', 'clahe.jpg', self.src_file)
+
+        self.assertIsNotNone (self.cache.get_file ('a', 'clahe.jpg'))
+        self.assertIsNone (self.cache.get_file ('b', 'clahe.jpg'))
+        self.assertIsNotNone (self.cache.get_file ('c', 'clahe.jpg'))
+        return
+
+    def test_store_is_kept_under_the_cap (self):
+        for k in range (6):
+            self.cache.put_file ('k' + str (k), 'clahe.jpg', self.src_file)
+            self.set_used ('k' + str (k), 60 - k)
+        sizes = [os.path.getsize (os.path.join (self.cache.blob_dir, f))
+                 for f in os.listdir (self.cache.blob_dir)]
+        self.assertLessEqual (sum (sizes), 250)
+        self.assertIsNotNone (self.cache.get_file ('k5', 'clahe.jpg'))
+        return
+
+    def test_array_round_trip (self):
+        array = np.arange (12, dtype = np.float32).reshape ((3, 4))
+        self.cache.put_array ('a', 'power.npy', array)
+        np.testing.assert_array_equal (self.cache.get_array ('a', 'power.npy'), array)
+        self.assertIsNone (self.cache.get_array ('missing', 'power.npy'))
+        return
+
+if __name__ == '__main__':
+    unittest.main ()
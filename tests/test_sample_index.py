@@ -0,0 +1,140 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# tests for sample_index: the stale check and change time over the outputs of
+# each region of interest, the config only resolved again when it changes, and
+# the index loaded without numpy
+#     python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import subprocess
+from unittest import mock
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+import config_resolver
+from sample_index import find_samples, defaults_file_name
+
+def write_text (file_name, text, mtime = None):
+    '''
+    function to write a text file, with a modification time in seconds (optional)
+    '''
+    with open (file_name, 'w') as f:
+        f.write (text)
+    if mtime is not None:
+        os.utime (file_name, ns = (mtime * 10**9, mtime * 10**9))
+    return (file_name)
+
+class test_sample_index (unittest.TestCase):
+    def setUp (self):
+        self.tmp_dir = tempfile.mkdtemp (prefix = 'photoseive_test_')
+        self.base_dir = os.path.join (self.tmp_dir, 'tree')
+        self.sample_dir = os.path.join (self.base_dir, 'image_1')
+        os.makedirs (self.sample_dir)
+        self.index_file = os.path.join (self.tmp_dir, 'sample_index.sqlite')
+        write_text (os.path.join (self.sample_dir, 'config.txt'),
+                    'rois:\n  a: [0, 0, 5, 5]\n  b: [5, 5, 5, 5]\n', 1000)
+        write_text (os.path.join (self.sample_dir, 'image_1.jpg'), 'image', 1000)
+        return
+
+    def tearDown (self):
+        shutil.rmtree (self.tmp_dir)
+        return
+
+    def write_outputs (self, roi, mtime):
+        for f in ('stats', 'gsd', 'percentiles'):
+            write_text (os.path.join (self.sample_dir, f + '_' + roi + '.txt'), 'x', mtime)
+        return
+
+    def sample (self):
+        samples = find_samples (self.base_dir, index_file = self.index_file)
+        self.assertEqual (len (samples), 1)
+        return (samples[0])
+
+    def test_every_region_output (self):
+        self.write_outputs ('a', 2000)
+        self.assertTrue (self.sample ()['stale'])
+        self.write_outputs ('b', 3000)
+        sample = self.sample ()
+        self.assertFalse (sample['stale'])
+        self.assertEqual (sample['mtime'], 3000 * 10**9)
+        return
+
+    def test_one_region_rerun (self):
+        self.write_outputs ('a', 2000)
+        self.write_outputs ('b', 3000)
+        self.assertEqual (self.sample ()['mtime'], 3000 * 10**9)
+
+        # rerunning the older region changes the sample
+        self.write_outputs ('a', 4000)
+        self.assertEqual (self.sample ()['mtime'], 4000 * 10**9)
+
+        # an image newer than one region makes it stale
+        write_text (os.path.join (self.sample_dir, 'image_1.jpg'), 'image', 3500)
+        self.write_outputs ('a', 4000)
+        self.assertTrue (self.sample ()['stale'])
+        return
+
+    def test_config_resolved_on_change (self):
+        self.write_outputs ('a', 2000)
+        self.write_outputs ('b', 2000)
+        resolve = mock.Mock (side_effect = config_resolver.resolve_config)
+        with mock.patch.object (config_resolver, 'resolve_config', resolve):
+            self.assertFalse (self.sample ()['stale'])
+            self.assertFalse (self.sample ()['stale'])
+            self.assertEqual (resolve.call_count, 1)
+
+            # a defaults file above the sample changes the outputs
+            write_text (os.path.join (self.base_dir, defaults_file_name),
+                        'rois:\n  c: [0, 0, 5, 5]\n', 1500)
+            write_text (os.path.join (self.sample_dir, 'config.txt'), '', 1000)
+            self.assertTrue (self.sample ()['stale'])
+            self.assertEqual (resolve.call_count, 2)
+            self.write_outputs ('c', 2000)
+            self.assertFalse (self.sample ()['stale'])
+            self.assertEqual (resolve.call_count, 2)
+        return
+
+    def test_older_index (self):
+        db = sqlite3.connect (self.index_file)
+        db.execute ('create table samples (directory text primary key, images text, '
+                    'config_mtime integer, image_mtime integer, stats_mtime integer, '
+                    'gsd_mtime integer, percentiles_mtime integer)')
+        db.commit ()
+        db.close ()
+        self.write_outputs ('a', 2000)
+        self.write_outputs ('b', 2000)
+        self.assertFalse (self.sample ()['stale'])
+        return
+
+    def test_no_numpy (self):
+        code = 'import sys, config_resolver, sample_index; print (\'numpy\' in sys.modules)'
+        out = subprocess.check_output ([sys.executable, '-c', code],
+                                       cwd = os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+        self.assertEqual (out.decode ().strip (), 'False')
+        return
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,90 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# tests for watch_folder: an image that cannot be taken in is tried again, and a
+# finished sample is only failed by an error, not by an interrupt
+#     python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import concurrent.futures
+from unittest import mock
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+import watch_folder as watch_module
+from watch_folder import watch_folder
+
+class test_watch_folder (unittest.TestCase):
+    def setUp (self):
+        self.tmp_dir = tempfile.mkdtemp (prefix = 'photoseive_test_')
+        self.drop_dir = os.path.join (self.tmp_dir, 'drop')
+        self.target_dir = os.path.join (self.tmp_dir, 'target')
+        os.makedirs (self.drop_dir)
+        os.makedirs (self.target_dir)
+        with open (os.path.join (self.drop_dir, 'IMG_1.JPG'), 'wb') as f:
+            f.write (b'\xff\xd8 image \xff\xd9')
+        self.watch = watch_folder (self.drop_dir, self.target_dir, None, None, settle_seconds = 0.0)
+        return
+
+    def tearDown (self):
+        shutil.rmtree (self.tmp_dir)
+        return
+
+    def test_failed_intake_is_tried_again (self):
+        with mock.patch.object (watch_module, 'make_photodir', side_effect = OSError ('disk full')):
+            self.assertRaises (OSError, self.watch.take_in, 'IMG_1.JPG')
+        self.assertNotIn ('IMG_1.JPG', self.watch.seen)
+
+        # the image is found again once it has settled, and taken in
+        self.watch.scan ()
+        self.assertEqual (self.watch.scan (), ['IMG_1.JPG'])
+        sample_image = self.watch.take_in ('IMG_1.JPG')
+        self.assertTrue (os.path.isfile (sample_image))
+        self.assertIn ('IMG_1.JPG', self.watch.seen)
+        self.watch.scan ()
+        self.assertEqual (self.watch.scan (), [])
+        return
+
+    def test_worker_error_fails_the_sample (self):
+        future = concurrent.futures.Future ()
+        future.set_exception (ValueError ('bad sample'))
+        self.watch.finish (future, 'sample.JPG', 0.0)
+        self.assertEqual (self.watch.failures, [('sample.JPG', 'bad sample')])
+        self.assertEqual (self.watch.completed, [])
+        return
+
+    def test_interrupt_while_appending_is_left_to_the_watch (self):
+        future = concurrent.futures.Future ()
+        future.set_result (None)
+        with mock.patch.object (watch_folder, 'append_result', side_effect = KeyboardInterrupt):
+            self.assertRaises (KeyboardInterrupt, self.watch.finish, future, 'sample.JPG', 0.0)
+        self.assertEqual (self.watch.failures, [])
+
+        # finished again (as the watch does when it stops)
+        with mock.patch.object (watch_folder, 'append_result'):
+            self.watch.finish (future, 'sample.JPG', 0.0)
+        self.assertEqual (self.watch.completed, ['sample.JPG'])
+        return
+
+if __name__ == '__main__':
+    unittest.main ()
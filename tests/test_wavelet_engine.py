@@ -0,0 +1,189 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# tests for wavelet_engine: the grain size distribution of synthetic images with
+# a known texture size, against DGS where it is installed, adaptive sampling and
+# adaptive scale selection
+#     python -m unittest discover tests
+
+import os
+import sys
+import unittest
+import cv2
+import numpy as np
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+from wavelet_engine import wavelet_gsd, select_scales
+from dgs_analysis import dgs_array, DGS
+from run_dgs_analysis import default_scales
+
+def texture_image (sigma, shape = (256, 384), seed = 0):
+    '''
+    function to make a synthetic greyscale image of blurred noise, the texture
+    (grain) size grows with sigma (pixels)
+    '''
+    rng = np.random.default_rng (seed)
+    img = cv2.GaussianBlur (rng.random (shape).astype (np.float32), (0, 0), sigma)
+    return (cv2.normalize (img, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U))
+
+def stripe_image (wavelength, shape = (512, 384), seed = 0):
+    '''
+    function to make a synthetic greyscale image of vertical stripes of one
+    wavelength (pixels) with a random phase in each row and a little noise, so the
+    energy is in a narrow band of scales
+    '''
+    rng = np.random.default_rng (seed)
+    x = np.arange (shape[1])[None, :] + rng.random ((shape[0], 1)) * wavelength
+    img = 128.0 + 100.0 * np.sin (2.0 * np.pi * x / wavelength) + rng.normal (0.0, 3.0, shape)
+    return (np.clip (img, 0, 255).astype (np.uint8))
+
+# the config of the tests: every 4th row, grains from 2 pixels to a quarter of the width
+test_config = dict (density = 4, resolution = 0.1, dofilter = 1, maxscale = 4, minscale = 2,
+                    notes = 8, verbose = 0, engine = 'native')
+
+class test_wavelet_engine (unittest.TestCase):
+    def test_bins_are_the_given_scales (self):
+        scales = default_scales ()
+        res = wavelet_gsd (texture_image (2.0), test_config, scales)
+        pixels = scales / test_config['resolution']
+        kept = scales[(pixels >= test_config['minscale']) & (pixels <= 384 / test_config['maxscale'])]
+        np.testing.assert_allclose (res['grain size bins'], kept)
+        np.testing.assert_allclose (select_scales (scales, 384, test_config) * 0.1, kept)
+        return
+
+    def test_distribution (self):
+        res = wavelet_gsd (texture_image (2.0), test_config, default_scales ())
+        self.assertAlmostEqual (res['grain size frequencies'].sum (), 1.0)
+        self.assertTrue (np.all (np.diff (res['percentile_values']) >= 0.0))
+        self.assertTrue (res['grain size bins'][0] <= res['mean grain size'] <= res['grain size bins'][-1])
+        return
+
+    def test_coarser_texture_has_larger_grains (self):
+        means = [wavelet_gsd (texture_image (sigma), test_config, default_scales ())['mean grain size']
+                 for sigma in (1.0, 3.0, 8.0)]
+        self.assertLess (means[0] * 1.2, means[1])
+        self.assertLess (means[1] * 1.2, means[2])
+        return
+
+    def test_chunks_do_not_change_the_result (self):
+        img = texture_image (3.0)
+        whole = wavelet_gsd (img, test_config, default_scales ())
+        chunked = wavelet_gsd (img, test_config, default_scales (), max_bytes = 64 * 1024)
+        np.testing.assert_allclose (chunked['grain size frequencies'],
+                                    whole['grain size frequencies'], rtol = 1e-5, atol = 1e-9)
+        return
+
+    @unittest.skipIf (DGS is None, 'DGS is not installed')
+    def test_against_dgs (self):
+        # the same image and config through DGS: the bins are the same scales, and
+        # the mean grain size and median agree to within 10 %
+        img = texture_image (3.0)
+        native = wavelet_gsd (img, test_config, default_scales ())
+        dgs = dgs_array (img, dict (test_config, engine = 'dgs'), default_scales ())
+        np.testing.assert_allclose (native['grain size bins'], dgs['grain size bins'], rtol = 1e-6)
+        self.assertAlmostEqual (native['mean grain size'] / dgs['mean grain size'], 1.0, delta = 0.1)
+        median = list (native['percentiles']).index (0.5)
+        self.assertAlmostEqual (native['percentile_values'][median] /
+                                np.asarray (dgs['percentile_values'])[median], 1.0, delta = 0.1)
+        return
+
+class test_adaptive_sampling (unittest.TestCase):
+    def setUp (self):
+        # a tall image of the same texture all the way down, every row a candidate
+        self.img = texture_image (3.0, shape = (2048, 256))
+        self.config = dict (test_config, density = 1, sampling = 'adaptive',
+                            sampling_tolerance = 0.02)
+        return
+
+    def test_converges_on_a_uniform_texture (self):
+        fixed = wavelet_gsd (self.img, dict (self.config, sampling = 'fixed'), default_scales ())
+        res = wavelet_gsd (self.img, self.config, default_scales ())
+        stats = res['stats']
+        self.assertTrue (stats['converged'])
+        self.assertEqual (stats['rows_available'], 2048)
+        self.assertLess (stats['rows_used'], stats['rows_available'] // 2)
+
+        # the percentiles are within the tolerance of those of every row
+        np.testing.assert_allclose (res['percentile_values'], fixed['percentile_values'],
+                                    rtol = 2 * self.config['sampling_tolerance'])
+        self.assertTrue (np.all (np.asarray ([stats[k] for k in stats if k.startswith ('ci95_p')]) <
+                                 self.config['sampling_tolerance'] * res['percentile_values'].max ()))
+        return
+
+    def test_worst_case_is_every_row (self):
+        config = dict (self.config, sampling_tolerance = 1e-9)
+        fixed = wavelet_gsd (self.img, dict (config, sampling = 'fixed'), default_scales ())
+        res = wavelet_gsd (self.img, config, default_scales ())
+        self.assertFalse (res['stats']['converged'])
+        self.assertEqual (res['stats']['rows_used'], 2048)
+        np.testing.assert_allclose (res['grain size frequencies'], fixed['grain size frequencies'],
+                                    rtol = 1e-5, atol = 1e-9)
+        return
+
+    def test_changing_texture_uses_more_rows (self):
+        # the texture size changes down the image, so the stratified rows disagree longer
+        mixed = np.concatenate ((texture_image (1.0, shape = (1024, 256)),
+                                 texture_image (8.0, shape = (1024, 256), seed = 1)))
+        uniform = wavelet_gsd (self.img, self.config, default_scales ())['stats']['rows_used']
+        changing = wavelet_gsd (mixed, self.config, default_scales ())['stats']['rows_used']
+        self.assertGreater (changing, uniform)
+        return
+
+class test_adaptive_scales (unittest.TestCase):
+    def compare (self, img):
+        '''
+        method to run the dense and adaptive scale selection on an image, returning
+        (dense results, adaptive results)
+        '''
+        dense = wavelet_gsd (img, test_config, default_scales ())
+        adaptive = wavelet_gsd (img, dict (test_config, scale_selection = 'adaptive'),
+                                default_scales ())
+        return (dense, adaptive)
+
+    def test_narrow_band_works_fewer_scales (self):
+        dense, adaptive = self.compare (stripe_image (12.0))
+        self.assertLess (adaptive['stats']['scales_evaluated'], len (dense['grain size bins']) // 2)
+
+        # the bins are all the scales, and the distribution is close to the dense one
+        np.testing.assert_allclose (adaptive['grain size bins'], dense['grain size bins'])
+        np.testing.assert_allclose (adaptive['percentile_values'], dense['percentile_values'],
+                                    rtol = 0.01)
+        self.assertAlmostEqual (adaptive['mean grain size'] / dense['mean grain size'], 1.0,
+                                delta = 0.01)
+        return
+
+    def test_broad_texture_is_close_to_dense (self):
+        dense, adaptive = self.compare (texture_image (3.0, shape = (512, 384)))
+        self.assertLessEqual (adaptive['stats']['scales_evaluated'], len (dense['grain size bins']))
+        np.testing.assert_allclose (adaptive['percentile_values'], dense['percentile_values'],
+                                    rtol = 0.01)
+        return
+
+    def test_with_adaptive_sampling (self):
+        config = dict (test_config, density = 1, scale_selection = 'adaptive',
+                       sampling = 'adaptive', sampling_tolerance = 0.02)
+        res = wavelet_gsd (stripe_image (12.0, shape = (2048, 384)), config, default_scales ())
+        self.assertTrue (res['stats']['converged'])
+        self.assertIn ('scales_evaluated', res['stats'])
+        self.assertAlmostEqual (res['grain size frequencies'].sum (), 1.0)
+        return
+
+if __name__ == '__main__':
+    unittest.main ()
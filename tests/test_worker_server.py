@@ -0,0 +1,146 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# tests for worker_server: stdout is given back after every request (also after an
+# interrupt), and the socket is owner only from the moment it exists
+#     python -m unittest discover tests
+
+import os
+import sys
+import stat
+import json
+import socket
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+import worker_server
+
+class test_server (worker_server.worker_server):
+    '''
+    server without the analysis modules, with requests that print and fail
+    '''
+    def warm (self):
+        return
+
+    def do_echo (self, text):
+        print (text)
+        return (dict (text = text))
+
+    def do_fail (self):
+        raise ValueError ('failed on purpose')
+
+    def do_interrupt (self):
+        print ('interrupted')
+        raise KeyboardInterrupt
+
+def run_request (server, message):
+    '''
+    function to run one request through handle on a socket pair, returns the replies
+    server = the server
+    message = the request dict
+    '''
+    ours, theirs = socket.socketpair ()
+    with ours, theirs:
+        ours.sendall ((json.dumps (message) + '\n').encode ('utf-8'))
+        try:
+            server.handle (theirs)
+        finally:
+            theirs.shutdown (socket.SHUT_WR)
+            replies = [json.loads (line) for line in ours.makefile ('r', encoding = 'utf-8')]
+    return (replies)
+
+class test_handle (unittest.TestCase):
+    def setUp (self):
+        self.server = test_server ('unused')
+        self.stdout = sys.stdout
+        return
+
+    def tearDown (self):
+        sys.stdout = self.stdout
+        return
+
+    def test_result_and_progress (self):
+        replies = run_request (self.server, dict (command = 'echo', text = 'hello'))
+        self.assertIs (sys.stdout, self.stdout)
+        self.assertEqual (replies[0], dict (event = 'progress', message = 'hello'))
+        self.assertTrue (replies[-1]['ok'])
+        self.assertEqual (replies[-1]['result'], dict (text = 'hello'))
+        return
+
+    def test_error (self):
+        replies = run_request (self.server, dict (command = 'fail'))
+        self.assertIs (sys.stdout, self.stdout)
+        self.assertFalse (replies[-1]['ok'])
+        self.assertIn ('failed on purpose', replies[-1]['error'])
+        return
+
+    def test_interrupt_restores_stdout (self):
+        with self.assertRaises (KeyboardInterrupt):
+            run_request (self.server, dict (command = 'interrupt'))
+        self.assertIs (sys.stdout, self.stdout)
+        return
+
+class test_serve (unittest.TestCase):
+    def setUp (self):
+        self.base_dir = tempfile.mkdtemp (prefix = 'photoseive_test_')
+        self.socket_path = os.path.join (self.base_dir, 'photoseive', 'worker.sock')
+        return
+
+    def tearDown (self):
+        shutil.rmtree (self.base_dir)
+        return
+
+    def test_owner_only (self):
+        server = test_server (self.socket_path)
+        modes = []
+        bind = socket.socket.bind
+
+        def checked_bind (s, address):
+            bind (s, address)
+            modes.append (stat.S_IMODE (os.stat (address).st_mode))
+            return
+
+        socket.socket.bind = checked_bind
+        try:
+            thread = threading.Thread (target = server.serve)
+            thread.start ()
+            for i in range (100):
+                if worker_server.ping (self.socket_path) is not None:
+                    break
+                threading.Event ().wait (0.05)
+        finally:
+            socket.socket.bind = bind
+
+        self.assertEqual (stat.S_IMODE (os.stat (os.path.dirname (self.socket_path)).st_mode), 0o700)
+        self.assertEqual (modes[0] & 0o077, 0)
+        self.assertEqual (worker_server.request ('echo', self.socket_path, on_progress = lambda m: None,
+                                                 text = 'hi'), dict (text = 'hi'))
+        worker_server.request ('shutdown', self.socket_path)
+        thread.join (10.0)
+        self.assertFalse (thread.is_alive ())
+        self.assertFalse (os.path.exists (self.socket_path))
+        return
+
+if __name__ == '__main__':
+    unittest.main ()
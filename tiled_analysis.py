@@ -0,0 +1,204 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# tiled_analysis: memory bounded analysis for very large images (e.g. stitched
+#                 mosaics). The image is worked through in full width strips: the
+#                 CLAHE is applied per strip with one CLAHE tile of overlap above
+#                 and below (the strips line up with the CLAHE tile grid, so the
+#                 interior matches the whole image CLAHE), the grainsize analysis
+#                 runs on the rows of each strip (the wavelets run along the rows,
+#                 so no overlap is needed there), and the strip frequencies are
+#                 combined, weighted by the rows in each strip.
+
+import os
+import sys
+import math
+import cv2
+import numpy as np
+
+from dgs_analysis import dgs_analysis, dgs_array, summarise_gsd, clahe_object
+from instrumentation import timer
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+# default memory budget for the strip working set (bytes)
+default_max_memory = 512 * 1024**2
+
+# peak bytes per strip pixel: the strip copy, the clahe output and the floating
+# point working arrays of the grainsize analysis
+strip_bytes_per_pixel = 24
+
+def open_grey_image (image_file):
+    '''
+    function to open an image as a 2d greyscale array without holding more of it
+    in memory than needed: .npy files and uncompressed tiffs (with tifffile) are
+    memory mapped, so only the strips that are read get paged in. Other formats
+    (e.g. jpeg, which cannot be decoded by region) are decoded once to greyscale,
+    which is 1 byte per pixel on top of the strip budget, so for a jpeg the peak
+    memory is the budget plus the whole greyscale frame. Returns (image, memory
+    mapped flag).
+
+    image_file = the image file name
+    '''
+    ext = os.path.splitext (image_file)[1].lower ()
+
+    if ext == '.npy':
+        img = np.load (image_file, mmap_mode = 'r')
+        if img.ndim == 2:
+            return (img, True)
+
+    if ext in ('.tif', '.tiff') and tifffile is not None:
+        try:
+            img = tifffile.memmap (image_file, mode = 'r')
+            if img.ndim == 2:
+                return (img, True)
+        except ValueError:
+            pass                            # compressed, decode below
+
+    img = cv2.imread (image_file, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise IOError ('cannot read the image file: ' + image_file)
+    return (img, False)
+
+def clahe_tile_size (height, width, clahe_dims):
+    '''
+    function to get the (height, width) of the clahe tiles opencv uses for a whole
+    image. If the image does not divide into the tiles, opencv pads it by
+    clahe_dims - (size % clahe_dims) in both directions (a whole extra tile where
+    that direction already divides), so the tiles are a little bigger.
+
+    height = image height
+    width = image width
+    clahe_dims = the clahe tile grid dimensions
+    '''
+    if height % clahe_dims == 0 and width % clahe_dims == 0:
+        return (height // clahe_dims, width // clahe_dims)
+    return ((height + clahe_dims - height % clahe_dims) // clahe_dims,
+            (width + clahe_dims - width % clahe_dims) // clahe_dims)
+
+class tiled_analysis:
+    def __init__ (self, image_file, scales, max_memory = default_max_memory, store = None):
+        '''
+        constructor takes the file name of the (calibrated) image to evaluate
+        image_file = the input image name
+        scales = input scales for analysis (a numpy array)
+        max_memory = memory budget for the strip working set (bytes), the strips are
+                     made as tall as this allows
+        store = where to put the results in place of the output files (optional,
+                see dgs_analysis)
+        '''
+        self.image_file = image_file
+        self.scales = scales
+        self.max_memory = max_memory
+
+        # the analysis object reads the config file and writes the outputs
+        self.gs = dgs_analysis (image_file, scales, store)
+        self.config = self.gs.config if not self.gs.config_file_error else dict ()
+
+        return
+
+    def plan_strips (self, height, width):
+        '''
+        method to plan the strips: returns the clahe tile height and width and a list
+        of (start, end) rows of the strip interiors, each a whole number of clahe tiles
+        height = image height
+        width = image width
+        '''
+        clahe_dims = int (self.config['clahe_dims'])
+        tile_h, tile_w = clahe_tile_size (height, width, clahe_dims)
+
+        # tiles per strip from the memory budget, less the two overlap tiles
+        rows_budget = self.max_memory // (width * strip_bytes_per_pixel)
+        tiles = max (1, int (rows_budget // tile_h) - 2)
+
+        strips = []
+        for start in range (0, height, tiles * tile_h):
+            strips.append ((start, min (height, start + tiles * tile_h)))
+        return (tile_h, tile_w, strips)
+
+    def run (self):
+        '''
+        method to run the tiled analysis and write the results
+        '''
+        if self.gs.config_file_error:
+            print ('ERROR: cannot run the tiled analysis without a config file: ' + self.image_file)
+            return
+        if self.config.get ('deblur_radius') is not None:
+            print ('WARNING: the deblur is not applied by the tiled analysis: ' + self.image_file)
+        if self.config.get ('rois'):
+            print ('WARNING: the tiled analysis analyses the whole image, not the rois: ' + self.image_file)
+
+        with timer ('decode'):
+            img, mapped = open_grey_image (self.image_file)
+        height, width = img.shape
+        clahe_dims = int (self.config['clahe_dims'])
+        tile_h, tile_w, strips = self.plan_strips (height, width)
+
+        freqs = None
+        total_rows = 0
+        for start, end in strips:
+            # the strip with one clahe tile of overlap either side
+            ext_start = max (0, start - tile_h)
+            ext_end = min (height, end + tile_h)
+            strip = np.ascontiguousarray (img[ext_start:ext_end])
+            if strip.dtype != np.uint8:
+                strip = cv2.normalize (strip, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+
+            # clahe with the same tiles as the whole image, then crop the interior. The
+            # strip is padded (as opencv pads the whole image) to whole tiles.
+            grid_rows = int (math.ceil ((ext_end - ext_start) / float (tile_h)))
+            pad_rows = grid_rows * tile_h - (ext_end - ext_start)
+            pad_cols = clahe_dims * tile_w - width
+            if pad_rows > 0 or pad_cols > 0:
+                strip = cv2.copyMakeBorder (strip, 0, pad_rows, 0, pad_cols, cv2.BORDER_REFLECT_101)
+            with timer ('clahe'):
+                strip = clahe_object ((clahe_dims, grid_rows)).apply (strip)[start - ext_start:end - ext_start, :width]
+
+            # grainsize analysis on the strip rows
+            with timer ('dgs'):
+                strip_stats = dgs_array (strip, self.config, self.scales)
+            rows = len (range (0, end - start, int (self.config['density'])))
+            strip_freqs = np.asarray (strip_stats['grain size frequencies'], dtype = np.float64)
+            if freqs is None:
+                bins = np.asarray (strip_stats['grain size bins'], dtype = np.float64)
+                percentiles = strip_stats['percentiles']
+                freqs = np.zeros_like (strip_freqs)
+
+            # a strip with no texture (e.g. a blank margin) has no distribution to add
+            strip_total = strip_freqs.sum ()
+            if strip_total > 0.0 and np.isfinite (strip_total):
+                freqs = freqs + strip_freqs / strip_total * rows
+                total_rows = total_rows + rows
+
+            del strip
+
+        if total_rows == 0:
+            print ('ERROR: no strip of the image has a grain size distribution: ' + self.image_file)
+            return
+
+        # combine the strips into one distribution and write the results
+        self.gs.dgs_stats = summarise_gsd (bins, freqs / total_rows, percentiles)
+        self.gs.extra_stats['tiles'] = len (strips)
+        self.gs.write_results ()
+
+        print ('completed: ' + self.image_file + ' (' + str (len (strips)) + ' strips)')
+        return
@@ -0,0 +1,311 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# watch_folder: a long running ingestion mode for field processing. A drop folder
+#               is polled for new images; once an image is fully written (its
+#               size and time have not changed for settle_seconds and the jpeg
+#               end marker is there) its sample directory is made with the config
+#               file, the image is unwarped and analysed in memory on a pool of
+#               worker processes, and the result row is appended to the
+#               coallated table. Only max_pending images are taken in at once,
+#               the rest wait in the drop folder until there is room, so images
+#               arriving faster than they can be processed do not pile up in
+#               memory.
+
+import os
+import sys
+import time
+import signal
+import fnmatch
+import multiprocessing
+import concurrent.futures
+import pandas as pd
+
+from make_photodirs import make_photodir
+from coallate_gsd_data import read_sample_rows, build_table, order_columns, write_columnar
+from dgs_analysis import replace_file
+from parallel_tree import set_worker_threads
+from sample_cache import default_max_bytes
+from sample_index import is_image
+
+# default seconds between looks at the drop folder, and seconds an image must be
+# unchanged before it is taken in
+default_poll_seconds = 0.5
+default_settle_seconds = 1.0
+
+def jpeg_complete (image_file, tail_bytes = 1024):
+    '''
+    function to check that a jpeg file has its end of image marker (near the end,
+    some cameras pad the file). Files that are not jpegs are taken as complete.
+    image_file = the image file
+    tail_bytes = number of bytes at the end of the file to look in
+    '''
+    if not fnmatch.fnmatch (image_file.lower (), '*.jp*g'):
+        return (True)
+    try:
+        with open (image_file, 'rb') as f:
+            f.seek (0, os.SEEK_END)
+            f.seek (max (0, f.tell () - tail_bytes))
+            return (b'\xff\xd9' in f.read ())
+    except OSError:
+        return (False)
+
+def init_worker (threads):
+    '''
+    function run in each worker process as it starts (the pool initializer): ctrl-c
+    is left to the watch, which finishes the samples in progress, and the opencv and
+    blas threads are limited (see set_worker_threads)
+    threads = number of threads each worker is allowed
+    '''
+    signal.signal (signal.SIGINT, signal.SIG_IGN)
+    set_worker_threads (threads)
+    return
+
+def analyse_sample (image_name, scales, reduce = False):
+    '''
+    function run in the worker processes: unwarp and analyse a sample in memory
+    (see sample_pipeline), writing the stats, gsd and percentiles files
+    image_name = the image in the sample directory
+    scales = input scales for analysis (a numpy array)
+    reduce = decode oversampled images at a reduced size
+    '''
+    from run_dgs_analysis import run_photoseive_sample
+    return (run_photoseive_sample (image_name, scales, True, None, default_max_bytes, False,
+                                   None, reduce))
+
+class watch_folder:
+    def __init__ (self, drop_dir, target_dir, config_file, scales, output_file = None,
+                  jobs = 1, max_pending = None, poll_seconds = default_poll_seconds,
+                  settle_seconds = default_settle_seconds, reduce = False, worker_threads = 1):
+        '''
+        constructor takes the drop folder and where to put the samples
+        drop_dir = the folder the images arrive in
+        target_dir = directory to make the sample directories in (see make_photodir)
+        config_file = the config file copied into each sample directory
+        scales = input scales for analysis (a numpy array)
+        output_file = the coallated table (csv) to append the results to (optional,
+                      the parquet and feather files are written when the watch stops)
+        jobs = number of worker processes
+        max_pending = most images taken in and not yet finished (default 2 x jobs)
+        poll_seconds = seconds between looks at the drop folder
+        settle_seconds = seconds an image must be unchanged before it is taken in
+        reduce = decode oversampled images at a reduced size (see decode_planner)
+        worker_threads = number of opencv and blas threads for each worker process
+        '''
+        self.drop_dir = drop_dir
+        self.target_dir = target_dir
+        self.config_file = config_file
+        self.scales = scales
+        self.output_file = output_file
+        self.jobs = jobs
+        self.max_pending = max_pending if max_pending is not None else 2 * jobs
+        self.poll_seconds = poll_seconds
+        self.settle_seconds = settle_seconds
+        self.reduce = reduce
+        self.worker_threads = worker_threads
+
+        self.changes = dict ()              # image: ((size, mtime), time first seen like that)
+        self.seen = set ()                  # images taken in (or already in the target)
+        self.intake_failed = set ()         # drop folder images that could not be taken in
+        self.completed = []
+        self.failures = []
+
+        # the columns of the table that is appended to
+        self.columns = None
+        if output_file is not None and os.path.isfile (output_file):
+            self.columns = list (pd.read_csv (output_file, nrows = 0).columns)
+        return
+
+    def scan (self):
+        '''
+        method to look at the drop folder, returns the images that are ready to take
+        in (oldest first)
+        '''
+        now = time.time ()
+        ready = []
+        for entry in os.scandir (self.drop_dir):
+            if entry.name in self.seen or not entry.is_file () or not is_image (entry.name):
+                continue
+            try:
+                st = entry.stat ()
+            except OSError:
+                continue
+
+            # the image is ready once it has stopped changing and is complete
+            state = (st.st_size, st.st_mtime_ns)
+            previous = self.changes.get (entry.name)
+            if previous is None or previous[0] != state:
+                self.changes[entry.name] = (state, now)
+            elif now - previous[1] >= self.settle_seconds and st.st_size > 0 and \
+                 jpeg_complete (entry.path):
+                ready.append ((st.st_mtime, entry.name))
+
+        ready.sort ()
+        return ([name for mtime, name in ready])
+
+    def take_in (self, name):
+        '''
+        method to make the sample directory of an image from the drop folder,
+        returns the image in the sample directory (None if it was already there).
+        If the sample directory cannot be made (OSError) the image is not marked as
+        seen, so it is tried again once it has settled again.
+        name = the image name in the drop folder
+        '''
+        self.changes.pop (name, None)
+        sample_image = make_photodir (os.path.join (self.drop_dir, name), self.target_dir,
+                                      self.config_file)
+        self.seen.add (name)
+        if sample_image is None:
+            print ('already taken in: ' + name)
+        return (sample_image)
+
+    def append_result (self, image_name):
+        '''
+        method to append the result of a sample to the coallated table: the row (a
+        row for each region of interest) is appended to the csv file, or the table
+        is rewritten (atomically) if the rows bring new columns
+        image_name = the image in the sample directory
+        '''
+        if self.output_file is None:
+            return
+
+        row = build_table (read_sample_rows (os.path.dirname (os.path.abspath (image_name))))
+        columns = list (row.columns)
+        if self.columns is None or not os.path.isfile (self.output_file):
+            replace_file (self.output_file, lambda f: row.to_csv (f, index = False))
+            self.columns = columns
+        elif set (columns) <= set (self.columns):
+            row.reindex (columns = self.columns).to_csv (self.output_file, mode = 'a',
+                                                         header = False, index = False)
+        else:
+            res = pd.concat ([pd.read_csv (self.output_file), row], ignore_index = True, sort = False)
+            res = res[order_columns (list (res.columns))]
+            replace_file (self.output_file, lambda f: res.to_csv (f, index = False))
+            self.columns = list (res.columns)
+        return
+
+    def run (self, idle_seconds = None):
+        '''
+        method to watch the drop folder until interrupted (ctrl-c), or until nothing
+        has arrived or been running for idle_seconds. The images that are in the
+        drop folder when the watch starts are taken in too. Returns the list of
+        (image name, error message) tuples of the samples that failed.
+        idle_seconds = stop after this long with nothing to do (optional)
+        '''
+        if not os.path.isdir (self.target_dir):
+            os.makedirs (self.target_dir)
+
+        in_flight = dict ()
+        idle_since = time.time ()
+        context = multiprocessing.get_context ('spawn')
+        pool = concurrent.futures.ProcessPoolExecutor (max_workers = self.jobs, mp_context = context,
+                                                       initializer = init_worker,
+                                                       initargs = (self.worker_threads,))
+        print ('watching: ' + self.drop_dir)
+        try:
+            while True:
+                # take in new images while there is room (backpressure: the rest
+                # wait in the drop folder)
+                if len (in_flight) < self.max_pending:
+                    for name in self.scan ()[:self.max_pending - len (in_flight)]:
+                        drop_image = os.path.join (self.drop_dir, name)
+                        try:
+                            sample_image = self.take_in (name)
+                        except OSError as e:
+                            # the image stays in the drop folder for another try, and
+                            # the watch carries on (the failure is recorded once)
+                            print ('ERROR: cannot take in: ' + name + ' (' + str (e) + ')')
+                            if drop_image not in self.intake_failed:
+                                self.intake_failed.add (drop_image)
+                                self.failures.append ((drop_image, str (e)))
+                            continue
+                        if drop_image in self.intake_failed:
+                            self.intake_failed.discard (drop_image)
+                            self.failures = [f for f in self.failures if f[0] != drop_image]
+                        if sample_image is not None:
+                            future = self.submit (pool, sample_image)
+                            in_flight[future] = (sample_image, time.time ())
+
+                if len (in_flight) == 0:
+                    if idle_seconds is not None and time.time () - idle_since >= idle_seconds:
+                        break
+                    time.sleep (self.poll_seconds)
+                    continue
+
+                done, not_done = concurrent.futures.wait (in_flight, timeout = self.poll_seconds,
+                                        return_when = concurrent.futures.FIRST_COMPLETED)
+                # a sample stays in flight until it is finished, so one interrupted
+                # while its result is appended is finished again below
+                for future in done:
+                    self.finish (future, *in_flight[future])
+                    del in_flight[future]
+                idle_since = time.time ()
+
+        except KeyboardInterrupt:
+            print ('stopping, finishing the ' + str (len (in_flight)) + ' samples in progress')
+            for future in concurrent.futures.as_completed (in_flight):
+                self.finish (future, *in_flight[future])
+        finally:
+            pool.shutdown ()
+
+        if self.output_file is not None and os.path.isfile (self.output_file):
+            write_columnar (pd.read_csv (self.output_file), self.output_file)
+        return (self.failures)
+
+    def submit (self, pool, sample_image):
+        '''
+        method to submit a sample to the pool. The pool starts its worker processes
+        here, so ctrl-c is ignored while they start: they inherit it, and one that
+        is still starting up (before init_worker) is not killed by a ctrl-c.
+        pool = the process pool
+        sample_image = the image in the sample directory
+        '''
+        handler = signal.signal (signal.SIGINT, signal.SIG_IGN)
+        try:
+            return (pool.submit (analyse_sample, sample_image, self.scales, self.reduce))
+        finally:
+            signal.signal (signal.SIGINT, handler)
+
+    def finish (self, future, sample_image, start):
+        '''
+        method to handle a sample that has finished: append its result to the table
+        future = the future of the sample
+        sample_image = the image in the sample directory
+        start = the time the image was taken in
+        '''
+        try:
+            future.result ()
+        except Exception as e:
+            # an error in the worker (or a dead worker) fails the sample, not the watch
+            print ('ERROR with: ' + sample_image + ' (' + str (e) + ')')
+            self.failures.append ((sample_image, str (e)))
+            return
+
+        # an interrupt here is left to the watch, which finishes the sample again
+        try:
+            self.append_result (sample_image)
+        except Exception as e:
+            print ('ERROR: cannot append the result of: ' + sample_image + ' (' + str (e) + ')')
+            self.failures.append ((sample_image, str (e)))
+            return
+
+        self.completed.append (sample_image)
+        print ('gsd ready: ' + sample_image + ' (' + '%.1f' % (time.time () - start) +
+               ' s after it was taken in)')
+        return
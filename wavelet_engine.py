@@ -0,0 +1,482 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# wavelet_engine: a built in grain size engine in place of DGS.dgs, selected with
+#                 'engine: native' in the config file. The rows picked by density
+#                 are transformed together: one batched fft of the rows, then the
+#                 mean Morlet wavelet power of each row at each scale is the row
+#                 power spectrum weighted by the squared wavelet response in the
+#                 frequency domain (Parseval), so all the rows and scales are one
+#                 matrix product and no inverse transforms are needed. The power is
+#                 rectified by the scale (Liu et al. 2007), each row is normalized,
+#                 and the rows are averaged into the grain size distribution.
+#                 With 'sampling: adaptive' the rows are added in batches in a
+#                 stratified order until the percentiles stop changing, and with
+#                 'scale_selection: adaptive' a coarse pass over a few rows finds
+#                 the band of scales with the energy, only that band is worked at
+#                 the full scale resolution, and the rest is interpolated from the
+#                 coarse scales onto the same reporting bins.
+
+import os
+import sys
+import numpy as np
+
+try:
+    import scipy.fft as fft_lib
+    fft_kwargs = dict (workers = -1)
+except ImportError:
+    fft_lib = np.fft
+    fft_kwargs = dict ()
+
+# morlet wavelet non-dimensional frequency
+morlet_omega0 = 6.0
+
+# default memory budget (bytes) for the row spectra worked on at once
+default_max_bytes = 64 * 1024**2
+
+# adaptive sampling defaults: the relative change of the percentiles between
+# batches that counts as converged, rows per batch, rows before the first check,
+# converged checks in a row needed to stop, and groups for the confidence band
+default_sampling_tolerance = 0.01
+sampling_batch = 32
+sampling_min_rows = 64
+sampling_patience = 2
+sampling_groups = 8
+
+# adaptive scale selection defaults: coarse scales per octave, rows for the coarse
+# pass, and the share of the coarse distribution the refined band must hold
+coarse_notes = 2
+coarse_rows = 32
+refine_fraction = 0.99
+
+# the squared morlet response below this fraction of its peak is left out, so only
+# the band of frequencies the scales respond to is worked
+response_cutoff = 1e-9
+
+# the band responses made so far, by scales and fft length (the same for every
+# image of a size, and every batch of rows)
+_band_cache = dict ()
+_band_cache_size = 64
+
+# percentiles reported by DGS
+default_percentiles = np.array ([0.05, 0.1, 0.16, 0.25, 0.5, 0.75, 0.84, 0.9, 0.95])
+
+def summarise_gsd (bins, freqs, percentiles = default_percentiles):
+    '''
+    function to make a results dict in the same form as DGS.dgs from a grain size
+    distribution: the moments (mean, sorting, skewness and kurtosis) and the
+    percentile values interpolated from the cumulative distribution
+    
+    bins = the grain size bins (a numpy array)
+    freqs = the frequencies of the bins (normalized here)
+    percentiles = the percentiles to report (fractions)
+    '''
+    bins = np.asarray (bins, dtype = np.float64)
+    freqs = np.asarray (freqs, dtype = np.float64)
+    freqs = freqs / freqs.sum ()
+    
+    mean = np.sum (freqs * bins)
+    sorting = np.sqrt (np.sum (freqs * (bins - mean)**2))
+    if sorting > 0.0:
+        skewness = np.sum (freqs * (bins - mean)**3) / sorting**3
+        kurtosis = np.sum (freqs * (bins - mean)**4) / sorting**4
+    else:
+        skewness = 0.0
+        kurtosis = 0.0
+    
+    percentiles = np.asarray (percentiles, dtype = np.float64)
+    values = np.interp (percentiles, np.cumsum (freqs), bins)
+    
+    return ({'mean grain size': mean, 'grain size sorting': sorting,
+             'grain size skewness': skewness, 'grain size kurtosis': kurtosis,
+             'percentiles': percentiles, 'percentile_values': values,
+             'grain size bins': bins, 'grain size frequencies': freqs})
+
+def morlet_response (scales, nfft):
+    '''
+    function to make the squared fourier response of the morlet wavelet at each
+    scale (scales x positive frequencies, float32), normalized to unit energy
+
+    scales = the wavelet scales (pixels, a numpy array)
+    nfft = the fft length
+    '''
+    omega = 2.0 * np.pi * np.arange (nfft // 2 + 1) / nfft
+    s = np.asarray (scales, dtype = np.float64)[:, None]
+    response = (2.0 * np.pi * s) * np.pi**-0.5 * np.exp (-(s * omega - morlet_omega0)**2)
+    return (response.astype (np.float32))
+
+def morlet_band (scales, nfft, cutoff = response_cutoff):
+    '''
+    function to get the squared morlet response of the scales over only the band of
+    frequencies where some scale responds (above cutoff of its peak). Returns (the
+    first frequency of the band, the response, frequencies x scales).
+
+    scales = the wavelet scales (pixels, a numpy array)
+    nfft = the fft length
+    cutoff = the response left out, relative to the peak of each scale
+    '''
+    key = (np.asarray (scales, dtype = np.float64).tobytes (), nfft, cutoff)
+    if key not in _band_cache:
+        response = morlet_response (scales, nfft)
+        keep = np.nonzero ((response > cutoff * response.max (axis = 1, keepdims = True)).any (axis = 0))[0]
+        if len (_band_cache) >= _band_cache_size:
+            _band_cache.clear ()
+        _band_cache[key] = (int (keep[0]), np.ascontiguousarray (response[:, keep[0]:keep[-1] + 1].T))
+    return (_band_cache[key])
+
+def make_scales (ncols, minscale, maxscale, notes):
+    '''
+    function to make the default scales (pixels) when none are given: notes per
+    octave from max (minscale, 2) pixels to ncols / maxscale
+
+    ncols = number of columns in the image
+    minscale = smallest scale (pixels)
+    maxscale = the largest scale is ncols / maxscale
+    notes = scales per octave
+    '''
+    smallest = max (float (minscale), 2.0)
+    octaves = np.log2 ((ncols / float (maxscale)) / smallest)
+    return (smallest * 2.0**(np.arange (0, int (octaves * notes) + 1) / float (notes)))
+
+def detrend_rows (rows):
+    '''
+    function to remove the linear trend of each row (in place, float32 rows)
+    rows = the rows (rows x columns)
+    '''
+    n = rows.shape[1]
+    x = np.arange (n, dtype = np.float32) - (n - 1) / 2.0
+    slope = rows @ x / np.float32 (x @ x)
+    rows -= rows.mean (axis = 1, keepdims = True)
+    rows -= slope[:, None] * x[None, :]
+    return (rows)
+
+def row_spectra (image, row_index, nfft, dofilter, low, high):
+    '''
+    function to get the power spectra of rows of an image between two frequencies
+    (rows x frequencies, float32)
+
+    image = the greyscale image (a 2d numpy array)
+    row_index = the rows
+    nfft = the fft length
+    dofilter = remove the linear trend of each row (else just the mean)
+    low, high = the frequency band (indices of the rfft)
+    '''
+    rows = np.asarray (image[row_index], dtype = np.float32)
+    if dofilter:
+        detrend_rows (rows)
+    else:
+        rows -= rows.mean (axis = 1, keepdims = True)
+
+    spectra = fft_lib.rfft (rows, n = nfft, axis = 1, **fft_kwargs)[:, low:high]
+    return ((spectra.real**2 + spectra.imag**2).astype (np.float32))
+
+def normalize_rows (power, scales, weights = None):
+    '''
+    function to rectify the row power by the scale, interpolate it onto the
+    reporting scales (with weights) and normalize each row to sum to 1
+    power = the row power (rows x scales, float32)
+    scales = the wavelet scales (pixels, a numpy array)
+    weights = matrix (reporting scales x scales) to interpolate with (optional, see
+              plan_scales)
+    '''
+    power /= np.asarray (scales, dtype = np.float32)[None, :]
+    if weights is not None:
+        power = power @ weights.T
+    totals = power.sum (axis = 1, keepdims = True)
+    totals[totals == 0.0] = 1.0
+    power /= totals
+    return (power)
+
+def row_power (image, scales, density = 1, dofilter = 1, max_bytes = default_max_bytes,
+               row_index = None, weights = None):
+    '''
+    function to get the scale rectified morlet wavelet power of every density-th row
+    of an image at each scale, normalized so each row sums to 1 (rows x scales).
+    The rows are worked through in chunks that fit in max_bytes.
+
+    image = the greyscale image (a 2d numpy array)
+    scales = the wavelet scales (pixels, a numpy array)
+    density = analyse every density-th row
+    dofilter = remove the linear trend of each row (else just the mean)
+    max_bytes = memory budget for the row spectra of a chunk
+    row_index = the rows to analyse, in place of every density-th row (optional)
+    weights = matrix (reporting scales x scales) to interpolate the power onto the
+              reporting scales before the rows are normalized (optional, see
+              plan_scales)
+    '''
+    ncols = image.shape[1]
+    nfft = 1 << int (np.ceil (np.log2 (ncols)))
+    low, response = morlet_band (scales, nfft)              # frequencies x scales
+    if row_index is None:
+        row_index = np.arange (0, image.shape[0], max (1, int (density)))
+
+    # rows per chunk, per fft column: the float32 rows (4 bytes), the half length
+    # spectra (numpy.fft gives complex128 even for float32 rows, so 16 bytes for
+    # every other column), the float64 squares of the real and imaginary parts
+    # (8 bytes) and the float32 power (2 bytes), rounded up
+    chunk = max (1, int (max_bytes // (nfft * 24)))
+
+    power = np.empty ((len (row_index), len (scales)), dtype = np.float32)
+    for start in range (0, len (row_index), chunk):
+        idx = row_index[start:start + chunk]
+        power[start:start + len (idx)] = row_spectra (image, idx, nfft, dofilter, low,
+                                                      low + len (response)) @ response
+
+    return (normalize_rows (power, scales, weights))
+
+def select_scales (scales, ncols, config):
+    '''
+    function to get the scales (pixels) that are analysed: the given scales (grain
+    sizes) divided by the resolution, those at or above minscale pixels and no
+    larger than ncols / maxscale (or the default scales if none are given)
+
+    scales = the scales (grain sizes in the units of the resolution, a numpy array
+             or None)
+    ncols = number of columns in the image
+    config = the config dict
+    '''
+    minscale = float (config.get ('minscale', 0) or 0)
+    maxscale = float (config.get ('maxscale', 8))
+    if scales is None:
+        scales = make_scales (ncols, minscale, maxscale, int (config.get ('notes', 8)))
+    else:
+        scales = np.asarray (scales, dtype = np.float64) / float (config['resolution'])
+    return (scales[(scales >= minscale) & (scales <= ncols / maxscale)])
+
+def interpolation_weights (evaluated, reporting):
+    '''
+    function to make the matrix (reporting x evaluated, float32) that interpolates
+    values at the evaluated scales linearly in log scale onto the reporting scales
+    evaluated = the evaluated scales (increasing, a numpy array)
+    reporting = the reporting scales (a numpy array)
+    '''
+    log_e = np.log (evaluated)
+    log_r = np.log (reporting)
+    identity = np.eye (len (evaluated))
+    weights = np.empty ((len (reporting), len (evaluated)), dtype = np.float32)
+    for j in range (len (evaluated)):
+        weights[:, j] = np.interp (log_r, log_e, identity[j])
+    return (weights)
+
+def plan_scales (image, scales, config, rows):
+    '''
+    function to choose the scales to evaluate for adaptive scale selection: a coarse
+    pass (coarse_notes per octave, picked from the reporting scales) over a few rows
+    finds the band that holds refine_fraction of the distribution, and every
+    reporting scale in that band (plus one coarse step on each side) is evaluated
+    along with the coarse scales; the tails are interpolated. The spectra of the
+    coarse rows are kept, so their power at the chosen scales comes without another
+    transform. Returns (evaluated scales, weights to interpolate them onto the
+    reporting scales, see row_power, and the power of the rows at the reporting
+    scales).
+
+    image = the greyscale image (a 2d numpy array)
+    scales = the reporting scales (pixels, increasing, a numpy array)
+    config = the config dict (dofilter)
+    rows = the rows for the coarse pass (spread over the image)
+    '''
+    nfft = 1 << int (np.ceil (np.log2 (image.shape[1])))
+
+    # the coarse scales: the reporting scales nearest to log spaced targets, and
+    # the first and last, so their band covers every reporting scale
+    octaves = np.log2 (scales[-1] / scales[0])
+    targets = scales[0] * 2.0**(np.arange (0, int (octaves * coarse_notes) + 2) / float (coarse_notes))
+    nearest = np.abs (np.log (scales)[None, :] - np.log (targets)[:, None]).argmin (axis = 1)
+    coarse = np.unique (np.append (nearest, [0, len (scales) - 1]))
+
+    # the coarse distribution of the rows
+    low, response = morlet_band (scales[coarse], nfft)
+    spectra = row_spectra (image, rows, nfft, config.get ('dofilter', 1), low, low + len (response))
+    freqs = normalize_rows (spectra @ response, scales[coarse]).astype (np.float64).mean (axis = 0)
+    cumulative = np.cumsum (freqs) / np.sum (freqs)
+
+    # the band between the tails, widened by a coarse step each side
+    tail = (1.0 - refine_fraction) / 2.0
+    first = max (0, int (np.searchsorted (cumulative, tail)) - 1)
+    last = min (len (coarse) - 1, int (np.searchsorted (cumulative, 1.0 - tail)) + 1)
+    evaluated = scales[np.union1d (coarse, np.arange (coarse[first], coarse[last] + 1))]
+    weights = interpolation_weights (evaluated, scales)
+
+    # the power of the coarse rows at the evaluated scales, from the kept spectra
+    band_low, band = morlet_band (evaluated, nfft)
+    power = spectra[:, band_low - low:band_low - low + len (band)] @ band
+    return (evaluated, weights, normalize_rows (power, evaluated, weights))
+
+def stratified_order (n):
+    '''
+    function to order 0..n-1 so that every prefix is spread evenly over the range
+    (golden ratio order: sorted by the fractional part of i * 0.618..). Unlike a
+    bit reversed order the prefixes do not land on multiples of a power of two, so
+    they are not all at the same phase of the 8 x 8 jpeg blocks.
+    n = number of items
+    '''
+    golden = (np.sqrt (5.0) - 1.0) / 2.0
+    return (np.argsort ((np.arange (n) * golden) % 1.0, kind = 'stable'))
+
+def percentile_values (bins, freqs, percentiles):
+    '''
+    function to interpolate the percentile values of a distribution
+    bins = the grain size bins
+    freqs = the frequencies (any scale)
+    percentiles = the percentiles (fractions)
+    '''
+    cumulative = np.cumsum (freqs) / np.sum (freqs)
+    return (np.interp (percentiles, cumulative, bins))
+
+def adaptive_row_power (image, scales, bins, config, max_bytes = default_max_bytes,
+                        weights = None, first = None):
+    '''
+    function to analyse rows in a stratified order (spread over the whole image) in
+    batches until the percentiles converge: the percentiles of the running
+    distribution change by less than the tolerance (relative) for sampling_patience
+    batches in a row, and their 95 % confidence half widths are within the
+    tolerance too. The candidate rows are every density-th row, so the worst case
+    is the fixed density analysis. Returns (the power of the rows used, rows x
+    scales, whether it converged, number of candidate rows).
+
+    image = the greyscale image (a 2d numpy array)
+    scales = the wavelet scales (pixels, a numpy array)
+    bins = the grain size bins (of the reporting scales)
+    config = the config dict (density, dofilter, sampling_tolerance)
+    max_bytes = memory budget for the row spectra worked on at once
+    weights = interpolation onto the reporting scales (optional, see row_power)
+    first = the power of the first rows in the order, already worked (optional)
+    '''
+    tolerance = float (config.get ('sampling_tolerance', default_sampling_tolerance))
+    candidates = np.arange (0, image.shape[0], max (1, int (config.get ('density', 1))))
+    order = candidates[stratified_order (len (candidates))]
+
+    batches = []
+    total = np.zeros (len (bins), dtype = np.float64)
+    done = 0
+    if first is not None:
+        batches.append (first)
+        total = total + first.sum (axis = 0, dtype = np.float64)
+        done = len (first)
+    previous = None
+    stable = 0
+    converged = False
+    for start in range (done, len (order), sampling_batch):
+        power = row_power (image, scales, 1, config.get ('dofilter', 1), max_bytes,
+                           order[start:start + sampling_batch], weights)
+        batches.append (power)
+        total = total + power.sum (axis = 0, dtype = np.float64)
+        if start + len (power) < sampling_min_rows:
+            continue
+
+        # the change since the last batch
+        values = percentile_values (bins, total, default_percentiles)
+        scale = np.maximum (np.abs (values), 1e-12)
+        if previous is not None and np.max (np.abs (values - previous) / scale) < tolerance:
+            stable = stable + 1
+        else:
+            stable = 0
+        previous = values
+
+        # the confidence band, only checked once the values have settled
+        if stable >= sampling_patience:
+            mean_ci, value_ci = confidence_band (np.concatenate (batches), bins,
+                                                 default_percentiles)
+            if np.max (value_ci / scale) < tolerance:
+                converged = True
+                break
+
+    return (np.concatenate (batches), converged, len (candidates))
+
+def confidence_band (power, bins, percentiles, groups = sampling_groups):
+    '''
+    function to get the 95 % confidence half widths of the mean grain size and the
+    percentile values from the spread of interleaved groups of rows (the rows are
+    in stratified order, so each group covers the whole image). Returns (mean half
+    width, percentile half widths).
+
+    power = the row power (rows x scales, see row_power)
+    bins = the grain size bins
+    percentiles = the percentiles (fractions)
+    groups = number of groups
+    '''
+    groups = min (groups, len (power))
+    if groups < 2:
+        return (np.nan, np.full (len (percentiles), np.nan))
+
+    group = np.arange (len (power)) % groups
+    means = []
+    values = []
+    for g in range (groups):
+        freqs = power[group == g].astype (np.float64).mean (axis = 0)
+        means.append (np.sum (freqs * bins) / np.sum (freqs))
+        values.append (percentile_values (bins, freqs, percentiles))
+
+    scale = 1.96 / np.sqrt (groups)
+    return (np.std (means, ddof = 1) * scale, np.std (values, axis = 0, ddof = 1) * scale)
+
+def wavelet_gsd (image, config, scales, max_bytes = default_max_bytes):
+    '''
+    function to run the grain size analysis on a greyscale image, returning a dict
+    in the same form as DGS.dgs (see summarise_gsd). The scales analysed are the
+    given scales in pixels between minscale and ncols / maxscale (see
+    select_scales), and the grain size bins are those times the resolution, so the
+    given scales themselves. With 'sampling: adaptive' in the config the rows are
+    added until the percentiles converge (see adaptive_row_power), and the rows
+    used and the 95 % confidence band are returned in the 'stats' entry (written
+    to stats.txt). With 'scale_selection: adaptive' only the scales chosen by
+    plan_scales are evaluated and the bins are still all the scales.
+
+    image = the greyscale image (a 2d numpy array)
+    config = the config dict (density, resolution, dofilter, maxscale, minscale, notes)
+    scales = the scales (grain sizes in the units of the resolution, increasing, a
+             numpy array, or None for notes per octave in pixels)
+    max_bytes = memory budget for the row spectra worked on at once
+    '''
+    if image.ndim != 2:
+        raise ValueError ('the wavelet engine needs a greyscale image')
+    used = select_scales (scales, image.shape[1], config)
+    if len (used) == 0:
+        raise ValueError ('no scales between minscale and ncols / maxscale')
+
+    bins = used * float (config['resolution'])
+    dofilter = config.get ('dofilter', 1)
+    candidates = np.arange (0, image.shape[0], max (1, int (config.get ('density', 1))))
+    evaluated, weights, first = used, None, None
+    stats = dict ()
+    if str (config.get ('scale_selection', 'dense')).lower () == 'adaptive' and len (used) > 2:
+        rows = candidates[stratified_order (len (candidates))[:coarse_rows]]
+        evaluated, weights, first = plan_scales (image, used, config, rows)
+        stats['scales_evaluated'] = int (len (evaluated))
+
+    if str (config.get ('sampling', 'fixed')).lower () != 'adaptive':
+        if first is None:
+            power = row_power (image, evaluated, 1, dofilter, max_bytes, candidates)
+        else:
+            rest = np.setdiff1d (candidates, rows)
+            power = np.concatenate ((first, row_power (image, evaluated, 1, dofilter,
+                                                       max_bytes, rest, weights)))
+    else:
+        power, converged, count = adaptive_row_power (image, evaluated, bins, config,
+                                                      max_bytes, weights, first)
+        mean_ci, value_ci = confidence_band (power, bins, default_percentiles)
+        stats.update (rows_used = int (len (power)), rows_available = int (count),
+                      converged = bool (converged), ci95_mean = float (mean_ci))
+        for p, ci in zip (default_percentiles, value_ci):
+            stats['ci95_p' + str (int (round (p * 100)))] = float (ci)
+
+    res = summarise_gsd (bins, power.astype (np.float64).mean (axis = 0))
+    if len (stats) > 0:
+        res['stats'] = stats
+    return (res)
@@ -0,0 +1,331 @@
+# photoseive utilities
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# worker_server: a long running local server that keeps the libraries (opencv,
+#                pandas, yaml, DGS) imported and the undistortion maps and clahe
+#                objects warm, so small jobs do not pay the start up cost each
+#                time. It listens on a unix socket (only the user can connect)
+#                for json lines requests: analyse a sample or a tree, calibrate
+#                an image, coallate a tree. The printed progress of a request is
+#                streamed back as json lines, then the result. Requests are run
+#                one at a time in the server thread (a tree request can still use
+#                a pool of worker processes). The client side only needs the
+#                standard library, so it starts quickly:
+#                    python worker_server.py serve &
+#                    python worker_server.py analyse /data/pismo/image_0046/DSC_0046.JPG
+
+import os
+import sys
+import json
+import time
+import socket
+import traceback
+
+# default socket, one server per user
+default_socket_path = os.path.join (os.path.expanduser ('~'), '.photoseive', 'worker.sock')
+
+def send_lines (conn, message):
+    '''
+    function to send a message dict as a json line (numpy values are converted)
+    conn = the socket
+    message = the message dict
+    '''
+    def convert (value):
+        if hasattr (value, 'tolist'):
+            return (value.tolist ())
+        return (str (value))
+    conn.sendall ((json.dumps (message, default = convert) + '\n').encode ('utf-8'))
+    return
+
+class progress_stream:
+    def __init__ (self, conn):
+        '''
+        file like object put in place of sys.stdout while a request runs, each
+        printed line is sent to the client as a 'progress' message
+        conn = the client socket
+        '''
+        self.conn = conn
+        self.buffer = ''
+        self.connected = True
+        return
+
+    def write (self, text):
+        self.buffer = self.buffer + text
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split ('\n', 1)
+            if self.connected and line.strip ():
+                try:
+                    send_lines (self.conn, dict (event = 'progress', message = line))
+                except OSError:
+                    self.connected = False      # the client went away, keep working
+        return (len (text))
+
+    def flush (self):
+        return
+
+class worker_server:
+    def __init__ (self, socket_path = default_socket_path, scales = None):
+        '''
+        constructor takes the socket to listen on
+        socket_path = the unix socket file
+        scales = the default scales for the analysis requests (the default scales of
+                 run_dgs_analysis if not given)
+        '''
+        self.socket_path = socket_path
+        self.scales = scales
+        self.requests = 0
+        self.started = time.time ()
+        self.running = False
+        return
+
+    def warm (self):
+        '''
+        method to import the analysis modules (the start up cost paid once)
+        '''
+        import run_dgs_analysis
+        self.ops = run_dgs_analysis
+        if self.scales is None:
+            self.scales = run_dgs_analysis.default_scales ()
+        return
+
+    def serve (self):
+        '''
+        method to listen for requests until a 'shutdown' request (or ctrl-c)
+        '''
+        self.warm ()
+
+        socket_dir = os.path.dirname (self.socket_path)
+        if socket_dir and not os.path.isdir (socket_dir):
+            os.makedirs (socket_dir, mode = 0o700)
+        if os.path.exists (self.socket_path):
+            if ping (self.socket_path):
+                print ('ERROR: a server is already listening on: ' + self.socket_path)
+                return
+            os.unlink (self.socket_path)        # left by a server that died
+
+        # the umask makes the socket owner only from the moment bind creates it
+        server = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask (0o177)
+        try:
+            server.bind (self.socket_path)
+        finally:
+            os.umask (umask)
+        os.chmod (self.socket_path, 0o600)
+        server.listen (16)
+        print ('listening on: ' + self.socket_path)
+
+        self.running = True
+        try:
+            while self.running:
+                conn, address = server.accept ()
+                with conn:
+                    self.handle (conn)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close ()
+            os.unlink (self.socket_path)
+        print ('stopped')
+        return
+
+    def handle (self, conn):
+        '''
+        method to run the request from a client connection, streaming the progress
+        and then the result (or the error) back
+        conn = the client socket
+        '''
+        f = conn.makefile ('r', encoding = 'utf-8')
+        line = f.readline ()
+        if not line:
+            return
+
+        stdout = sys.stdout
+        stream = progress_stream (conn)
+        try:
+            request = json.loads (line)
+            command = request.pop ('command')
+            method = getattr (self, 'do_' + command, None)
+            if method is None:
+                raise ValueError ('unknown command: ' + str (command))
+
+            self.requests = self.requests + 1
+            sys.stdout = stream
+            start = time.time ()
+            result = method (**request)
+            reply = dict (event = 'result', ok = True, result = result,
+                          seconds = time.time () - start)
+        except Exception as e:
+            reply = dict (event = 'result', ok = False, error = type (e).__name__ + ': ' + str (e),
+                          traceback = traceback.format_exc ())
+        finally:
+            sys.stdout = stdout                 # also on ctrl-c, not left on the client
+
+        if stream.connected:
+            try:
+                send_lines (conn, reply)
+            except OSError:
+                pass
+        return
+
+    def do_ping (self):
+        '''
+        request to check the server is up
+        '''
+        return (dict (pid = os.getpid (), uptime = time.time () - self.started,
+                      requests = self.requests))
+
+    def do_shutdown (self):
+        '''
+        request to stop the server after this request
+        '''
+        self.running = False
+        return (dict (pid = os.getpid ()))
+
+    def do_analyse (self, image, scales = None, fused = True, reduce = False):
+        '''
+        request to analyse a sample, returns its row of the coallated table (a list
+        of rows, one for each region of interest, for a sample with rois)
+        image = the image in the sample directory
+        scales = the scales (a list, the server default if not given)
+        fused = run the in-memory pipeline (else the file workflow)
+        reduce = decode oversampled images at a reduced size
+        '''
+        import numpy as np
+        scales = self.scales if scales is None else np.asarray (scales, dtype = np.float64)
+        self.ops.run_photoseive_sample (image, scales, fused, reduce = reduce)
+        rows = self.ops.read_sample_rows (os.path.dirname (os.path.abspath (image)))
+        return (rows if self.ops.has_rois (image) else rows[0])
+
+    def do_analyse_tree (self, base_dir, scales = None, **kwargs):
+        '''
+        request to analyse a tree (see run_photoseive_tree), returns the failed
+        samples
+        base_dir = base directory of the tree
+        scales = the scales (a list, the server default if not given)
+        kwargs = the other arguments of run_photoseive_tree (e.g. jobs, fused)
+        '''
+        import numpy as np
+        scales = self.scales if scales is None else np.asarray (scales, dtype = np.float64)
+        failures = self.ops.run_photoseive_tree (base_dir, scales, **kwargs)
+        return (dict (failures = [f[0] for f in failures]))
+
+    def do_calibrate (self, image):
+        '''
+        request to unwarp an image, returns the calibrated image name
+        image = the raw image in the sample directory
+        '''
+        return (dict (calibrated = self.ops.distortion_calibration (image).run ()))
+
+    def do_coallate (self, base_dir, output_file, incremental = False, jobs = 8):
+        '''
+        request to coallate a tree, returns the size of the table
+        base_dir = base directory of the tree
+        output_file = the coallated csv file
+        incremental = only read the samples that have changed
+        jobs = number of threads to read the samples on
+        '''
+        res = self.ops.coallate_gsd_data (base_dir, output_file, jobs, incremental)
+        return (dict (output_file = output_file, rows = len (res), columns = len (res.columns)))
+
+def request (command, socket_path = default_socket_path, on_progress = None, **args):
+    '''
+    function to send a request to the server and wait for the result. The progress
+    messages are passed to on_progress as they arrive (printed if not given).
+    Returns the result, or raises RuntimeError if the request failed.
+
+    command = 'analyse', 'analyse_tree', 'calibrate', 'coallate', 'ping' or 'shutdown'
+    socket_path = the server socket
+    on_progress = function called with each progress message (optional)
+    args = the arguments of the request (see the do_ methods of worker_server)
+    '''
+    if on_progress is None:
+        on_progress = print
+
+    conn = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+    with conn:
+        conn.connect (socket_path)
+        message = dict (args)
+        message['command'] = command
+        conn.sendall ((json.dumps (message) + '\n').encode ('utf-8'))
+        for line in conn.makefile ('r', encoding = 'utf-8'):
+            reply = json.loads (line)
+            if reply['event'] == 'progress':
+                on_progress (reply['message'])
+            elif reply['ok']:
+                return (reply['result'])
+            else:
+                raise RuntimeError (reply['error'])
+    raise RuntimeError ('the server closed the connection without a result')
+
+def ping (socket_path = default_socket_path):
+    '''
+    function to check if a server is listening, returns the ping result or None
+    socket_path = the server socket
+    '''
+    try:
+        return (request ('ping', socket_path))
+    except (OSError, RuntimeError):
+        return (None)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser (description = 'photoseive worker server and client')
+    parser.add_argument ('--socket', default = default_socket_path, help = 'the server socket')
+    commands = parser.add_subparsers (dest = 'command')
+    commands.required = True
+    commands.add_parser ('serve', help = 'run the server')
+    commands.add_parser ('ping', help = 'check the server is up')
+    commands.add_parser ('shutdown', help = 'stop the server')
+    p = commands.add_parser ('analyse', help = 'analyse a sample')
+    p.add_argument ('image', help = 'the image in the sample directory')
+    p.add_argument ('--reduce', action = 'store_true', help = 'decode at a reduced size')
+    p.add_argument ('--file-workflow', action = 'store_true', help = 'write the clahe image')
+    p = commands.add_parser ('analyse_tree', help = 'analyse a tree')
+    p.add_argument ('base_dir', help = 'base directory of the tree')
+    p.add_argument ('--jobs', type = int, default = 1, help = 'number of worker processes')
+    p = commands.add_parser ('calibrate', help = 'unwarp an image')
+    p.add_argument ('image', help = 'the raw image in the sample directory')
+    p = commands.add_parser ('coallate', help = 'coallate a tree')
+    p.add_argument ('base_dir', help = 'base directory of the tree')
+    p.add_argument ('output_file', help = 'the coallated csv file')
+    p.add_argument ('--incremental', action = 'store_true', help = 'only read changed samples')
+    a = parser.parse_args ()
+
+    if a.command == 'serve':
+        worker_server (a.socket).serve ()
+        sys.exit (0)
+
+    if a.command == 'analyse':
+        args = dict (image = os.path.abspath (a.image), fused = not a.file_workflow, reduce = a.reduce)
+    elif a.command == 'analyse_tree':
+        args = dict (base_dir = os.path.abspath (a.base_dir), jobs = a.jobs)
+    elif a.command == 'calibrate':
+        args = dict (image = os.path.abspath (a.image))
+    elif a.command == 'coallate':
+        args = dict (base_dir = os.path.abspath (a.base_dir),
+                     output_file = os.path.abspath (a.output_file), incremental = a.incremental)
+    else:
+        args = dict ()
+
+    try:
+        print (json.dumps (request (a.command, a.socket, **args), indent = 1))
+    except (OSError, RuntimeError) as e:
+        print ('ERROR: ' + str (e))
+        sys.exit (1)